@@ -17,7 +17,37 @@ export  async function uploadFile({ filepath, content }) {
     return response.json();
 }
 
-export async function analyze({ filepath, token, model = null }) {
+export async function uploadProject(files) {
+    // the files of a folder input keep their path under the chosen folder, archives are extracted by the server
+    const form = new FormData();
+    for (const file of files) {
+        const path = file.webkitRelativePath ? file.webkitRelativePath.split("/").slice(1).join("/") : file.name;
+        form.append("files", file, path);
+    }
+
+    const response = await fetch("http://localhost:8000/upload/project", {
+        method: "POST",
+        body: form,
+    });
+
+    if (!response.ok) {
+        throw new Error(`Upload failed: ${response.status} ${response.statusText}`);
+    }
+
+    return response.json();
+}
+
+export async function getJob(jobId) {
+    const response = await fetch(`http://localhost:8000/jobs/${jobId}`);
+
+    if (!response.ok) {
+        throw new Error(`Job lookup failed: ${response.status} ${response.statusText}`);
+    }
+
+    return response.json();
+}
+
+export async function analyze({ filepath = null, hash = null, token, model = null, pollInterval = 2000 }) {
     const response = await fetch("http://localhost:8000/analyze", {
         method: "POST",
         headers: {
@@ -25,14 +55,79 @@ export async function analyze({ filepath, token, model = null }) {
         },
         body: JSON.stringify({
             "filepath": filepath,
+            "hash": hash,
             "hf_token": token,
             "model": model
         }),
     });
 
     if (!response.ok) {
-        throw new Error(`Upload failed: ${response.status} ${response.statusText}`);
+        throw new Error(`Analysis failed: ${response.status} ${response.statusText}`);
     }
 
-    return response.json();
+    // the analysis runs as a background job, polled until it is over, an upload analyzed before is done at once
+    const submitted = await response.json();
+    if (submitted.status === "done") {
+        return submitted.result;
+    }
+    const job_id = submitted.job_id;
+    while (true) {
+        const job = await getJob(job_id);
+        if (job.status === "done") {
+            return job.result;
+        }
+        if (job.status === "failed") {
+            throw new Error(`Analysis failed: ${job.error}`);
+        }
+        await new Promise(resolve => setTimeout(resolve, pollInterval));
+    }
+}
+
+export async function analyzeStream({ filepath = null, hash = null, token, model = null, onRecord = () => {} }) {
+    const response = await fetch("http://localhost:8000/analyze/stream", {
+        method: "POST",
+        headers: {
+            "Content-Type": "application/json",
+        },
+        body: JSON.stringify({
+            "filepath": filepath,
+            "hash": hash,
+            "hf_token": token,
+            "model": model
+        }),
+    });
+
+    if (!response.ok) {
+        throw new Error(`Analysis failed: ${response.status} ${response.statusText}`);
+    }
+
+    // one JSON record per line: the file header, then each function once defined
+    const records = [];
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = "";
+    const handle = (line) => {
+        if (!line.trim()) {
+            return;
+        }
+        const record = JSON.parse(line);
+        if (record.error) {
+            throw new Error(`Analysis failed: ${record.error}`);
+        }
+        records.push(record);
+        onRecord(record);
+    };
+    while (true) {
+        const { done, value } = await reader.read();
+        if (done) {
+            break;
+        }
+        buffer += decoder.decode(value, { stream: true });
+        const lines = buffer.split("\n");
+        buffer = lines.pop();
+        lines.forEach(handle);
+    }
+    handle(buffer + decoder.decode());
+
+    return records;
 }
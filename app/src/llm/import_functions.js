@@ -11,7 +11,7 @@ export const LLM_API = {
 
             // FUNCTION
             let fn = editor.createConcept("function");
-            fn.getAttribute("name").setValue(entry.name);
+            fn.getAttribute("name").setValue(entry.qualname || entry.name);
             fn.getAttribute("description").setValue(entry.description || "");
             fn.getAttribute("category").setValue(entry.category || "");
 
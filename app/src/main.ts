@@ -49,7 +49,7 @@ editor.init({
   projectionModel: PROJECTION
 });
 
-let folderName: string;
+let uploadHash: string;
 
 btnUpload.addEventListener("click", (event) => {
   const filepath = "/code/fichier_test.py"
@@ -82,17 +82,16 @@ def list_files(directory: str) -> list[str]:
         print(f"Error listing files in {directory}: {e}")
         return []
     `
-  }).then(name =>{
-    folderName = name
+  }).then(upload =>{
+    uploadHash = upload.hash
   })
     .catch(console.error)
 })
 
 btnAnalyze.addEventListener("click", (event) => {
-  const filePath = "/"+folderName+"/fichier_test.py"
   const token = "" // get from .env
   analyze({
-    filepath: filePath,
+    hash: uploadHash,
     token
   }).then(json => {
     let instance = editor.createInstance("file");
@@ -0,0 +1,224 @@
+import argparse
+import fnmatch
+import glob
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from dotenv import load_dotenv
+
+from cache import ExtractionCache, ResponseCache, ResultStore
+from clients import ClientRegistry
+from gentleman_llm import STRATEGIES, GentlemanLLM
+from project_index import ProjectIndex
+from rate_limit import RateLimiter
+from util import (
+    latest_functions_json,
+    list_files,
+    read_functions_from_json,
+    write_file,
+    write_functions_to_json,
+)
+
+
+def discover_files(target: str, pattern: str = "*.py") -> list[str]:
+    """Lists the files to analyze, from a directory searched recursively or from a glob.
+
+    Args:
+        target (str): A directory, a file, or a glob such as "src/**/*.py".
+        pattern (str, optional): The file name pattern to keep when `target` is a directory. Defaults to "*.py".
+
+    Returns:
+        list[str]: The sorted paths of the files.
+    """
+    if os.path.isdir(target):
+        return [
+            os.path.join(target, f)
+            for f in list_files(target, recursive=True)
+            if fnmatch.fnmatch(os.path.basename(f), pattern)
+        ]
+    if os.path.isfile(target):
+        return [target]
+    return sorted(f for f in glob.glob(target, recursive=True) if os.path.isfile(f))
+
+
+def output_name(filepath: str, root: str | None = None) -> str:
+    """Gives the name of a file's JSON output, unique within the analyzed tree.
+
+    Args:
+        filepath (str): The path of the analyzed file.
+        root (str | None, optional): The analyzed directory, the path is made relative to it. If None, only the file's name is kept. Defaults to None.
+
+    Returns:
+        str: The output name, "pkg/mod.py" gives "pkg.mod.py".
+    """
+    rel_path = os.path.relpath(filepath, root) if root else os.path.basename(filepath)
+    return rel_path.replace(os.sep, ".").replace("/", ".")
+
+
+def analyze_files(
+    service: GentlemanLLM,
+    files: list[str],
+    root: str | None = None,
+    output_dir: str = "results",
+    file_workers: int = 4,
+    incremental: bool = True,
+) -> dict:
+    """Analyzes the files across a thread pool and writes one JSON per file, then the call graph of the files.
+
+    The LLM queries of every file go through the same `service`, so its `max_in_flight` bounds them globally.
+    Each file is added to a `ProjectIndex` from its extraction once analyzed, giving the calls between the files.
+
+    Args:
+        service (GentlemanLLM): The service defining the functions.
+        files (list[str]): The paths of the files to analyze.
+        root (str | None, optional): The analyzed directory, used to name the outputs. Defaults to None.
+        output_dir (str, optional): The directory of the JSON outputs. Defaults to "results".
+        file_workers (int, optional): The number of files analyzed at once. Defaults to 4.
+        incremental (bool, optional): If True, the last output of each file is reused for its unchanged functions. Defaults to True.
+
+    Returns:
+        dict: The index of the run, the output of each analyzed file, the error of each failed file and the call graph's file.
+    """
+    index = {"outputs": {}, "errors": {}}
+    project = ProjectIndex()
+    total = len(files)
+    start = time.monotonic()
+
+    def analyze_one(filepath: str) -> str:
+        name = output_name(filepath, root)
+        previous = None
+        if incremental:
+            last_output = latest_functions_json(name, dir=output_dir)
+            if last_output:
+                previous = read_functions_from_json(last_output)
+        result = service.analyze_file(filepath, previous=previous)
+        _, _, _, file_context = service.extract(filepath)
+        project.add_context(filepath, file_context, root)
+        return write_functions_to_json(result, name, dir=output_dir)
+
+    with ThreadPoolExecutor(max_workers=max(1, file_workers)) as executor:
+        futures = {executor.submit(analyze_one, f): f for f in files}
+        for done, future in enumerate(as_completed(futures), start=1):
+            filepath = futures[future]
+            key = os.path.relpath(filepath, root) if root else filepath
+            elapsed = time.monotonic() - start
+            try:
+                index["outputs"][key] = future.result()
+                print(f"[{done}/{total}] {key} ({elapsed:.1f}s)")
+            except Exception as e:
+                index["errors"][key] = str(e)
+                print(f"[{done}/{total}] [ERROR] {key}: {e} ({elapsed:.1f}s)")
+
+    index["outputs"] = dict(sorted(index["outputs"].items()))
+    index["errors"] = dict(sorted(index["errors"].items()))
+    index["call_graph"] = write_file(
+        os.path.join(output_dir, "call_graph.json"),
+        json.dumps(project.to_json(), indent=4, ensure_ascii=False),
+    )
+    return index
+
+
+def analyze_directory(
+    service: GentlemanLLM,
+    target: str,
+    pattern: str = "*.py",
+    output_dir: str = "results",
+    file_workers: int = 4,
+    incremental: bool = True,
+) -> dict:
+    """Analyzes every matching file of a directory, or of a glob, and writes the index of the run.
+
+    Args:
+        service (GentlemanLLM): The service defining the functions.
+        target (str): A directory, a file, or a glob such as "src/**/*.py".
+        pattern (str, optional): The file name pattern to keep when `target` is a directory. Defaults to "*.py".
+        output_dir (str, optional): The directory of the JSON outputs. Defaults to "results".
+        file_workers (int, optional): The number of files analyzed at once. Defaults to 4.
+        incremental (bool, optional): If True, the last output of each file is reused for its unchanged functions. Defaults to True.
+
+    Returns:
+        dict: The index of the run, also written to `output_dir/index.json`.
+    """
+    files = discover_files(target, pattern)
+    if os.path.isdir(target):
+        root = target
+    elif files:
+        root = os.path.commonpath([os.path.dirname(os.path.abspath(f)) for f in files])
+    else:
+        root = None
+    print(f"Analyzing {len(files)} files from {target}")
+
+    index = analyze_files(service, files, root, output_dir, file_workers, incremental)
+    write_file(
+        os.path.join(output_dir, "index.json"),
+        json.dumps(index, indent=4, ensure_ascii=False),
+    )
+    return index
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Analyzes the Python files of a directory with the gentleman LLM."
+    )
+    parser.add_argument("target", help="A directory, a file, or a glob.")
+    parser.add_argument("--pattern", default="*.py", help="File name pattern in a directory.")
+    parser.add_argument("--output", default="results", help="Directory of the JSON outputs.")
+    parser.add_argument("--model", default="meta-llama/Llama-3.1-70B-Instruct")
+    parser.add_argument("--file-workers", type=int, default=4, help="Files analyzed at once.")
+    parser.add_argument("--function-workers", type=int, default=4, help="Functions analyzed at once per file.")
+    parser.add_argument("--max-in-flight", type=int, default=16, help="LLM queries running at once, over all files.")
+    parser.add_argument("--rps", type=float, default=None, help="LLM requests per second budget.")
+    parser.add_argument("--tpm", type=float, default=None, help="LLM tokens per minute budget.")
+    parser.add_argument("--strategy", default="pipeline", choices=STRATEGIES, help="How the functions are queried.")
+    parser.add_argument("--batch-size", type=int, default=5, help="Functions per query with the batched strategy.")
+    parser.add_argument("--context-budget", type=int, default=1500, help="Tokens of file context sent with a function, 0 for the whole file.")
+    parser.add_argument("--category-threshold", type=float, default=0.85, help="Confidence above which the rule-based category replaces the LLM's, above 1 always asks the LLM.")
+    parser.add_argument("--full", action="store_true", help="Redefine every function, ignoring previous outputs.")
+    parser.add_argument("--http2", action="store_true", help="Query the LLM over HTTP/2, needs `pip install h2`.")
+    parser.add_argument("--no-cache", action="store_true", help="Do not read cached LLM answers nor stored definitions.")
+    args = parser.parse_args()
+
+    load_dotenv()
+    clients = ClientRegistry(
+        http2=args.http2,
+        max_connections=args.max_in_flight,
+        max_keepalive_connections=args.max_in_flight,
+    )
+    service = GentlemanLLM(
+        model=args.model,
+        hf_token=os.getenv("HF_TOKEN"),
+        max_workers=args.function_workers,
+        strategy=args.strategy,
+        batch_size=args.batch_size,
+        context_budget=args.context_budget or None,
+        category_threshold=args.category_threshold,
+        cache=ResponseCache(bypass=args.no_cache),
+        result_store=ResultStore(bypass=args.no_cache),
+        extraction_cache=ExtractionCache(path="cache/extractions"),
+        clients=clients,
+        rate_limiter=RateLimiter(
+            requests_per_second=args.rps,
+            tokens_per_minute=args.tpm,
+            max_concurrency=args.max_in_flight,
+        ),
+    )
+    try:
+        index = analyze_directory(
+            service,
+            args.target,
+            pattern=args.pattern,
+            output_dir=args.output,
+            file_workers=args.file_workers,
+            incremental=not args.full,
+        )
+    finally:
+        clients.close()
+    print(f"[OK] {len(index['outputs'])} files analyzed, {len(index['errors'])} failed.")
+    print(f"LLM answers: {service.repair_stats.summary()}.")
+    print(f"Definitions reused from previous runs: {service.result_store.hits}.")
+
+
+if __name__ == "__main__":
+    main()
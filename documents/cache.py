@@ -0,0 +1,414 @@
+import hashlib
+import json
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import context
+import static_types
+import type_grammar
+import util
+from context import FileContext
+
+
+def extractor_version() -> str:
+    """Hashes the source of the modules extracting the files, to invalidate the extractions when they change.
+
+    Returns:
+        str: The hex digest of the extraction code.
+    """
+    digest = hashlib.sha256()
+    for module in (util, static_types, type_grammar, context):
+        with open(module.__file__, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+class ResponseCache:
+    """On-disk cache of the LLM answers, keyed by a hash of the model and the messages sent.
+
+    A hit doesn't write to the database: the access times of the hits are kept in memory, and written with
+    the next eviction, every `evict_every` hits, or when the cache is closed.
+
+    Args:
+        path (str, optional): The SQLite file of the cache. Defaults to "cache/llm_responses.sqlite".
+        ttl (float | None, optional): The number of seconds an answer stays valid, None to keep answers forever. Defaults to 30 days.
+        max_entries (int | None, optional): The number of answers kept, the least recently used are evicted first. None for no limit. Defaults to 100 000.
+        bypass (bool, optional): If True, cached answers are never read, the new answers are still stored. Defaults to False.
+        evict_every (int, optional): The number of stored answers between two evictions, and of hits between two writes of their access times. Defaults to 100.
+    """
+
+    def __init__(
+        self,
+        path: str = "cache/llm_responses.sqlite",
+        ttl: float | None = 30 * 24 * 3600,
+        max_entries: int | None = 100_000,
+        bypass: bool = False,
+        evict_every: int = 100,
+    ):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.bypass = bypass
+        self.evict_every = evict_every
+        self.writes = 0
+        self.hits = 0
+        self.misses = 0
+        # the access time of the hits not yet written, by key
+        self.accessed: dict[str, float] = {}
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                answer TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )"""
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed_at)"
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS responses_created ON responses (created_at)"
+        )
+        self.conn.commit()
+
+    @staticmethod
+    def key(
+        model: str, system: list[str], user_query: str, error: str | None = None
+    ) -> str:
+        """Hashes a query to the LLM.
+
+        Args:
+            model (str): The model queried.
+            system (list[str]): The system queries.
+            user_query (str): The user query.
+            error (str | None, optional): The error of the previous attempt. Defaults to None.
+
+        Returns:
+            str: The hex digest identifying the query.
+        """
+        payload = json.dumps([model, system, user_query, error], ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> str | None:
+        """Gets the cached answer of a query.
+
+        Args:
+            key (str): The key of the query, see `ResponseCache.key`.
+
+        Returns:
+            (str | None): The cached answer, or None if it is missing, expired, or the cache is bypassed.
+        """
+        if self.bypass:
+            return None
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT answer, created_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            answer, created_at = row
+            if self.ttl is not None and now - created_at > self.ttl:
+                self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.conn.commit()
+                self.misses += 1
+                return None
+            self.accessed[key] = now
+            if len(self.accessed) >= self.evict_every:
+                self.flush_accessed()
+                self.conn.commit()
+            self.hits += 1
+            return answer
+
+    def flush_accessed(self):
+        """Writes the access times of the last hits, in the current transaction. Called with the lock held."""
+        if self.accessed:
+            self.conn.executemany(
+                "UPDATE responses SET accessed_at = ? WHERE key = ?",
+                [(accessed_at, key) for key, accessed_at in self.accessed.items()],
+            )
+            self.accessed.clear()
+
+    def set(self, key: str, answer: str):
+        """Stores the answer of a query, evicting the expired and least recently used answers.
+
+        Args:
+            key (str): The key of the query, see `ResponseCache.key`.
+            answer (str): The answer of the LLM.
+        """
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses (key, answer, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, answer, now, now),
+            )
+            self.writes += 1
+            if self.writes % self.evict_every == 0:
+                self.evict(now)
+            self.conn.commit()
+
+    def evict(self, now: float):
+        """Deletes the expired answers, then the least recently used ones above `max_entries`. Called with the lock held.
+
+        Args:
+            now (float): The current time.
+        """
+        self.flush_accessed()
+        if self.ttl is not None:
+            self.conn.execute(
+                "DELETE FROM responses WHERE created_at < ?", (now - self.ttl,)
+            )
+        if self.max_entries is not None:
+            (count,) = self.conn.execute("SELECT COUNT(*) FROM responses").fetchone()
+            excess = count - self.max_entries
+            if excess > 0:
+                self.conn.execute(
+                    "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY accessed_at LIMIT ?)",
+                    (excess,),
+                )
+
+    def clear(self):
+        """Deletes every cached answer."""
+        with self.lock:
+            self.accessed.clear()
+            self.conn.execute("DELETE FROM responses")
+            self.conn.commit()
+
+    def close(self):
+        """Writes the access times of the last hits, and closes the cache's database."""
+        with self.lock:
+            self.flush_accessed()
+            self.conn.commit()
+            self.conn.close()
+
+
+class ResultStore:
+    """On-disk store of the function definitions, keyed by the model and the normalized AST of the function.
+
+    Shared by every file and run, a function already defined with the same model, in any file, reuses its definition.
+
+    Args:
+        path (str, optional): The SQLite file of the store. Defaults to "cache/function_results.sqlite".
+        ttl (float | None, optional): The number of seconds a definition stays valid, None to keep definitions forever. Defaults to 30 days.
+        bypass (bool, optional): If True, stored definitions are never read, the new definitions are still stored. Defaults to False.
+    """
+
+    def __init__(
+        self,
+        path: str = "cache/function_results.sqlite",
+        ttl: float | None = 30 * 24 * 3600,
+        bypass: bool = False,
+    ):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.ttl = ttl
+        self.bypass = bypass
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS results (
+                model TEXT NOT NULL,
+                fingerprint TEXT NOT NULL,
+                result TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                PRIMARY KEY (model, fingerprint)
+            )"""
+        )
+        self.conn.commit()
+
+    def get(self, model: str, fingerprint: str) -> dict | None:
+        """Gets the stored definition of a function.
+
+        Args:
+            model (str): The model that defined the function.
+            fingerprint (str): The function's fingerprint, see `ast_fingerprint`.
+
+        Returns:
+            (dict | None): The parameters, return, description, tags, category and its source, or None if missing, expired, or the store is bypassed.
+        """
+        if self.bypass:
+            return None
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT result, created_at FROM results WHERE model = ? AND fingerprint = ?",
+                (model, fingerprint),
+            ).fetchone()
+            if row is None or (self.ttl is not None and time.time() - row[1] > self.ttl):
+                self.misses += 1
+                return None
+            self.hits += 1
+            return json.loads(row[0])
+
+    def set(self, model: str, fingerprint: str, function_info: dict):
+        """Stores the definition of a function.
+
+        Args:
+            model (str): The model that defined the function.
+            fingerprint (str): The function's fingerprint, see `ast_fingerprint`.
+            function_info (dict): The defined function.
+        """
+        result = {
+            key: function_info.get(key)
+            for key in (
+                "parameters",
+                "return",
+                "description",
+                "tags",
+                "category",
+                "category_source",
+                "category_confidence",
+            )
+        }
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO results (model, fingerprint, result, created_at) VALUES (?, ?, ?, ?)",
+                (model, fingerprint, json.dumps(result, ensure_ascii=False), time.time()),
+            )
+            self.conn.commit()
+
+    def close(self):
+        """Closes the store's database."""
+        with self.lock:
+            self.conn.close()
+
+
+class ExtractionCache:
+    """Cache of the extraction of the files: their functions, imports, content and context, see `extract_information`.
+
+    The last extractions are kept in memory, and optionally pickled on disk. An extraction is valid while the file keeps
+    its modification time and size, or else its content hash, and the extraction code is unchanged.
+    Each hit gives a fresh copy, the callers can update the functions in place.
+
+    Args:
+        max_entries (int, optional): The number of extractions kept in memory, the least recently used are evicted first. Defaults to 128.
+        path (str | None, optional): The directory of the pickled extractions, None to keep them in memory only. Defaults to None.
+    """
+
+    def __init__(self, max_entries: int = 128, path: str | None = None):
+        if path:
+            os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.max_entries = max_entries
+        self.version = extractor_version()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def entry_path(self, filepath: str) -> str:
+        """Gives the pickle file of a file's extraction.
+
+        Args:
+            filepath (str): The path of the extracted file.
+
+        Returns:
+            str: The path of the pickle.
+        """
+        name = hashlib.sha256(os.path.abspath(filepath).encode("utf-8")).hexdigest()
+        return os.path.join(self.path, f"{name}.pickle")
+
+    def lookup(self, key: str) -> dict | None:
+        """Gets the entry of a file, from memory or else from disk.
+
+        Args:
+            key (str): The absolute path of the file.
+
+        Returns:
+            (dict | None): The entry, with the file's stat, content hash and pickled extraction. None if it is missing.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                return entry
+        if not self.path:
+            return None
+        try:
+            with open(self.entry_path(key), "rb") as f:
+                entry = pickle.load(f)
+        except (OSError, pickle.PickleError, EOFError, AttributeError):
+            return None
+        if entry.get("version") != self.version:
+            return None
+        return entry
+
+    def store(self, key: str, entry: dict, persist: bool = True):
+        """Keeps the entry of a file in memory, and on disk when `persist`.
+
+        Args:
+            key (str): The absolute path of the file.
+            entry (dict): The entry, see `lookup`.
+            persist (bool, optional): If True, the entry is also written to disk. Defaults to True.
+        """
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        if self.path and persist:
+            tmp = f"{self.entry_path(key)}.{threading.get_ident()}.tmp"
+            try:
+                with open(tmp, "wb") as f:
+                    pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp, self.entry_path(key))
+            except OSError as e:
+                print(f"Error writing extraction cache for {key}: {e}")
+
+    def extract(self, filepath: str) -> tuple[list[dict], set[str], str, FileContext]:
+        """Extracts a file, or reads its cached extraction.
+
+        Args:
+            filepath (str): The path to the Python file.
+
+        Raises:
+            FileNotFoundError: The file doesn't exist.
+
+        Returns:
+            tuple[list[dict], set[str], str, FileContext]: The function dictionaries, the imports, the content and the context of the file.
+        """
+        key = os.path.abspath(filepath)
+        if not os.path.isfile(key):
+            raise FileNotFoundError(f"File not found: {filepath}")
+        stat = os.stat(key)
+        signature = (stat.st_mtime_ns, stat.st_size)
+
+        entry = self.lookup(key)
+        if entry is not None and entry["signature"] == signature:
+            self.hits += 1
+            return pickle.loads(entry["extraction"])
+
+        content = util.read_file(key)
+        content_hash = hashlib.sha256(content.encode("utf-8")).hexdigest()
+        if entry is not None and entry["hash"] == content_hash:
+            # touched but unchanged
+            self.hits += 1
+            self.store(key, {**entry, "signature": signature})
+            return pickle.loads(entry["extraction"])
+
+        self.misses += 1
+        visitor = util.parse_module(content, filepath)
+        extraction = (visitor.functions, set(visitor.imports), content, FileContext(visitor))
+        self.store(
+            key,
+            {
+                "version": self.version,
+                "signature": signature,
+                "hash": content_hash,
+                "extraction": pickle.dumps(extraction, protocol=pickle.HIGHEST_PROTOCOL),
+            },
+        )
+        return extraction
@@ -0,0 +1,423 @@
+import argparse
+import ast
+import json
+import os
+
+from local import FUNCTION_TYPES_LIST
+from util import list_files, parse_source, read_functions_from_json
+
+# modules whose functions reach outside of the program
+IO_MODULES = {
+    "aiohttp",
+    "boto3",
+    "csv",
+    "ftplib",
+    "glob",
+    "http",
+    "httpx",
+    "openpyxl",
+    "pickle",
+    "psycopg2",
+    "pymongo",
+    "requests",
+    "shutil",
+    "smtplib",
+    "socket",
+    "sqlite3",
+    "subprocess",
+    "urllib",
+    "xlrd",
+}
+# called by name, imported from an I/O module
+IO_FUNCTIONS = {
+    "open",
+    "input",
+    "urlopen",
+    "listdir",
+    "scandir",
+    "makedirs",
+    "mkdir",
+    "rmdir",
+    "unlink",
+    "read_csv",
+    "read_excel",
+}
+# methods doing I/O whatever the object
+IO_METHODS = {
+    "urlopen",
+    "listdir",
+    "scandir",
+    "makedirs",
+    "mkdir",
+    "rmdir",
+    "unlink",
+    "readline",
+    "readlines",
+    "writelines",
+    "executemany",
+    "fetchone",
+    "fetchall",
+    "fetchmany",
+    "read_csv",
+    "to_csv",
+    "read_excel",
+    "to_excel",
+    "read_text",
+    "write_text",
+    "read_bytes",
+    "write_bytes",
+    # document databases
+    "insert_one",
+    "insert_many",
+    "find_one",
+    "update_one",
+    "update_many",
+    "replace_one",
+    "delete_one",
+    "delete_many",
+    "bulk_write",
+}
+# methods doing I/O on a file, connection or client, but not on other objects: list.remove, DataFrame.drop
+HANDLE_METHODS = {
+    "open",
+    "read",
+    "write",
+    "remove",
+    "walk",
+    "execute",
+    "commit",
+    "cursor",
+    "connect",
+    "send",
+    "recv",
+    "aggregate",
+    "drop",
+}
+# called on a serialization module: json.load reads a file, json.loads doesn't
+FILE_SERIALIZERS = {"json", "pickle", "yaml", "toml", "marshal"}
+# os functions that only compute paths
+PURE_OS_PATH = {"join", "basename", "dirname", "splitext", "split", "normpath", "relpath", "sep"}
+LOGGING_CALLS = {"print", "debug", "info", "warning", "error", "exception", "critical"}
+NON_DETERMINISTIC = {"random", "time", "datetime", "uuid", "secrets"}
+TEST_CALLS = {"raises", "fail", "skip", "approx"}
+CONSTRUCTORS = {"__init__", "__new__", "__post_init__", "setUp", "setup_method"}
+
+
+def dotted_name(node: ast.expr) -> str:
+    """Gives the dotted name of a called expression, such as "os.path.join" or "self.client.get".
+
+    Args:
+        node (ast.expr): The called expression.
+
+    Returns:
+        str: The dotted name, "" for an expression without a name.
+    """
+    parts = []
+    while isinstance(node, ast.Attribute):
+        parts.append(node.attr)
+        node = node.value
+    if isinstance(node, ast.Name):
+        parts.append(node.id)
+    elif isinstance(node, ast.Call):
+        parts.append(dotted_name(node.func) + "()")
+    else:
+        return ""
+    return ".".join(reversed(parts))
+
+
+def is_io_call(name: str, handles: set[str] = frozenset()) -> bool:
+    """Checks if a call reaches outside of the program: files, network, databases or processes.
+
+    A method of `HANDLE_METHODS` only counts on an I/O module, on a handle, or on the result of an I/O call.
+
+    Args:
+        name (str): The dotted name of the call, see `dotted_name`.
+        handles (set[str], optional): The local names bound to a file, connection or client. Defaults to none.
+
+    Returns:
+        bool: True if the call performs I/O.
+    """
+    parts = name.split(".")
+    root, last = parts[0], parts[-1]
+    if root in IO_MODULES:
+        return True
+    if len(parts) == 1:
+        return last in IO_FUNCTIONS
+    if last in IO_METHODS:
+        return True
+    if last in HANDLE_METHODS and is_handle(root, handles):
+        return True
+    if root in FILE_SERIALIZERS and last in ("load", "dump"):
+        return True
+    if root == "os" and last not in PURE_OS_PATH and last not in ("getenv", "environ"):
+        return True
+    return False
+
+
+def is_handle(root: str, handles: set[str]) -> bool:
+    """Checks if the receiver of a method is a file, connection or client: a handle, or the result of an I/O call.
+
+    Args:
+        root (str): The first part of the dotted name of the call, such as "conn" or "open()".
+        handles (set[str]): The local names bound to a file, connection or client.
+
+    Returns:
+        bool: True if the receiver does I/O.
+    """
+    if root.endswith("()"):
+        return is_io_call(root[:-2], handles)
+    return root in handles
+
+
+def io_handles(node: ast.AST) -> set[str]:
+    """Lists the local names bound to the result of an I/O call, such as `f` in `with open(path) as f`.
+
+    The bindings are followed until none is added, `cur = conn.cursor()` being a handle once `conn` is one.
+
+    Args:
+        node (ast.AST): The function.
+
+    Returns:
+        set[str]: The names of the files, connections and clients of the function.
+    """
+    bindings = []
+    for child in ast.walk(node):
+        if isinstance(child, ast.Assign) and isinstance(child.value, ast.Call):
+            names = {t.id for t in child.targets if isinstance(t, ast.Name)}
+            bindings.append((names, dotted_name(child.value.func)))
+        elif (
+            isinstance(child, ast.withitem)
+            and isinstance(child.context_expr, ast.Call)
+            and isinstance(child.optional_vars, ast.Name)
+        ):
+            bindings.append(({child.optional_vars.id}, dotted_name(child.context_expr.func)))
+
+    handles = set()
+    changed = True
+    while changed:
+        changed = False
+        for names, call in bindings:
+            if call and not names <= handles and is_io_call(call, handles):
+                handles |= names
+                changed = True
+    return handles
+
+
+def features(function_info: dict) -> dict | None:
+    """Reads the syntactic features of a function used by `classify`.
+
+    Args:
+        function_info (dict): The dictionnary containing the function's information, see `extract_information`.
+
+    Returns:
+        dict | None: The features of the function, or None if its source can't be parsed.
+    """
+    node = parse_source(function_info["source"] or "")
+    if node is None:
+        return None
+
+    body = []
+    if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+        body = node.body
+        if ast.get_docstring(node) is not None:
+            body = body[1:]
+    decorators = [d.split("(")[0] for d in function_info.get("decorators", [])]
+
+    parameters = [name for name, _ in function_info["parameters"]]
+    receiver = parameters[0] if parameters and parameters[0] in ("self", "cls") else None
+
+    calls = []
+    asserts = 0
+    uses_receiver = False
+    global_state = False
+    for child in ast.walk(node):
+        if isinstance(child, ast.Call):
+            calls.append(dotted_name(child.func))
+        elif isinstance(child, ast.Assert):
+            asserts += 1
+        elif isinstance(child, (ast.Global, ast.Nonlocal)):
+            global_state = True
+        elif isinstance(child, ast.Name) and receiver and child.id == receiver:
+            uses_receiver = True
+
+    handles = io_handles(node)
+    io_calls = [c for c in calls if is_io_call(c, handles)]
+    return {
+        "name": function_info["name"],
+        "decorators": decorators,
+        "statements": len(body),
+        "receiver": receiver,
+        "uses_receiver": uses_receiver,
+        "asserts": asserts,
+        "calls": calls,
+        "io_calls": io_calls,
+        # a method of `HANDLE_METHODS` on an object not known to do I/O
+        "maybe_io_calls": [
+            c for c in calls if c not in io_calls and "." in c and c.split(".")[-1] in HANDLE_METHODS
+        ],
+        "logging": any(c.split(".")[-1] in LOGGING_CALLS for c in calls),
+        "non_deterministic": any(c.split(".")[0] in NON_DETERMINISTIC for c in calls),
+        "test_calls": any(
+            c.split(".")[-1] in TEST_CALLS or c.split(".")[-1].startswith("assert")
+            for c in calls
+        ),
+        "global_state": global_state,
+    }
+
+
+def classify(function_info: dict) -> tuple[str | None, float]:
+    """Classifies a function into a category of `FUNCTION_TYPES_GUIDE` from syntactic rules.
+
+    The rules follow the guide's criteria: the name and assertions of tests, the `__init__` of constructors,
+    the decorators or short attribute access of properties, and the I/O calls of external interactions.
+    A method that only does I/O on some objects, such as `remove` or `execute`, stays below the default threshold
+    unless its receiver is a file or connection, see `is_io_call`.
+    A function matching none of them, without I/O, logging nor state, is a pure utility.
+
+    Args:
+        function_info (dict): The dictionnary containing the function's information, see `extract_information`.
+
+    Returns:
+        tuple[str | None, float]: The category, and the confidence of the rules between 0 and 1. None if the source can't be read.
+    """
+    f = features(function_info)
+    if f is None:
+        return None, 0.0
+
+    name = f["name"]
+    is_test_name = name.startswith("test_") or name.endswith("_test")
+    if is_test_name and (f["asserts"] or f["test_calls"]):
+        return "TestFunction", 0.99
+    if is_test_name:
+        # `test_connection()` may well be a helper opening a socket: the name alone leaves it to the LLM
+        return "TestFunction", 0.6
+    if f["asserts"] >= 2 and not f["io_calls"]:
+        return "TestFunction", 0.6
+
+    if f["receiver"] and name in CONSTRUCTORS:
+        return "Constructor", 0.95 if not f["io_calls"] else 0.85
+
+    if any(d == "property" or d.endswith((".setter", ".getter", ".deleter")) for d in f["decorators"]):
+        return "Property", 0.95
+    if (
+        f["receiver"]
+        and f["uses_receiver"]
+        and f["statements"] <= 2
+        and not f["calls"]
+        and name.startswith(("get_", "set_", "is_", "has_"))
+    ):
+        return "Property", 0.85
+    if f["receiver"] and f["uses_receiver"] and f["statements"] <= 2 and not f["calls"]:
+        return "Property", 0.6
+
+    io = len(f["io_calls"])
+    if io >= 2:
+        return "ExternalInteraction", 0.9
+    if io == 1:
+        return "ExternalInteraction", 0.8
+    if f["maybe_io_calls"]:
+        # `items.remove(x)` or `self.conn.execute(q)`: too ambiguous to skip the LLM
+        return "ExternalInteraction", 0.5
+
+    if f["receiver"] and f["uses_receiver"]:
+        # business logic on the object state, no category fits it well
+        return "PureUtility", 0.3
+    if f["logging"] or f["non_deterministic"] or f["global_state"]:
+        return "PureUtility", 0.4
+    return "PureUtility", 0.75
+
+
+def agreement_report(functions: list[dict], threshold: float = 0.85) -> dict:
+    """Compares the categories given by the LLM to the ones of `classify`.
+
+    Only the categories labelled by the LLM are compared, see `GentlemanLLM.apply_category`: the categories
+    given by the rules, and the outputs older than the category sources, are left out. To measure the rules
+    at every confidence, the outputs have to be made with the rules disabled (a category threshold above 1).
+
+    Args:
+        functions (list[dict]): The defined functions, from the outputs of the analysis.
+        threshold (float, optional): The confidence above which the rules replace the LLM. Defaults to 0.85.
+
+    Returns:
+        dict: The number of functions left out, the agreement rate overall, above the threshold, by LLM category and by confidence, and the disagreements.
+    """
+
+    def rate(pairs: list[tuple[str, str]]) -> dict:
+        agreed = sum(1 for llm, rules in pairs if llm == rules)
+        return {
+            "functions": len(pairs),
+            "agreement": round(agreed / len(pairs), 3) if pairs else None,
+        }
+
+    pairs = []
+    confident = []
+    by_category = {c: [] for c in FUNCTION_TYPES_LIST}
+    by_confidence = {}
+    disagreements = []
+    skipped = 0
+    for f in functions:
+        if f.get("category") not in FUNCTION_TYPES_LIST or "source" not in f:
+            continue
+        if f.get("category_source") != "llm":
+            skipped += 1
+            continue
+        category, confidence = classify(f)
+        pair = (f["category"], category)
+        pairs.append(pair)
+        by_category[f["category"]].append(pair)
+        by_confidence.setdefault(f"{confidence:.2f}", []).append(pair)
+        if confidence >= threshold:
+            confident.append(pair)
+        if category != f["category"]:
+            disagreements.append(
+                {
+                    "function": f.get("qualname", f["name"]),
+                    "llm": f["category"],
+                    "rules": category,
+                    "confidence": confidence,
+                }
+            )
+
+    return {
+        "not_from_llm": skipped,
+        "overall": rate(pairs),
+        "above_threshold": {
+            "threshold": threshold,
+            "coverage": round(len(confident) / len(pairs), 3) if pairs else None,
+            **rate(confident),
+        },
+        "by_category": {c: rate(p) for c, p in by_category.items() if p},
+        "by_confidence": {c: rate(p) for c, p in sorted(by_confidence.items())},
+        "disagreements": disagreements,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Reports the agreement of the rule-based categories with the LLM's, over analysis outputs. "
+        "Only the categories labelled by the LLM are compared: the outputs have to be made with the rules disabled, "
+        "such as `batch.py --category-threshold 2`, or the confident functions are missing from the report."
+    )
+    parser.add_argument("outputs", nargs="+", help="JSON outputs, or directories of JSON outputs.")
+    parser.add_argument("--threshold", type=float, default=0.85, help="Confidence above which the rules replace the LLM.")
+    parser.add_argument("--details", action="store_true", help="Lists the disagreements.")
+    args = parser.parse_args()
+
+    functions = []
+    for target in args.outputs:
+        paths = [target]
+        if os.path.isdir(target):
+            paths = [os.path.join(target, f) for f in list_files(target) if f.endswith(".json")]
+        for path in paths:
+            output = read_functions_from_json(path)
+            if isinstance(output, list):
+                functions.extend(f for f in output if isinstance(f, dict))
+
+    report = agreement_report(functions, args.threshold)
+    if not args.details:
+        report.pop("disagreements")
+    print(json.dumps(report, indent=4, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+import threading
+
+from openai import (
+    DEFAULT_CONNECTION_LIMITS,
+    AsyncOpenAI,
+    DefaultAsyncHttpxClient,
+    DefaultHttpxClient,
+    OpenAI,
+)
+
+BASE_URL = "https://router.huggingface.co/v1"
+
+
+class ClientRegistry:
+    """Process-wide LLM clients, shared by the services instead of opening a connection pool per service.
+
+    There is one client per base URL and token, and per kind: synchronous or asynchronous. The model is chosen
+    by each query, so the clients of every model share the same keep-alive connections and TLS sessions.
+    The asynchronous clients belong to the event loop that first uses them, the server's.
+    The pool limits are built with the HTTP library openai is installed with, it isn't imported directly.
+    HTTP/2 needs the `h2` package: `pip install h2`.
+
+    Args:
+        http2 (bool, optional): If True, the connections use HTTP/2 when the server accepts it. Defaults to False.
+        max_connections (int, optional): The connections open at once, per client. Defaults to 100.
+        max_keepalive_connections (int, optional): The idle connections kept open, per client. Defaults to 20.
+        keepalive_expiry (float, optional): The seconds an idle connection is kept open. Defaults to 60.
+    """
+
+    def __init__(
+        self,
+        http2: bool = False,
+        max_connections: int = 100,
+        max_keepalive_connections: int = 20,
+        keepalive_expiry: float = 60,
+    ):
+        self.http2 = http2
+        # the `Limits` class of the HTTP library openai is built on
+        self.limits = type(DEFAULT_CONNECTION_LIMITS)(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.clients: dict[tuple[str, str, bool], OpenAI | AsyncOpenAI] = {}
+        self.lock = threading.Lock()
+
+    def get(self, hf_token: str, base_url: str = BASE_URL) -> OpenAI:
+        """Gives the synchronous client of a token, created on first use.
+
+        Args:
+            hf_token (str): The Hugging Face token.
+            base_url (str, optional): The URL of the API. Defaults to the Hugging Face router.
+
+        Returns:
+            OpenAI: The shared client.
+        """
+        with self.lock:
+            key = (base_url, hf_token, False)
+            if key not in self.clients:
+                self.clients[key] = OpenAI(
+                    base_url=base_url,
+                    api_key=hf_token,
+                    max_retries=0,  # rate limits and provider errors are retried by `define`
+                    http_client=DefaultHttpxClient(http2=self.http2, limits=self.limits),
+                )
+            return self.clients[key]
+
+    def get_async(self, hf_token: str, base_url: str = BASE_URL) -> AsyncOpenAI:
+        """Gives the asynchronous client of a token, created on first use.
+
+        Args:
+            hf_token (str): The Hugging Face token.
+            base_url (str, optional): The URL of the API. Defaults to the Hugging Face router.
+
+        Returns:
+            AsyncOpenAI: The shared client.
+        """
+        with self.lock:
+            key = (base_url, hf_token, True)
+            if key not in self.clients:
+                self.clients[key] = AsyncOpenAI(
+                    base_url=base_url,
+                    api_key=hf_token,
+                    max_retries=0,  # rate limits and provider errors are retried by `define`
+                    http_client=DefaultAsyncHttpxClient(http2=self.http2, limits=self.limits),
+                )
+            return self.clients[key]
+
+    def take(self, kind: type) -> list:
+        """Removes the clients of a kind from the registry."""
+        with self.lock:
+            taken = {key: c for key, c in self.clients.items() if isinstance(c, kind)}
+            for key in taken:
+                del self.clients[key]
+        return list(taken.values())
+
+    def close(self):
+        """Closes the connections of the synchronous clients, new clients are created on the next use."""
+        for client in self.take(OpenAI):
+            client.close()
+
+    async def aclose(self):
+        """Closes the connections of every client, new clients are created on the next use."""
+        self.close()
+        for client in self.take(AsyncOpenAI):
+            await client.close()
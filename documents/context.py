@@ -0,0 +1,109 @@
+from util import ModuleVisitor
+
+
+def estimate_text_tokens(text: str) -> int:
+    """Estimates the number of tokens of a text, about 4 characters per token.
+
+    Args:
+        text (str): The text.
+
+    Returns:
+        int: The estimated number of tokens.
+    """
+    return len(text) // 4
+
+
+class FileContext:
+    """Builds the file context sent with a function to the LLM, bounded by a token budget.
+
+    A file fitting in the budget is sent whole. Otherwise the context gathers, in order and while the budget allows it:
+    the module docstring, the imports, the headers of the enclosing classes, then the functions called by,
+    and calling, the function (their source, or only their signature and docstring when the source doesn't fit).
+
+    Args:
+        visitor (ModuleVisitor): The visitor of the file, with its functions completed, see `parse_module`.
+    """
+
+    def __init__(self, visitor: ModuleVisitor):
+        self.content = visitor.content
+        self.functions = {f["qualname"]: f for f in visitor.functions}
+        self.docstring = visitor.docstring
+        self.imports = list(visitor.import_sources)
+        self.classes = sorted(visitor.class_headers)
+        self.signatures = dict(visitor.headers)
+        # the links leaving the file, see `ProjectIndex.add_context`
+        self.import_targets = dict(visitor.import_targets)
+        self.unresolved = dict(visitor.unresolved)
+
+    def neighbours(self, functions: list[dict]) -> list[str]:
+        """Lists the functions called by, then calling, the given functions.
+
+        Args:
+            functions (list[dict]): The function dictionnaries.
+
+        Returns:
+            list[str]: The qualified names of the neighbours, without duplicates nor the given functions.
+        """
+        own = {f["qualname"] for f in functions}
+        names = []
+        for key in ("calls", "called_by"):
+            for f in functions:
+                for name in f.get(key, []):
+                    if name not in own and name not in names:
+                        names.append(name)
+        return names
+
+    def for_functions(self, functions: list[dict], budget: int | None) -> str:
+        """Builds the context of one or several functions of the file.
+
+        Args:
+            functions (list[dict]): The function dictionnaries.
+            budget (int | None): The maximum number of tokens of the context, None for the whole file.
+
+        Returns:
+            str: The context, the whole file if it fits in the budget.
+        """
+        if budget is None or estimate_text_tokens(self.content) <= budget:
+            return self.content
+
+        sections = []
+        remaining = budget
+
+        def add(text: str) -> bool:
+            nonlocal remaining
+            cost = estimate_text_tokens(text) + 1
+            if not text or cost > remaining:
+                return False
+            sections.append(text)
+            remaining -= cost
+            return True
+
+        if self.docstring:
+            add(f'"""{self.docstring}"""')
+        if self.imports:
+            add("\n".join(self.imports))
+
+        for start, end, header in self.classes:
+            if any(start <= f["start_line"] <= end for f in functions):
+                add(header)
+
+        for name in self.neighbours(functions):
+            neighbour = self.functions.get(name)
+            if neighbour is not None and add(neighbour["source"]):
+                continue
+            if name in self.signatures:
+                add(self.signatures[name])
+
+        return "\n\n".join(sections)
+
+    def for_function(self, function_info: dict, budget: int | None) -> str:
+        """Builds the context of a function of the file, see `for_functions`.
+
+        Args:
+            function_info (dict): The dictionnary containing the function's information.
+            budget (int | None): The maximum number of tokens of the context, None for the whole file.
+
+        Returns:
+            str: The context, the whole file if it fits in the budget.
+        """
+        return self.for_functions([function_info], budget)
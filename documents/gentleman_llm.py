@@ -1,47 +1,199 @@
+import asyncio
+import json
 import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from time import sleep
-from openai import OpenAI
+from openai import AsyncOpenAI, OpenAI
 from util import (
+    ACCEPTED_TYPES,
     VALID_BASE_TYPES,
-    extract_information,
+    ast_fingerprint,
+    copy_definition,
+    merge_previous,
+    parse_json_answer,
+    parse_module,
+    read_file,
     validate_types,
     validate_tags,
     validate_type,
     in_range,
     valid_category,
 )
+from cache import ExtractionCache, ResponseCache, ResultStore
+from classifier import classify
+from clients import BASE_URL, ClientRegistry
+from repair import (
+    RepairStats,
+    category_candidates,
+    description_candidates,
+    repairing,
+    tags_candidates,
+    type_candidates,
+)
+from context import FileContext
+from rate_limit import (
+    RateLimiter,
+    backoff_delay,
+    estimate_tokens,
+    is_rate_limit_error,
+    is_transient_error,
+    retry_after,
+)
+from scheduler import Stage, run_stages, run_stages_async
 from local import (
     FUNCTION_TYPES_LIST,
     FUNCTION_TYPES_GUIDE,
 )
 
 
+def used_tokens(resp) -> int | None:
+    """Reads the number of tokens used by a chat completion.
+
+    Args:
+        resp (ChatCompletion): The response of the LLM.
+
+    Returns:
+        int | None: The total number of tokens, or None if the provider didn't give it.
+    """
+    usage = getattr(resp, "usage", None)
+    return getattr(usage, "total_tokens", None)
+
+
+# "pipeline": one query per step and function, "batched": one query per step for `batch_size` functions,
+# "one-shot": one query for every step of a function
+STRATEGIES = ("pipeline", "batched", "one-shot")
+
+
+class FilePlan:
+    """The functions of a file, and the ones the LLM has to define, see `GentlemanLLM.plan_file`.
+
+    Args:
+        filepath (str): The file containing the code.
+        functions (list[dict]): The functions of the file, in order, the output of the analysis.
+        imports (set[str]): The set containing all of the imports of the file.
+        file_context (FileContext): The file, sent within `context_budget` tokens.
+        to_define (list[dict]): The functions to define, a single one per fingerprint.
+        groups (dict[str, list[dict]]): The functions to define grouped by fingerprint, see `GentlemanLLM.reuse_definitions`.
+    """
+
+    def __init__(
+        self,
+        filepath: str,
+        functions: list[dict],
+        imports: set[str],
+        file_context: FileContext,
+        to_define: list[dict],
+        groups: dict[str, list[dict]],
+    ):
+        self.filepath = filepath
+        self.functions = functions
+        self.imports = imports
+        self.file_context = file_context
+        self.to_define = to_define
+        self.groups = groups
+        self.fingerprints = {id(group[0]): fingerprint for fingerprint, group in groups.items()}
+
+    def header(self) -> dict:
+        """Gives the first record of the output, naming the file."""
+        return {"file": os.path.basename(self.filepath)}
+
+    def reused(self) -> list[dict]:
+        """Lists the functions already defined: copied from a previous output or from the result store."""
+        pending = {id(f) for f in self.to_define}
+        for group in self.groups.values():
+            pending.update(id(f) for f in group)
+        return [f for f in self.functions if id(f) not in pending]
+
+    def group_of(self, function_info: dict) -> tuple[str | None, list[dict]]:
+        """Gives the fingerprint of a function to define and its identical functions, itself first.
+
+        Args:
+            function_info (dict): A function of `to_define`.
+
+        Returns:
+            tuple[str | None, list[dict]]: The fingerprint, None if the function has none, and the identical functions.
+        """
+        fingerprint = self.fingerprints.get(id(function_info))
+        if fingerprint is None:
+            return None, [function_info]
+        return fingerprint, self.groups[fingerprint]
+
+    def output(self) -> list[dict]:
+        """Gives the output of the analysis: the header, then every function of the file."""
+        return [self.header()] + self.functions
+
+
 class GentlemanLLM:
-    def __init__(self, hf_token: str, model: str):
+    def __init__(
+        self,
+        hf_token: str,
+        model: str,
+        max_workers: int = 4,
+        cache: ResponseCache | None = None,
+        max_in_flight: int | None = None,
+        rate_limiter: RateLimiter | None = None,
+        strategy: str = "pipeline",
+        batch_size: int = 5,
+        context_budget: int | None = 1500,
+        category_threshold: float | None = 0.85,
+        result_store: ResultStore | None = None,
+        extraction_cache: ExtractionCache | None = None,
+        clients: ClientRegistry | None = None,
+    ):
+        if strategy not in STRATEGIES:
+            raise ValueError(f"Unknown strategy {strategy}, expected one of {STRATEGIES}.")
+        self.strategy = strategy
+        self.batch_size = batch_size
+        self.context_budget = context_budget
+        self.category_threshold = category_threshold
+        self.repair_stats = RepairStats()
         self.model = model
-        self.client = OpenAI(
-            base_url="https://router.huggingface.co/v1",
-            api_key=hf_token,
-        )
-        self.ex_retries = 0
+        self.max_workers = max_workers
+        self.cache = cache
+        self.result_store = result_store
+        self.extraction_cache = extraction_cache
+        if rate_limiter is None and max_in_flight:
+            rate_limiter = RateLimiter(max_concurrency=max_in_flight)
+        self.rate_limiter = rate_limiter
+        self.clients = clients
+        self.client = self.create_client(hf_token)
         self.max_retry = 10
         self.max_ex_retry = 5
 
-    def ask(
+    def create_client(self, hf_token: str) -> OpenAI:
+        """Creates the client used to query the LLM, or takes the shared one of `clients`.
+
+        Args:
+            hf_token (str): The Hugging Face token.
+
+        Returns:
+            OpenAI: The client for the Hugging Face router.
+        """
+        if self.clients is not None:
+            return self.clients.get(hf_token)
+        return OpenAI(
+            base_url=BASE_URL,
+            api_key=hf_token,
+            max_retries=0,  # rate limits and provider errors are retried by `define`
+        )
+
+    def close(self):
+        """Closes the client's connections, unless the client is shared."""
+        if self.clients is None:
+            self.client.close()
+
+    def messages(
         self, user_query: str, system: list[str], error: str | None = None
-    ) -> str | RuntimeError:
-        """Queries the llm with the user query, and system query. Optionally error if the last the last query with the LLM was unsuccessful.
+    ) -> list[dict]:
+        """Builds the chat messages sent to the LLM.
 
         Args:
-            user_query (str): a list of user queries
+            user_query (str): The user query.
             system (list[str]): a list of system queries
             error (str | None, optional): The last error if the previous query was unsuccesful. Defaults to None.
 
-        Raises:
-            RuntimeError: The LLM did not return anything.
-
         Returns:
-            (str|RuntimeError): The answer of the model.
+            list[dict]: The messages of the chat completion.
         """
         messages = [{"role": "system", "content": s_query} for s_query in system]
         if error:
@@ -49,75 +201,220 @@ class GentlemanLLM:
                 {"role": "system", "content": f"Previous attempt failed:\n{error}"}
             )
         messages.append({"role": "user", "content": user_query})
+        return messages
+
+    def cached_answer(
+        self, user_query: str, system: list[str], error: str | None = None
+    ) -> tuple[str | None, str | None]:
+        """Reads the answer of a query from `cache`.
+
+        Args:
+            user_query (str): The user query.
+            system (list[str]): a list of system queries
+            error (str | None, optional): The last error if the previous query was unsuccesful. Defaults to None.
+
+        Returns:
+            tuple[str | None, str | None]: The key of the query, None without `cache`, and its cached answer, None if it isn't cached.
+        """
+        if self.cache is None:
+            return None, None
+        key = self.cache.key(self.model, system, user_query, error)
+        return key, self.cache.get(key)
+
+    def store_answer(self, key: str | None, answer: str):
+        """Stores the answer of a query in `cache`, see `cached_answer`."""
+        if key is not None:
+            self.cache.set(key, answer)
+
+    def release(self, tokens: int, resp=None, error: Exception | None = None):
+        """Frees the slot of a finished query in `rate_limiter`, see `RateLimiter.release`.
+
+        Args:
+            tokens (int): The estimated number of tokens of the query.
+            resp (ChatCompletion, optional): The response of the LLM, if the query succeeded. Defaults to None.
+            error (Exception | None, optional): The exception of the query, if it failed. Defaults to None.
+        """
+        if self.rate_limiter is not None:
+            used = used_tokens(resp) if resp is not None else None
+            self.rate_limiter.release(tokens, used, error=error)
+
+    @staticmethod
+    def read_answer(resp) -> str:
+        """Reads the answer of a chat completion.
+
+        Args:
+            resp (ChatCompletion): The response of the LLM.
+
+        Raises:
+            RuntimeError: The LLM did not return anything.
 
-        resp = self.client.chat.completions.create(model=self.model, messages=messages)
+        Returns:
+            str: The answer of the model.
+        """
         answer = resp.choices[0].message.content
         if not answer:
             raise RuntimeError("Model returned no output.")
         return answer
 
-    # Define functions
-    def define_param_types(
+    def ask(
+        self, user_query: str, system: list[str], error: str | None = None
+    ) -> str | RuntimeError:
+        """Queries the llm with the user query, and system query. Optionally error if the last the last query with the LLM was unsuccessful.
+
+        The answer is read from, and stored in, `cache` when one is given. The query waits for `rate_limiter` when one is given.
+
+        Args:
+            user_query (str): a list of user queries
+            system (list[str]): a list of system queries
+            error (str | None, optional): The last error if the previous query was unsuccesful. Defaults to None.
+
+        Raises:
+            RuntimeError: The LLM did not return anything.
+
+        Returns:
+            (str|RuntimeError): The answer of the model.
+        """
+        key, cached = self.cached_answer(user_query, system, error)
+        if cached is not None:
+            return cached
+
+        messages = self.messages(user_query, system, error)
+        tokens = estimate_tokens(messages)
+
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire(tokens)
+        try:
+            resp = self.client.chat.completions.create(
+                model=self.model, messages=messages
+            )
+        except Exception as e:
+            self.release(tokens, error=e)
+            raise
+        self.release(tokens, resp)
+
+        answer = self.read_answer(resp)
+        self.store_answer(key, answer)
+        return answer
+
+    def define(
+        self, funcname: str, name: str, query: str, system: list[str], check
+    ) -> object | RuntimeError:
+        """Queries the LLM until its answer passes `check`, sending back the last error on each new try.
+
+        The checks of the requests first try to repair the answer locally, see `repairing`. The answers still failing are counted as retried in `repair_stats`.
+        Rate limits and failures of the provider are retried after a delay, see `failed`.
+
+        Args:
+            funcname (str): The name of the function being defined.
+            name (str): The name of the current step in the function definition.
+            query (str): The user query.
+            system (list[str]): A list of system queries.
+            check (Callable[[str], object]): Validates the answer and returns the defined value, raises an exception if the answer isn't valid.
+
+        Raises:
+            RuntimeError: if the number of tries exceed `max_retry`, or the number of rate limited or failed queries exceed `max_ex_retry`.
+
+        Returns:
+            (object | RuntimeError): The value returned by `check`.
+        """
+        attempts = {"error": None, "tries": 0, "rate_limited": 0, "unavailable": 0}
+        while True:
+            try:
+                answer = self.ask(query, system, attempts["error"])
+                return check(answer)
+            except Exception as e:
+                delay = self.failed(funcname, name, attempts, e)
+            if delay:
+                sleep(delay)
+
+    def failed(self, funcname: str, name: str, attempts: dict, e: Exception) -> float:
+        """Handles a failed query of `define`, giving the delay before the next try.
+
+        Rate limits, and failures of the provider or of the connection, are retried after a delay, the error isn't sent to the LLM.
+        The other errors, such as an invalid answer, are sent back to the LLM on the next try, see `exception_handler`.
+
+        Args:
+            funcname (str): The name of the function being defined.
+            name (str): The name of the current step in the function definition.
+            attempts (dict): The error to send back, and the number of each kind of failure, updated in place.
+            e (Exception): The exception of the query.
+
+        Raises:
+            RuntimeError: if the number of tries exceed `max_retry`, or the number of rate limited or failed queries exceed `max_ex_retry`.
+
+        Returns:
+            float: The delay in seconds, 0 to retry at once.
+        """
+        if is_rate_limit_error(e):
+            attempts["rate_limited"] += 1
+            return self.rate_limit_delay(funcname, attempts["rate_limited"], e)
+        if is_transient_error(e):
+            attempts["unavailable"] += 1
+            return self.unavailable_delay(funcname, attempts["unavailable"], e)
+        self.repair_stats.record("retried")
+        attempts["error"], attempts["tries"] = self.exception_handler(
+            funcname, name, attempts["tries"], e
+        )
+        return 0.0
+
+    # Define requests
+    def param_types_request(
         self, function_info: dict, imports: set[str]
-    ) -> list[str] | Exception:
-        """Defines the types of each parameters of a function.
+    ) -> tuple[str, list[str], object]:
+        """Builds the query, system queries and answer check defining the types of each parameters of a function.
 
         Args:
             function_info (dict): The dictionnary containing the function's information.
             imports (set[str]): The set containing all of the imports of the function's file, used to match types with LLM answer.
 
         Returns:
-            (list[str] | Exception): A list of the types of each parameters. Or an exception if the LLM's answer is not valid.
+            (tuple[str, list[str], Callable[[str], list[str]]]): The query, the system queries, and the check of the answer.
         """
         system = [
             "You are a code analysis assistant.",
             "You will be given a Python function source and a list of its parameters.",
             "Define each parameter's type.",
-            f"Parameters types accepted: {VALID_BASE_TYPES}",
+            f"Parameters types accepted: {ACCEPTED_TYPES}",
             "Respond ONLY with a Python list of types.",
         ]
 
-        p_names = [name for name, _ in function_info["parameters"]]
+        p_names = self.unresolved_parameters(function_info)
         code = function_info["source"]
         query = f"Function:\n{code}\n\nParameters:\n{p_names}"
-
         p_len = len(p_names)
-        last_error = None
-        tries = 0
-        while True:
-            try:
-                answer = self.ask(query, system, error=last_error)
-                types = validate_types(answer, imports)
-
-                len_ans = len(types)
-                if len_ans == p_len:
-                    return types
-                elif len_ans > p_len:
-                    last_error = (
-                        f"Too many types given.\nGiven: {len_ans}, Expected: {p_len}."
-                    )
-                else:
-                    last_error = (
-                        f"Not enough types given.\nGiven: {len_ans}, Expected: {p_len}."
-                    )
-                tries += 1
 
-            except Exception as e:
-                name = "parameter types"
-                last_error, tries = self.exception_handler(function_info["name"], name, tries, e)
+        def check(answer: str) -> list[str]:
+            types = validate_types(answer, imports)
+            len_ans = len(types)
+            if len_ans > p_len:
+                raise ValueError(
+                    f"Too many types given.\nGiven: {len_ans}, Expected: {p_len}."
+                )
+            if len_ans < p_len:
+                raise ValueError(
+                    f"Not enough types given.\nGiven: {len_ans}, Expected: {p_len}."
+                )
+            # the types resolved statically are kept, the answer fills the others in order
+            answers = iter(types)
+            return [t or next(answers) for _, t in function_info["parameters"]]
 
-    def define_tags(
+        valid_types = VALID_BASE_TYPES | imports
+        return query, system, repairing(
+            check, lambda answer: type_candidates(answer, valid_types), self.repair_stats
+        )
+
+    def tags_request(
         self, function_info: dict, content: str, max_tags: int = 5
-    ) -> list[str] | Exception:
-        """Defines `max_tags` tags for the function.
+    ) -> tuple[str, list[str], object]:
+        """Builds the query, system queries and answer check defining `max_tags` tags for the function.
 
         Args:
             function_info (dict): The dictionnary containing the function's information.
-            content (str): The whole content of the function's file.
+            content (str): The content of the function's file, or its context, see `FileContext`.
             max_tags (int, optional): The number of tags to define for the function. Defaults to 5.
 
         Returns:
-            (list[str] | Exception): A list of the tags. Or an exception if the LLM's answer isn't valid.
+            (tuple[str, list[str], Callable[[str], list[str]]]): The query, the system queries, and the check of the answer.
         """
         system = [
             "You are a code analysis assistant.",
@@ -126,31 +423,21 @@ class GentlemanLLM:
             "Respond ONLY with a Python list of tags string.",
         ]
         query = f"File content:\n{content}\nFunction source:\n{function_info['source']}\nDescription of function:\n{function_info['description']}"
-        last_error = None
-        tries = 0
-        while True:
-            try:
-                answer = self.ask(query, system, last_error)
-                tags = validate_tags(answer)
-                tries += 1
-                return tags
-            except Exception as e:
-                name = "tags"
-                last_error, tries = self.exception_handler(function_info["name"], name, tries, e)
+        return query, system, repairing(validate_tags, tags_candidates, self.repair_stats)
 
-    def define_description(
+    def description_request(
         self, function_info: dict, content: str, min_len=50, max_len=200
-    ) -> str | Exception:
-        """Define the description of the function.
+    ) -> tuple[str, list[str], object]:
+        """Builds the query, system queries and answer check defining the description of the function.
 
         Args:
             function_info (dict): The dictionnary containing the function's information.
-            content (str): The whole content of the function's file.
+            content (str): The content of the function's file, or its context, see `FileContext`.
             min_len (int, optional): The minimum length of the description. Defaults to 50.
             max_len (int, optional): The maximum length of the description. Defaults to 200.
 
         Returns:
-            (str | Exception): The description of the function. Or an exception if the LLM's answer isn't valid.
+            (tuple[str, list[str], Callable[[str], str]]): The query, the system queries, and the check of the answer.
         """
         system = [
             "You are a code analysis assistant.",
@@ -161,45 +448,109 @@ class GentlemanLLM:
         source = function_info["source"]
         parameters = function_info["parameters"]
         query = f"File content:\n{content}\nFunction source:\n{source}\nParameters:\n{parameters}"
-        last_error = None
-        tries = 0
 
-        while True:
-            try:
-                answer = self.ask(query, system, last_error)
-
-                len_ans = len(answer)
-                if in_range(len_ans, min_len, max_len):
-                    return answer
-                elif len_ans < min_len:
-                    tries += 1
-                    last_error = f"Description is too short.\nGiven:{len_ans}, Expected at least: {min_len}."
-                else:
-                    tries += 1
-                    last_error = f"Description is too long.\nGiven:{len_ans}, Expected at most: {max_len}."
+        def check(answer: str) -> str:
+            len_ans = len(answer)
+            if len_ans < min_len:
+                raise ValueError(
+                    f"Description is too short.\nGiven:{len_ans}, Expected at least: {min_len}."
+                )
+            if not in_range(len_ans, min_len, max_len):
+                raise ValueError(
+                    f"Description is too long.\nGiven:{len_ans}, Expected at most: {max_len}."
+                )
+            return answer
 
-            except Exception as e:
-                name = "description"
-                last_error, tries = self.exception_handler(function_info["name"], name, tries, e)
+        return query, system, repairing(
+            check, lambda answer: description_candidates(answer, max_len), self.repair_stats
+        )
 
-    def define_return_type(
-        self, function_info: dict, imports: set[str]
-    ) -> str | Exception:
-        """Define the return type of the function.
+    def unresolved_parameters(self, function_info: dict) -> list[str]:
+        """Lists the parameters whose type wasn't resolved statically, see `static_types`.
 
         Args:
             function_info (dict): The dictionnary containing the function's information.
-            imports (set[str]): The set containing all of the imports of the function's file, used to match types with LLM answer.
 
         Returns:
-            (str | Exception): The return type of the function. Or an exception if the LLm's answer isn't valid.
+            list[str]: The names of the parameters the LLM has to type, in order.
+        """
+        return [name for name, t in function_info["parameters"] if not t]
+
+    def known_param_types(self, function_info: dict) -> list[str] | None:
+        """Gives the types of the parameters of the function when they don't need the LLM.
+
+        Args:
+            function_info (dict): The dictionnary containing the function's information.
+
+        Returns:
+            (list[str] | None): The types of each parameter, or None if the LLM has to define some of them.
+        """
+        if self.unresolved_parameters(function_info):
+            return None
+        return [t for _, t in function_info["parameters"]]
+
+    def known_return_type(self, function_info: dict) -> str | None:
+        """Gives the return type of the function when it doesn't need the LLM.
+
+        Args:
+            function_info (dict): The dictionnary containing the function's information.
+
+        Returns:
+            (str | None): The return type, or None if the LLM has to define it.
         """
         r_value, r_type = function_info["return"]
         if r_value == "" and r_type == "":
             return "None"
         if r_type != "any":  # type is already defined
             return r_type
+        return None
+
+    def known_category(self, function_info: dict) -> str | None:
+        """Gives the category of the function when the rule-based classifier is confident enough, see `classify`.
+
+        Args:
+            function_info (dict): The dictionnary containing the function's information.
+
+        Returns:
+            (str | None): The category, or None if the LLM has to define it.
+        """
+        if self.category_threshold is None:
+            return None
+        category, confidence = classify(function_info)
+        if category is None or confidence < self.category_threshold:
+            return None
+        return category
+
+    def apply_category(self, function_info: dict, category: str):
+        """Sets the category of the function, with its source and the confidence of the rules, see `known_category`.
+
+        Args:
+            function_info (dict): The dictionnary containing the function's information, updated in place.
+            category (str): The category, from the rules or the LLM.
+        """
+        rules, confidence = classify(function_info)
+        from_rules = (
+            self.category_threshold is not None
+            and rules is not None
+            and confidence >= self.category_threshold
+        )
+        function_info["category"] = category
+        function_info["category_source"] = "rules" if from_rules else "llm"
+        function_info["category_confidence"] = confidence
+
+    def return_type_request(
+        self, function_info: dict, imports: set[str]
+    ) -> tuple[str, list[str], object]:
+        """Builds the query, system queries and answer check defining the return type of the function.
+
+        Args:
+            function_info (dict): The dictionnary containing the function's information.
+            imports (set[str]): The set containing all of the imports of the function's file, used to match types with LLM answer.
 
+        Returns:
+            (tuple[str, list[str], Callable[[str], str]]): The query, the system queries, and the check of the answer.
+        """
+        r_value, _ = function_info["return"]
         system = [
             "You are a code analysis assistant.",
             "You will be given a Python function source, a list of its parameters and their types, and its return value.",
@@ -211,27 +562,21 @@ class GentlemanLLM:
         query = (
             f"Function source:\n{source}\nParameters:\n{parameters}\nReturn:\n{r_value}"
         )
-        last_error = None
-        tries = 0
-
-        while True:
-            try:
-                answer = self.ask(query, system, last_error)
-                return_type = validate_type(answer, imports)
-                tries += 1
-                return return_type
-            except Exception as e:
-                name = "return type"
-                last_error, tries = self.exception_handler(function_info["name"], name, tries, e)
+        valid_types = VALID_BASE_TYPES | imports
+        return query, system, repairing(
+            lambda answer: validate_type(answer, imports),
+            lambda answer: type_candidates(answer, valid_types),
+            self.repair_stats,
+        )
 
-    def define_category(self, function_info: dict) -> str | Exception:
-        """Define the category of the function.
+    def category_request(self, function_info: dict) -> tuple[str, list[str], object]:
+        """Builds the query, system queries and answer check defining the category of the function.
 
         Args:
             function_info (dict): The dictionnary containing the function's information.
 
         Returns:
-            str | Exception: The category of the function. Or an exception if the LLm's answer isn't valid.
+            (tuple[str, list[str], Callable[[str], str]]): The query, the system queries, and the check of the answer.
         """
         system = [
             "You are a code analysis assistant.",
@@ -264,101 +609,1103 @@ class GentlemanLLM:
         {tags}        
         """
 
-        last_error = None
-        tries = 0
-        while True:
-            try:
-                answer = self.ask(query, system, last_error).strip()
-                tries += 1
+        def check(answer: str) -> str:
+            answer = answer.strip().replace('"', "").replace("'", "")
+            valid_category(answer, FUNCTION_TYPES_LIST)
+            # the category as listed, whatever the case of the answer
+            return next(c for c in FUNCTION_TYPES_LIST if c.lower() == answer.lower())
+
+        return query, system, repairing(
+            check,
+            lambda answer: category_candidates(answer, FUNCTION_TYPES_LIST),
+            self.repair_stats,
+        )
 
-                if valid_category(answer, FUNCTION_TYPES_LIST):
-                    return answer
+    # Define functions
+    def define_param_types(
+        self, function_info: dict, imports: set[str]
+    ) -> list[str] | Exception:
+        """Defines the types of each parameters of a function.
 
-                last_error = f"Category is not a valid function category: {answer}."
+        Args:
+            function_info (dict): The dictionnary containing the function's information.
+            imports (set[str]): The set containing all of the imports of the function's file, used to match types with LLM answer.
 
-            except Exception as e:
-                name = "category"
-                last_error, tries = self.exception_handler(function_info["name"], name, tries, e)
+        Returns:
+            (list[str] | Exception): A list of the types of each parameters. Or an exception if the LLM's answer is not valid.
+        """
+        known = self.known_param_types(function_info)
+        if known is not None:
+            return known
+        query, system, check = self.param_types_request(function_info, imports)
+        return self.define(function_info["qualname"], "parameter types", query, system, check)
 
-    def analyze_file(self, filepath: str) -> list[dict] | RuntimeError:
-        """Defines the all of the function's in the file.
+    def define_tags(
+        self, function_info: dict, content: str, max_tags: int = 5
+    ) -> list[str] | Exception:
+        """Defines `max_tags` tags for the function.
 
         Args:
-            filepath (str): The file containing the code.
-
-        Raises:
-            RuntimeError: The LLM failed to define the function's of the file.
+            function_info (dict): The dictionnary containing the function's information.
+            content (str): The content of the function's file, or its context, see `FileContext`.
+            max_tags (int, optional): The number of tags to define for the function. Defaults to 5.
 
         Returns:
-            (list[dict] | Exception): The function defined in a list. Or an Exception if the LLM failed to define the functions.
+            (list[str] | Exception): A list of the tags. Or an exception if the LLM's answer isn't valid.
         """
-        functions, imports, content = extract_information(filepath)
+        query, system, check = self.tags_request(function_info, content, max_tags)
+        return self.define(function_info["qualname"], "tags", query, system, check)
 
-        for f in functions:
-            try:
-                f["parameters"] = [
-                    (name, t)
-                    for (name, _), t in zip(
-                        f["parameters"], self.define_param_types(f, imports)
-                    )
-                ]
+    def define_description(
+        self, function_info: dict, content: str, min_len=50, max_len=200
+    ) -> str | Exception:
+        """Define the description of the function.
 
-                f["tags"] = self.define_tags(f, content)
-                f["description"] = self.define_description(f, content)
-                f["return"] = (f["return"][0], self.define_return_type(f, imports))
-                f["category"] = self.define_category(f)
-            except Exception as e:
-                raise RuntimeError(f"Failed to define function {f['name']}: {e}")
+        Args:
+            function_info (dict): The dictionnary containing the function's information.
+            content (str): The content of the function's file, or its context, see `FileContext`.
+            min_len (int, optional): The minimum length of the description. Defaults to 50.
+            max_len (int, optional): The maximum length of the description. Defaults to 200.
 
-        base_name = os.path.basename(filepath)
-        json_output = [{"file": base_name}] + functions
-        return json_output
+        Returns:
+            (str | Exception): The description of the function. Or an exception if the LLM's answer isn't valid.
+        """
+        query, system, check = self.description_request(
+            function_info, content, min_len, max_len
+        )
+        return self.define(function_info["qualname"], "description", query, system, check)
 
-    def exception_handler(
-        self, funcname:str, name: str, tries: int, e: Exception
-    ) -> tuple[str, int] | RuntimeError:
-        """Handles the different exception returned by the LLM.
+    def define_return_type(
+        self, function_info: dict, imports: set[str]
+    ) -> str | Exception:
+        """Define the return type of the function.
 
         Args:
-            name (str): The name of the current step in the function definition.
-            tries (int): The number of tries for the current step.
-            e (Exception): The exception returned.
-
-        Raises:
-            RuntimeError: if the number of tries exceed `max_retry`, the LLM's failing to define the current step.
+            function_info (dict): The dictionnary containing the function's information.
+            imports (set[str]): The set containing all of the imports of the function's file, used to match types with LLM answer.
 
         Returns:
-            ((str, int) | RuntimeError): The error to return to the LLM, and number of tries. Or an Exception if the number of retries have been exceeded.
+            (str | Exception): The return type of the function. Or an exception if the LLm's answer isn't valid.
         """
-        err = str(e).lower()
-        if "exceeded" in err:
-            self.exceed_credits_handle(e)
-        else:
-            last_error = str(e)
-            print(f"Attempt {tries} failed for function {funcname}: {e}")
-            tries += 1
-            if tries >= self.max_retry:
-                raise RuntimeError(f"Failed to define {name} after {tries} tries: {e}")
-            return last_error, tries
+        known = self.known_return_type(function_info)
+        if known is not None:
+            return known
+        query, system, check = self.return_type_request(function_info, imports)
+        return self.define(function_info["qualname"], "return type", query, system, check)
 
-    # Obsolete
-    def exceed_credits_handle(self, e: Exception) -> int:
-        """Handles the credit issue with Hugging Face.
+    def define_category(self, function_info: dict) -> str | Exception:
+        """Define the category of the function.
 
         Args:
-            e (Exception): Credit issue exception.
-
-        Raises:
-            RuntimeError: Number of retries have exceeded `max_ex_retry`.
+            function_info (dict): The dictionnary containing the function's information.
 
         Returns:
-            (int): The number of retries for the credit exception.
+            str | Exception: The category of the function. Or an exception if the LLm's answer isn't valid.
         """
-        self.ex_tries += 1
-        if self.ex_tries >= self.max_ex_retry:
-            raise RuntimeError("Exceeded maximum retries for exceeded credits.") from e
-        wait = 2**self.ex_tries
-        print(f"Exceeded monthly included credits (false), retrying in {wait} seconds...")
-        
-        sleep(wait)
-        return self.ex_tries
+        known = self.known_category(function_info)
+        if known is not None:
+            return known
+        query, system, check = self.category_request(function_info)
+        return self.define(function_info["qualname"], "category", query, system, check)
+
+    def batch_request(
+        self, stage: str, functions: list[dict], content: str, imports: set[str]
+    ) -> tuple[str, list[str], object]:
+        """Builds the query, system queries and answer check defining one step for several functions at once.
+
+        The functions are identified by "f1", "f2", ... and the LLM answers a JSON object mapping each id to its answer.
+        Each answer goes through the check of the step's single request, a failed answer gives None.
+
+        Args:
+            stage (str): The name of the step, see `definition_stages`.
+            functions (list[dict]): The dictionnaries containing the functions' information.
+            content (str): The content of the functions' file, or their context, see `FileContext`.
+            imports (set[str]): The set containing all of the imports of the functions' file.
+
+        Returns:
+            (tuple[str, list[str], Callable[[str], list]]): The query, the system queries, and the check of the answer, giving the result of each function or None.
+        """
+        instructions = {
+            "parameters": [
+                "Define the type of each parameter of each function, as a list of types in the order of its parameters.",
+                f"Parameters types accepted: {ACCEPTED_TYPES}",
+            ],
+            "description": [
+                "Generate for each function a concise description ONLY of its source, on its role, purpose, and behavior in the file, between 50 and 200 characters.",
+            ],
+            "return": [
+                "Define the return type of each function.",
+                "If a return's type is unclear or is from a dependency, use `any` as its type.",
+            ],
+            "tags": [
+                "Extract for each function up to 5 relevant tags that describe ONLY its purpose, behavior, and role, as a list of strings.",
+            ],
+            "category": [
+                "Using FUNCTION_TYPES_GUIDE, determine which function category best describes each function.",
+                "Valid categories are the ones listed in FUNCTION_TYPES_GUIDE.",
+            ],
+        }
+        single_checks = {
+            "parameters": lambda f: self.param_types_request(f, imports)[2],
+            "description": lambda f: self.description_request(f, content)[2],
+            "return": lambda f: self.return_type_request(f, imports)[2],
+            "tags": lambda f: self.tags_request(f, content)[2],
+            "category": lambda f: self.category_request(f)[2],
+        }
+        system = (
+            [
+                "You are a code analysis assistant.",
+                "You will be given Python functions, each under a '### <id>' header.",
+            ]
+            + instructions[stage]
+            + [
+                'Respond ONLY with a JSON object mapping each function id to its answer, e.g. {"f1": ..., "f2": ...}.',
+            ]
+        )
+
+        items = []
+        for i, f in enumerate(functions, start=1):
+            details = {
+                "parameters": f"Parameters:\n{self.unresolved_parameters(f)}",
+                "description": f"Parameters:\n{f['parameters']}",
+                "return": f"Parameters:\n{f['parameters']}\nReturn:\n{f['return'][0]}",
+                "tags": f"Description of function:\n{f['description']}",
+                "category": f"Description:\n{f['description']}\nParameters:\n{f['parameters']}\nReturn:\n{f['return']}\nTags:\n{f['tags']}",
+            }
+            items.append(f"### f{i}\nFunction source:\n{f['source']}\n{details[stage]}")
+
+        header = ""
+        if stage in ("description", "tags"):
+            header = f"File content:\n{content}\n\n"
+        elif stage == "category":
+            header = f"{FUNCTION_TYPES_GUIDE}\n\n"
+        query = header + "\n\n".join(items)
+
+        checks = [single_checks[stage](f) for f in functions]
+
+        def check(answer: str) -> list:
+            value = parse_json_answer(answer)
+            if not isinstance(value, dict):
+                raise ValueError("Expected a JSON object mapping each function id to its answer.")
+            results = []
+            for i, item_check in enumerate(checks, start=1):
+                item = value.get(f"f{i}")
+                if item is None:
+                    results.append(None)
+                    continue
+                try:
+                    text = item if isinstance(item, str) else json.dumps(item)
+                    results.append(item_check(text))
+                except Exception:
+                    results.append(None)
+            return results
+
+        return query, system, check
+
+    def one_shot_request(
+        self, function_info: dict, content: str, imports: set[str]
+    ) -> tuple[str, list[str], object]:
+        """Builds the query, system queries and answer check defining every step of a function at once.
+
+        The LLM answers a JSON object with one key per step, see `definition_stages`. Each field goes through
+        the check of the step's single request, a failed field gives None.
+
+        Args:
+            function_info (dict): The dictionnary containing the function's information.
+            content (str): The content of the function's file, or its context, see `FileContext`.
+            imports (set[str]): The set containing all of the imports of the function's file.
+
+        Returns:
+            (tuple[str, list[str], Callable[[str], dict]]): The query, the system queries, and the check of the answer, giving the result of each step or None.
+        """
+        system = [
+            "You are a code analysis assistant.",
+            "You will be given a Python file, a function source, its parameters and its return value.",
+            "Define, for ONLY the function source:",
+            f'- "parameters": the list of the types of the given parameters, in order. Parameters types accepted: {ACCEPTED_TYPES}',
+            '- "description": a concise description of its role, purpose, and behavior in the file, between 50 and 200 characters.',
+            '- "return": its return type. If it is unclear or is from a dependency, use `any`.',
+            '- "tags": a list of up to 5 relevant tags that describe its purpose, behavior, and role.',
+            '- "category": using FUNCTION_TYPES_GUIDE, the function category that best describes it.',
+            'Respond ONLY with a JSON object with the keys "parameters", "description", "return", "tags" and "category".',
+        ]
+        p_names = self.unresolved_parameters(function_info)
+        query = f"""{FUNCTION_TYPES_GUIDE}
+File content:
+{content}
+Function source:
+{function_info["source"]}
+Parameters:
+{p_names}
+Return:
+{function_info["return"][0]}"""
+
+        checks = {
+            "parameters": self.param_types_request(function_info, imports)[2],
+            "description": self.description_request(function_info, content)[2],
+            "return": self.return_type_request(function_info, imports)[2],
+            "tags": self.tags_request(function_info, content)[2],
+            "category": self.category_request(function_info)[2],
+        }
+
+        def check(answer: str) -> dict:
+            value = parse_json_answer(answer)
+            if not isinstance(value, dict):
+                raise ValueError(
+                    'Expected a JSON object with the keys "parameters", "description", "return", "tags" and "category".'
+                )
+            results = {}
+            for key, field_check in checks.items():
+                field = value.get(key)
+                results[key] = None
+                if field is None:
+                    continue
+                try:
+                    text = field if isinstance(field, str) else json.dumps(field)
+                    results[key] = field_check(text)
+                except Exception:
+                    pass
+            return results
+
+        return query, system, check
+
+    def define_one_shot(
+        self, function_info: dict, content: str, imports: set[str]
+    ) -> dict:
+        """Defines every step of a function in a single query, see `one_shot_request`.
+
+        Args:
+            function_info (dict): The dictionnary containing the function's information.
+            content (str): The content of the function's file, or its context, see `FileContext`.
+            imports (set[str]): The set containing all of the imports of the function's file.
+
+        Returns:
+            dict: The result of each step, None for the steps to define individually.
+        """
+        query, system, check = self.one_shot_request(function_info, content, imports)
+        name = function_info["qualname"]
+        try:
+            return self.define(name, "one-shot definition", query, system, check)
+        except RuntimeError as e:
+            print(f"One-shot definition failed for function {name}: {e}")
+            return {}
+
+    def apply_one_shot(
+        self, function_info: dict, results: dict, stages: list[Stage]
+    ) -> list[Stage]:
+        """Applies the steps defined by a one-shot query, returning the steps left to define individually.
+
+        Args:
+            function_info (dict): The dictionnary containing the function's information, updated in place.
+            results (dict): The result of each step, see `define_one_shot`.
+            stages (list[Stage]): The definition stages, see `definition_stages`.
+
+        Returns:
+            list[Stage]: The stages whose field failed its check, only depending on each other.
+        """
+        known = self.known_return_type(function_info)
+        if known is not None:
+            results = {**results, "return": known}
+        known = self.known_param_types(function_info)
+        if known is not None:
+            results = {**results, "parameters": known}
+        known = self.known_category(function_info)
+        if known is not None:
+            results = {**results, "category": known}
+
+        remaining = [s for s in stages if results.get(s.name) is None]
+        for stage in stages:
+            if stage not in remaining:
+                stage.apply(function_info, results[stage.name])
+
+        names = {s.name for s in remaining}
+        return [
+            Stage(s.name, [i for i in s.inputs if i in names], s.run, s.apply)
+            for s in remaining
+        ]
+
+    def define_batch(
+        self, stage: str, functions: list[dict], content: str, imports: set[str]
+    ) -> list:
+        """Defines one step for several functions in a single query, see `batch_request`.
+
+        Args:
+            stage (str): The name of the step, see `definition_stages`.
+            functions (list[dict]): The dictionnaries containing the functions' information.
+            content (str): The content of the functions' file, or their context, see `FileContext`.
+            imports (set[str]): The set containing all of the imports of the functions' file.
+
+        Returns:
+            list: The result of each function, None for the functions to define individually.
+        """
+        query, system, check = self.batch_request(stage, functions, content, imports)
+        label = ", ".join(f["qualname"] for f in functions)
+        try:
+            return self.define(label, f"batched {stage}", query, system, check)
+        except RuntimeError as e:
+            print(f"Batched {stage} failed for functions {label}: {e}")
+            return [None] * len(functions)
+
+    def definition_stages(self, imports: set[str], content: str) -> list[Stage]:
+        """Lists the steps of a function's definition and the steps each of them reads.
+
+        The parameter types and the description only need the source, the return type reads the parameter types,
+        the tags read the description, and the category reads every other step.
+
+        Args:
+            imports (set[str]): The set containing all of the imports of the function's file.
+            content (str): The content of the function's file, or its context, see `FileContext`.
+
+        Returns:
+            list[Stage]: The definition stages of a function.
+        """
+
+        def apply_parameters(f: dict, types: list[str]):
+            f["parameters"] = [(name, t) for (name, _), t in zip(f["parameters"], types)]
+
+        def apply_return(f: dict, return_type: str):
+            f["return"] = (f["return"][0], return_type)
+
+        return [
+            Stage(
+                "parameters",
+                [],
+                lambda f: self.define_param_types(f, imports),
+                apply_parameters,
+            ),
+            Stage(
+                "description",
+                [],
+                lambda f: self.define_description(f, content),
+                lambda f, description: f.update(description=description),
+            ),
+            Stage(
+                "return",
+                ["parameters"],
+                lambda f: self.define_return_type(f, imports),
+                apply_return,
+            ),
+            Stage(
+                "tags",
+                ["description"],
+                lambda f: self.define_tags(f, content),
+                lambda f, tags: f.update(tags=tags),
+            ),
+            Stage(
+                "category",
+                ["parameters", "description", "return", "tags"],
+                self.define_category,
+                self.apply_category,
+            ),
+        ]
+
+    def analyze_function(
+        self, function_info: dict, imports: set[str], file_context: FileContext
+    ) -> dict | RuntimeError:
+        """Defines the parameter types, tags, description, return type and category of a function.
+
+        The independent steps are defined at the same time, see `definition_stages`. With the "one-shot" strategy,
+        every step is first asked in a single query, and only the steps whose answer failed are asked again.
+
+        Args:
+            function_info (dict): The dictionnary containing the function's information.
+            imports (set[str]): The set containing all of the imports of the function's file.
+            file_context (FileContext): The function's file, sent within `context_budget` tokens.
+
+        Raises:
+            RuntimeError: The LLM failed to define the function.
+
+        Returns:
+            (dict | RuntimeError): The function's dictionnary, completed. Or an Exception if the LLM failed to define the function.
+        """
+        f = function_info
+        content = file_context.for_function(f, self.context_budget)
+        try:
+            stages = self.definition_stages(imports, content)
+            if self.strategy == "one-shot":
+                results = self.define_one_shot(f, content, imports)
+                stages = self.apply_one_shot(f, results, stages)
+            run_stages(f, stages)
+        except Exception as e:
+            raise RuntimeError(f"Failed to define function {f['qualname']}: {e}")
+        return f
+
+    def analyze_functions(
+        self, functions: list[dict], imports: set[str], file_context: FileContext
+    ):
+        """Defines the functions concurrently, at most `max_workers` at a time.
+
+        Args:
+            functions (list[dict]): The dictionnaries containing the functions' information, updated in place.
+            imports (set[str]): The set containing all of the imports of the functions' file.
+            file_context (FileContext): The functions' file, sent within `context_budget` tokens.
+
+        Raises:
+            RuntimeError: The LLM failed to define a function.
+        """
+        with ThreadPoolExecutor(max_workers=max(1, self.max_workers)) as executor:
+            futures = [
+                executor.submit(self.analyze_function, f, imports, file_context)
+                for f in functions
+            ]
+            try:
+                for future in futures:
+                    future.result()
+            except Exception:
+                executor.shutdown(cancel_futures=True)
+                raise
+
+    def batch_groups(self, stage: str, functions: list[dict]) -> list[list[dict]]:
+        """Splits the functions into the batches of a step, `batch_size` functions each, leaving out the functions whose step doesn't need the LLM.
+
+        Args:
+            stage (str): The name of the step, see `definition_stages`.
+            functions (list[dict]): The dictionnaries containing the functions' information.
+
+        Returns:
+            list[list[dict]]: The batches, one query each.
+        """
+        known = {
+            "parameters": self.known_param_types,
+            "return": self.known_return_type,
+            "category": self.known_category,
+        }.get(stage)
+        batched = functions if known is None else [f for f in functions if known(f) is None]
+        size = max(1, self.batch_size)
+        return [batched[i : i + size] for i in range(0, len(batched), size)]
+
+    @staticmethod
+    def batched_results(
+        functions: list[dict], groups: list[list[dict]], results
+    ) -> tuple[dict[int, object], list[dict]]:
+        """Collects the results of the batches of a step.
+
+        Args:
+            functions (list[dict]): The dictionnaries containing the functions' information.
+            groups (list[list[dict]]): The batches, see `batch_groups`.
+            results (Iterable[list]): The results of each batch, see `define_batch`.
+
+        Returns:
+            tuple[dict[int, object], list[dict]]: The results by function id, and the functions left to define individually.
+        """
+        defined = {}
+        for group, group_results in zip(groups, results):
+            for f, result in zip(group, group_results):
+                if result is not None:
+                    defined[id(f)] = result
+        return defined, [f for f in functions if id(f) not in defined]
+
+    def single_stage(
+        self, stage: str, function_info: dict, imports: set[str], file_context: FileContext
+    ) -> Stage:
+        """Gives the step of a function defined on its own, with the function's context.
+
+        Args:
+            stage (str): The name of the step, see `definition_stages`.
+            function_info (dict): The dictionnary containing the function's information.
+            imports (set[str]): The set containing all of the imports of the function's file.
+            file_context (FileContext): The function's file, sent within `context_budget` tokens.
+
+        Returns:
+            Stage: The step.
+        """
+        content = file_context.for_function(function_info, self.context_budget)
+        return next(s for s in self.definition_stages(imports, content) if s.name == stage)
+
+    def analyze_batched(
+        self, functions: list[dict], imports: set[str], file_context: FileContext
+    ):
+        """Defines the functions step by step, each step defining `batch_size` functions per query.
+
+        The batches of a step run concurrently, at most `max_workers` at a time. The functions whose answer
+        failed its check are then defined individually.
+
+        Args:
+            functions (list[dict]): The dictionnaries containing the functions' information, updated in place.
+            imports (set[str]): The set containing all of the imports of the functions' file.
+            file_context (FileContext): The functions' file, sent within `context_budget` tokens for each batch.
+
+        Raises:
+            RuntimeError: The LLM failed to define a function.
+        """
+        with ThreadPoolExecutor(max_workers=max(1, self.max_workers)) as executor:
+            for stage in self.definition_stages(imports, file_context.content):
+                groups = self.batch_groups(stage.name, functions)
+                results = executor.map(
+                    lambda group: self.define_batch(
+                        stage.name,
+                        group,
+                        file_context.for_functions(group, self.context_budget),
+                        imports,
+                    ),
+                    groups,
+                )
+                defined, missing = self.batched_results(functions, groups, results)
+
+                def define_one(f: dict) -> object:
+                    try:
+                        return self.single_stage(stage.name, f, imports, file_context).run(dict(f))
+                    except Exception as e:
+                        raise RuntimeError(f"Failed to define function {f['qualname']}: {e}")
+
+                for f, result in zip(missing, executor.map(define_one, missing)):
+                    defined[id(f)] = result
+
+                for f in functions:
+                    stage.apply(f, defined[id(f)])
+
+    def extract(self, filepath: str) -> tuple[list[dict], set[str], str, FileContext]:
+        """Extracts the functions, imports, content and context of a file, from `extraction_cache` when one is given.
+
+        Args:
+            filepath (str): The file containing the code.
+
+        Raises:
+            FileNotFoundError: The file doesn't exist, with or without `extraction_cache`.
+
+        Returns:
+            tuple[list[dict], set[str], str, FileContext]: The function dictionaries, the imports, the content and the context of the file.
+        """
+        if self.extraction_cache is not None:
+            return self.extraction_cache.extract(filepath)
+        if not os.path.isfile(filepath):
+            raise FileNotFoundError(f"File not found: {filepath}")
+        visitor = parse_module(read_file(filepath), filepath)
+        return visitor.functions, set(visitor.imports), visitor.content, FileContext(visitor)
+
+    def reuse_definitions(self, functions: list[dict]) -> tuple[list[dict], dict[str, list[dict]]]:
+        """Copies the definitions stored for the functions, and keeps a single function to define per fingerprint.
+
+        Args:
+            functions (list[dict]): The functions to define, updated in place when their definition is stored.
+
+        Returns:
+            tuple[list[dict], dict[str, list[dict]]]: The functions left to define, and the functions to define grouped by fingerprint, see `ast_fingerprint`.
+        """
+        to_define = []
+        groups = {}
+        for f in functions:
+            fingerprint = ast_fingerprint(f["source"])
+            if fingerprint is None:
+                to_define.append(f)
+                continue
+            if fingerprint in groups:
+                groups[fingerprint].append(f)
+                continue
+            stored = None
+            if self.result_store is not None:
+                stored = self.result_store.get(self.model, fingerprint)
+            if stored is not None:
+                copy_definition(f, stored)
+                continue
+            groups[fingerprint] = [f]
+            to_define.append(f)
+        return to_define, groups
+
+    def store_definitions(self, groups: dict[str, list[dict]]):
+        """Copies each defined function to its identical functions, and stores its definition.
+
+        Args:
+            groups (dict[str, list[dict]]): The functions grouped by fingerprint, the first one defined, see `reuse_definitions`.
+        """
+        for fingerprint, group in groups.items():
+            self.store_definition(fingerprint, group)
+
+    def store_definition(self, fingerprint: str, group: list[dict]):
+        """Copies a defined function to its identical functions, and stores its definition.
+
+        Args:
+            fingerprint (str): The fingerprint of the functions, see `ast_fingerprint`.
+            group (list[dict]): The identical functions, the first one defined.
+        """
+        defined, *duplicates = group
+        for f in duplicates:
+            copy_definition(f, defined)
+        if self.result_store is not None:
+            self.result_store.set(self.model, fingerprint, defined)
+
+    def plan_file(self, filepath: str, previous: list[dict] | None = None) -> FilePlan:
+        """Extracts a file and finds the functions the LLM has to define.
+
+        The functions unchanged since `previous` are copied from it, the functions stored in `result_store` are copied from it,
+        and identical functions are defined once, see `reuse_definitions`.
+
+        Args:
+            filepath (str): The file containing the code.
+            previous (list[dict] | None, optional): A previous output of `analyze_file` for the file. Defaults to None.
+
+        Returns:
+            FilePlan: The functions of the file, and the ones to define.
+        """
+        functions, imports, content, file_context = self.extract(filepath)
+        to_define = functions if previous is None else merge_previous(functions, previous)
+        to_define, groups = self.reuse_definitions(to_define)
+        return FilePlan(filepath, functions, imports, file_context, to_define, groups)
+
+    def complete(self, plan: FilePlan, function_info: dict) -> list[dict]:
+        """Copies a defined function to its identical functions, and stores its definition, see `store_definition`.
+
+        Args:
+            plan (FilePlan): The functions of the file.
+            function_info (dict): A defined function of `plan.to_define`.
+
+        Returns:
+            list[dict]: The function, and its identical functions.
+        """
+        fingerprint, group = plan.group_of(function_info)
+        if fingerprint is not None:
+            self.store_definition(fingerprint, group)
+        return group
+
+    def analyze_file(
+        self, filepath: str, previous: list[dict] | None = None
+    ) -> list[dict] | RuntimeError:
+        """Defines the all of the function's in the file.
+
+        The functions are defined concurrently, at most `max_workers` at a time, the output keeps the order of the file.
+        With the "batched" strategy, each query defines a step of `batch_size` functions, see `analyze_batched`.
+        Identical functions are defined once, and the functions defined before with the model are read from `result_store`.
+
+        Args:
+            filepath (str): The file containing the code.
+            previous (list[dict] | None, optional): A previous output of `analyze_file` for the file. The functions unchanged since are copied from it instead of being defined again. Defaults to None.
+
+        Raises:
+            RuntimeError: The LLM failed to define the function's of the file.
+
+        Returns:
+            (list[dict] | Exception): The function defined in a list. Or an Exception if the LLM failed to define the functions.
+        """
+        plan = self.plan_file(filepath, previous)
+        if self.strategy == "batched":
+            self.analyze_batched(plan.to_define, plan.imports, plan.file_context)
+        else:
+            self.analyze_functions(plan.to_define, plan.imports, plan.file_context)
+        self.store_definitions(plan.groups)
+        return plan.output()
+
+    def stream_file(self, filepath: str, previous: list[dict] | None = None):
+        """Defines the functions of the file like `analyze_file`, giving each function as soon as it is defined.
+
+        The `{"file": ...}` header comes first, then the functions copied from `previous` or `result_store`,
+        then each defined function with its identical functions, in the order they complete.
+        With the "batched" strategy, the functions are defined together and come at the end.
+
+        Args:
+            filepath (str): The file containing the code.
+            previous (list[dict] | None, optional): A previous output of `analyze_file` for the file, see `analyze_file`. Defaults to None.
+
+        Raises:
+            RuntimeError: The LLM failed to define a function of the file, the functions not yet started are cancelled.
+
+        Yields:
+            dict: The header, then the function dictionnaries.
+        """
+        plan = self.plan_file(filepath, previous)
+        yield plan.header()
+        yield from plan.reused()
+
+        if self.strategy == "batched":
+            self.analyze_batched(plan.to_define, plan.imports, plan.file_context)
+            for f in plan.to_define:
+                yield from self.complete(plan, f)
+            return
+
+        executor = ThreadPoolExecutor(max_workers=max(1, self.max_workers))
+        futures = [
+            executor.submit(self.analyze_function, f, plan.imports, plan.file_context)
+            for f in plan.to_define
+        ]
+        try:
+            for future in as_completed(futures):
+                yield from self.complete(plan, future.result())
+        finally:
+            executor.shutdown(cancel_futures=True)
+
+    def exception_handler(
+        self, funcname:str, name: str, tries: int, e: Exception
+    ) -> tuple[str, int] | RuntimeError:
+        """Handles the different exception returned by the LLM.
+
+        Args:
+            name (str): The name of the current step in the function definition.
+            tries (int): The number of tries for the current step.
+            e (Exception): The exception returned.
+
+        Raises:
+            RuntimeError: if the number of tries exceed `max_retry`, the LLM's failing to define the current step.
+
+        Returns:
+            ((str, int) | RuntimeError): The error to return to the LLM, and number of tries. Or an Exception if the number of retries have been exceeded.
+        """
+        last_error = str(e)
+        print(f"Attempt {tries} failed for function {funcname}: {e}")
+        tries += 1
+        if tries >= self.max_retry:
+            raise RuntimeError(f"Failed to define {name} after {tries} tries: {e}")
+        return last_error, tries
+
+    def rate_limit_delay(self, funcname: str, attempt: int, e: Exception) -> float:
+        """Gives the delay before retrying a query refused by a rate limit or exceeded credits.
+
+        The delay is jittered and grows with the attempts of this query only, other queries keep running.
+
+        Args:
+            funcname (str): The name of the function being defined.
+            attempt (int): The number of times the query was refused.
+            e (Exception): Rate limit exception.
+
+        Raises:
+            RuntimeError: Number of retries have exceeded `max_ex_retry`.
+
+        Returns:
+            (float): The delay in seconds.
+        """
+        if attempt >= self.max_ex_retry:
+            raise RuntimeError("Exceeded maximum retries for rate limits.") from e
+        wait = max(retry_after(e) or 0.0, backoff_delay(attempt))
+        print(f"Rate limited for function {funcname}, retrying in {wait:.1f} seconds...")
+        return wait
+
+    def unavailable_delay(self, funcname: str, attempt: int, e: Exception) -> float:
+        """Gives the delay before retrying a query failed by the provider or the connection, see `is_transient_error`.
+
+        Args:
+            funcname (str): The name of the function being defined.
+            attempt (int): The number of times the query failed.
+            e (Exception): The exception of the query.
+
+        Raises:
+            RuntimeError: Number of retries have exceeded `max_ex_retry`.
+
+        Returns:
+            (float): The delay in seconds.
+        """
+        if attempt >= self.max_ex_retry:
+            raise RuntimeError(f"Exceeded maximum retries for provider errors: {e}") from e
+        wait = max(retry_after(e) or 0.0, backoff_delay(attempt))
+        print(f"Provider error for function {funcname}: {e}, retrying in {wait:.1f} seconds...")
+        return wait
+
+
+class AsyncGentlemanLLM(GentlemanLLM):
+    """Asynchronous GentlemanLLM, built on `AsyncOpenAI`, for services serving many analyses at once.
+
+    The prompts and checks are the ones of `GentlemanLLM`, only the queries are awaited.
+    """
+
+    def create_client(self, hf_token: str) -> AsyncOpenAI:
+        """Creates the asynchronous client used to query the LLM, or takes the shared one of `clients`.
+
+        Args:
+            hf_token (str): The Hugging Face token.
+
+        Returns:
+            AsyncOpenAI: The client for the Hugging Face router.
+        """
+        if self.clients is not None:
+            return self.clients.get_async(hf_token)
+        return AsyncOpenAI(
+            base_url=BASE_URL,
+            api_key=hf_token,
+            max_retries=0,  # rate limits and provider errors are retried by `define`
+        )
+
+    async def close(self):
+        """Closes the client's connections, unless the client is shared."""
+        if self.clients is None:
+            await self.client.close()
+
+    async def ask(
+        self, user_query: str, system: list[str], error: str | None = None
+    ) -> str | RuntimeError:
+        """Queries the llm with the user query, and system query. Optionally error if the last the last query with the LLM was unsuccessful.
+
+        The answer is read from, and stored in, `cache` when one is given, on a worker thread. The query waits for `rate_limiter` when one is given.
+
+        Args:
+            user_query (str): a list of user queries
+            system (list[str]): a list of system queries
+            error (str | None, optional): The last error if the previous query was unsuccesful. Defaults to None.
+
+        Raises:
+            RuntimeError: The LLM did not return anything.
+
+        Returns:
+            (str|RuntimeError): The answer of the model.
+        """
+        key, cached = None, None
+        if self.cache is not None:
+            key, cached = await asyncio.to_thread(self.cached_answer, user_query, system, error)
+        if cached is not None:
+            return cached
+
+        messages = self.messages(user_query, system, error)
+        tokens = estimate_tokens(messages)
+
+        if self.rate_limiter is not None:
+            await self.rate_limiter.acquire_async(tokens)
+        try:
+            resp = await self.client.chat.completions.create(
+                model=self.model, messages=messages
+            )
+        except Exception as e:
+            self.release(tokens, error=e)
+            raise
+        self.release(tokens, resp)
+
+        answer = self.read_answer(resp)
+        if key is not None:
+            await asyncio.to_thread(self.store_answer, key, answer)
+        return answer
+
+    async def define(
+        self, funcname: str, name: str, query: str, system: list[str], check
+    ) -> object | RuntimeError:
+        """Queries the LLM until its answer passes `check`, see `GentlemanLLM.define`.
+
+        Args:
+            funcname (str): The name of the function being defined.
+            name (str): The name of the current step in the function definition.
+            query (str): The user query.
+            system (list[str]): A list of system queries.
+            check (Callable[[str], object]): Validates the answer and returns the defined value, raises an exception if the answer isn't valid.
+
+        Raises:
+            RuntimeError: if the number of tries exceed `max_retry`, or the number of rate limited or failed queries exceed `max_ex_retry`.
+
+        Returns:
+            (object | RuntimeError): The value returned by `check`.
+        """
+        attempts = {"error": None, "tries": 0, "rate_limited": 0, "unavailable": 0}
+        while True:
+            try:
+                answer = await self.ask(query, system, attempts["error"])
+                return check(answer)
+            except Exception as e:
+                delay = self.failed(funcname, name, attempts, e)
+            if delay:
+                await asyncio.sleep(delay)
+
+    async def define_param_types(
+        self, function_info: dict, imports: set[str]
+    ) -> list[str] | Exception:
+        """Defines the types of each parameters of a function, see `GentlemanLLM.define_param_types`."""
+        known = self.known_param_types(function_info)
+        if known is not None:
+            return known
+        query, system, check = self.param_types_request(function_info, imports)
+        return await self.define(
+            function_info["qualname"], "parameter types", query, system, check
+        )
+
+    async def define_tags(
+        self, function_info: dict, content: str, max_tags: int = 5
+    ) -> list[str] | Exception:
+        """Defines `max_tags` tags for the function, see `GentlemanLLM.define_tags`."""
+        query, system, check = self.tags_request(function_info, content, max_tags)
+        return await self.define(function_info["qualname"], "tags", query, system, check)
+
+    async def define_description(
+        self, function_info: dict, content: str, min_len=50, max_len=200
+    ) -> str | Exception:
+        """Define the description of the function, see `GentlemanLLM.define_description`."""
+        query, system, check = self.description_request(
+            function_info, content, min_len, max_len
+        )
+        return await self.define(
+            function_info["qualname"], "description", query, system, check
+        )
+
+    async def define_return_type(
+        self, function_info: dict, imports: set[str]
+    ) -> str | Exception:
+        """Define the return type of the function, see `GentlemanLLM.define_return_type`."""
+        known = self.known_return_type(function_info)
+        if known is not None:
+            return known
+        query, system, check = self.return_type_request(function_info, imports)
+        return await self.define(
+            function_info["qualname"], "return type", query, system, check
+        )
+
+    async def define_category(self, function_info: dict) -> str | Exception:
+        """Define the category of the function, see `GentlemanLLM.define_category`."""
+        known = self.known_category(function_info)
+        if known is not None:
+            return known
+        query, system, check = self.category_request(function_info)
+        return await self.define(function_info["qualname"], "category", query, system, check)
+
+    async def define_one_shot(
+        self, function_info: dict, content: str, imports: set[str]
+    ) -> dict:
+        """Defines every step of a function in a single query, see `GentlemanLLM.define_one_shot`."""
+        query, system, check = self.one_shot_request(function_info, content, imports)
+        name = function_info["qualname"]
+        try:
+            return await self.define(name, "one-shot definition", query, system, check)
+        except RuntimeError as e:
+            print(f"One-shot definition failed for function {name}: {e}")
+            return {}
+
+    async def define_batch(
+        self, stage: str, functions: list[dict], content: str, imports: set[str]
+    ) -> list:
+        """Defines one step for several functions in a single query, see `GentlemanLLM.define_batch`."""
+        query, system, check = self.batch_request(stage, functions, content, imports)
+        label = ", ".join(f["qualname"] for f in functions)
+        try:
+            return await self.define(label, f"batched {stage}", query, system, check)
+        except RuntimeError as e:
+            print(f"Batched {stage} failed for functions {label}: {e}")
+            return [None] * len(functions)
+
+    async def analyze_function(
+        self, function_info: dict, imports: set[str], file_context: FileContext
+    ) -> dict | RuntimeError:
+        """Defines the parameter types, tags, description, return type and category of a function, see `GentlemanLLM.analyze_function`."""
+        f = function_info
+        content = file_context.for_function(f, self.context_budget)
+        try:
+            stages = self.definition_stages(imports, content)
+            if self.strategy == "one-shot":
+                results = await self.define_one_shot(f, content, imports)
+                stages = self.apply_one_shot(f, results, stages)
+            await run_stages_async(f, stages)
+        except Exception as e:
+            raise RuntimeError(f"Failed to define function {f['qualname']}: {e}")
+        return f
+
+    def function_tasks(
+        self, functions: list[dict], imports: set[str], file_context: FileContext
+    ) -> list[asyncio.Task]:
+        """Starts defining the functions, at most `max_workers` at a time.
+
+        Args:
+            functions (list[dict]): The dictionnaries containing the functions' information, updated in place.
+            imports (set[str]): The set containing all of the imports of the functions' file.
+            file_context (FileContext): The functions' file, sent within `context_budget` tokens.
+
+        Returns:
+            list[asyncio.Task]: The task defining each function, see `analyze_function`.
+        """
+        semaphore = asyncio.Semaphore(max(1, self.max_workers))
+
+        async def bounded(f: dict) -> dict:
+            async with semaphore:
+                return await self.analyze_function(f, imports, file_context)
+
+        return [asyncio.create_task(bounded(f)) for f in functions]
+
+    async def analyze_functions(
+        self, functions: list[dict], imports: set[str], file_context: FileContext
+    ):
+        """Defines the functions concurrently, at most `max_workers` at a time, see `GentlemanLLM.analyze_functions`."""
+        tasks = self.function_tasks(functions, imports, file_context)
+        try:
+            await asyncio.gather(*tasks)
+        except Exception:
+            for task in tasks:
+                task.cancel()
+            raise
+
+    async def analyze_batched(
+        self, functions: list[dict], imports: set[str], file_context: FileContext
+    ):
+        """Defines the functions step by step, `batch_size` functions per query, see `GentlemanLLM.analyze_batched`."""
+        semaphore = asyncio.Semaphore(max(1, self.max_workers))
+
+        async def bounded(coro):
+            async with semaphore:
+                return await coro
+
+        for stage in self.definition_stages(imports, file_context.content):
+            groups = self.batch_groups(stage.name, functions)
+            results = await asyncio.gather(
+                *(
+                    bounded(
+                        self.define_batch(
+                            stage.name,
+                            group,
+                            file_context.for_functions(group, self.context_budget),
+                            imports,
+                        )
+                    )
+                    for group in groups
+                )
+            )
+            defined, missing = self.batched_results(functions, groups, results)
+
+            async def define_one(f: dict) -> object:
+                try:
+                    return await self.single_stage(stage.name, f, imports, file_context).run(dict(f))
+                except Exception as e:
+                    raise RuntimeError(f"Failed to define function {f['qualname']}: {e}")
+
+            missing_results = await asyncio.gather(
+                *(bounded(define_one(f)) for f in missing)
+            )
+            for f, result in zip(missing, missing_results):
+                defined[id(f)] = result
+
+            for f in functions:
+                stage.apply(f, defined[id(f)])
+
+    async def analyze_file(
+        self, filepath: str, previous: list[dict] | None = None
+    ) -> list[dict] | RuntimeError:
+        """Defines the all of the function's in the file, at most `max_workers` functions at a time.
+
+        Args:
+            filepath (str): The file containing the code.
+            previous (list[dict] | None, optional): A previous output of `analyze_file` for the file, see `GentlemanLLM.analyze_file`. Defaults to None.
+
+        Raises:
+            RuntimeError: The LLM failed to define the function's of the file.
+
+        Returns:
+            (list[dict] | Exception): The function defined in a list. Or an Exception if the LLM failed to define the functions.
+        """
+        plan = await asyncio.to_thread(self.plan_file, filepath, previous)
+        if self.strategy == "batched":
+            await self.analyze_batched(plan.to_define, plan.imports, plan.file_context)
+        else:
+            await self.analyze_functions(plan.to_define, plan.imports, plan.file_context)
+        await asyncio.to_thread(self.store_definitions, plan.groups)
+        return plan.output()
+
+    async def stream_file(self, filepath: str, previous: list[dict] | None = None):
+        """Defines the functions of the file, giving each function as soon as it is defined, see `GentlemanLLM.stream_file`.
+
+        Args:
+            filepath (str): The file containing the code.
+            previous (list[dict] | None, optional): A previous output of `analyze_file` for the file, see `GentlemanLLM.analyze_file`. Defaults to None.
+
+        Raises:
+            RuntimeError: The LLM failed to define a function of the file, the functions being defined are cancelled.
+
+        Yields:
+            dict: The header, then the function dictionnaries.
+        """
+        plan = await asyncio.to_thread(self.plan_file, filepath, previous)
+        yield plan.header()
+        for f in plan.reused():
+            yield f
+
+        if self.strategy == "batched":
+            await self.analyze_batched(plan.to_define, plan.imports, plan.file_context)
+            for f in plan.to_define:
+                for defined in await asyncio.to_thread(self.complete, plan, f):
+                    yield defined
+            return
+
+        tasks = self.function_tasks(plan.to_define, plan.imports, plan.file_context)
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                f = await next_done
+                for defined in await asyncio.to_thread(self.complete, plan, f):
+                    yield defined
+        finally:
+            for task in tasks:
+                task.cancel()
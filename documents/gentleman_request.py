@@ -1,44 +1,272 @@
-from fastapi import FastAPI
+import asyncio
+import io
+import json
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, File, HTTPException, UploadFile
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from util import next_available_foldername, write_file
-from gentleman_llm import GentlemanLLM
+from project_index import ProjectIndex
+from uploads import UploadStore
+from util import list_files
+from gentleman_llm import AsyncGentlemanLLM
+from cache import ExtractionCache, ResponseCache, ResultStore, extractor_version
+from clients import ClientRegistry
+from rate_limit import RateLimiter
+from jobs import JobQueue, JobStore
 import os
 
-app = FastAPI()
+DEFAULT_MODEL = "meta-llama/Llama-3.1-8B-Instruct"
+# files of a project folder analyzed at once
+FILE_WORKERS = 4
+# the settings of the analyses, part of the key of an analysis by hash with the model
+ANALYSIS_SETTINGS = {
+    "strategy": "pipeline",
+    "batch_size": 5,
+    "context_budget": 1500,
+    "category_threshold": 0.85,
+}
+
+cache = ResponseCache()
+result_store = ResultStore()
+extraction_cache = ExtractionCache(path="cache/extractions")
+# LLM clients shared by the analyses, LLM_HTTP2=1 needs `pip install h2`
+clients = ClientRegistry(http2=os.getenv("LLM_HTTP2") == "1")
+uploads = UploadStore()
+# one budget for every job and stream, LLM_RPS and LLM_TPM are unlimited when unset
+rate_limiter = RateLimiter(
+    requests_per_second=float(os.getenv("LLM_RPS")) if os.getenv("LLM_RPS") else None,
+    tokens_per_minute=float(os.getenv("LLM_TPM")) if os.getenv("LLM_TPM") else None,
+    max_concurrency=int(os.getenv("LLM_MAX_IN_FLIGHT", "16")),
+)
 
 
 class AnalyzeRequest(BaseModel):
-    """Request model for analyzing a file with GentlemanLLM.
+    """Request model for analyzing a file, or a project folder, with GentlemanLLM.
 
     Args:
         BaseModel (BaseModel): Pydantic base model for request validation.
     """
 
-    filepath: str
+    filepath: str | None = None
+    hash: str | None = None
     model: str | None
     hf_token: str |None
 
 
+async def analyze_folder(service: AsyncGentlemanLLM, folder: str) -> dict:
+    """Analyzes the Python files of a project folder, `FILE_WORKERS` files at a time.
+
+    Args:
+        service (AsyncGentlemanLLM): The service defining the functions.
+        folder (str): The project folder.
+
+    Returns:
+        dict: The output of each analyzed file and the error of each failed file, by path in the project,
+        and the call graph of the project, see `ProjectIndex`.
+    """
+    files = [f for f in list_files(folder, recursive=True) if f.endswith(".py")]
+    semaphore = asyncio.Semaphore(FILE_WORKERS)
+    project = ProjectIndex()
+    outputs = {}
+    errors = {}
+
+    async def analyze_one(name: str):
+        path = os.path.join(folder, name)
+        async with semaphore:
+            try:
+                outputs[name] = await service.analyze_file(path)
+            except Exception as e:
+                errors[name] = str(e)
+                return
+        _, _, _, file_context = await asyncio.to_thread(service.extract, path)
+        project.add_context(path, file_context, folder)
+
+    await asyncio.gather(*(analyze_one(name) for name in files))
+    return {
+        "outputs": dict(sorted(outputs.items())),
+        "errors": dict(sorted(errors.items())),
+        "call_graph": project.to_json(),
+    }
+
+
+async def run_analysis(request: dict, secrets: dict) -> list[dict] | dict:
+    """Analyzes a file, or a project folder, using the specified LLM model, without holding a worker thread during the LLM queries.
+
+    Args:
+        request (dict): The file or folder path and model of the job, and if the client gave a token.
+        secrets (dict): The Hugging Face token of the job, if the client gave one.
+
+    Raises:
+        RuntimeError: The client gave a token that was lost, the job isn't billed to the server's token instead.
+
+    Returns:
+        list[dict] | dict: Analysis results from the LLM, for a folder see `analyze_folder`.
+    """
+    if request.get("needs_token") and not secrets.get("hf_token"):
+        raise RuntimeError("The job's token was lost by a restart of the server, resubmit the job.")
+    hf_token = secrets.get("hf_token") or os.getenv("HF_TOKEN")
+    service = AsyncGentlemanLLM(
+        model=request["model"],
+        hf_token=hf_token,
+        cache=cache,
+        result_store=result_store,
+        extraction_cache=extraction_cache,
+        clients=clients,
+        rate_limiter=rate_limiter,
+        **request.get("settings", ANALYSIS_SETTINGS),
+    )
+    try:
+        filepath = request.get("filepath")
+        if "hash" in request:
+            filepath = uploads.target(request["hash"])
+            if filepath is None:
+                raise ValueError(f"Unknown upload: {request['hash']}")
+        if os.path.isdir(filepath):
+            return await analyze_folder(service, filepath)
+        return await service.analyze_file(filepath)
+    finally:
+        await service.close()
+
+
+jobs = JobQueue(JobStore(), run_analysis, workers=int(os.getenv("JOB_WORKERS", "2")))
+# analyses by hash are reused while the extraction code is unchanged
+EXTRACTOR_VERSION = extractor_version()
+
+
+def target_of(req: AnalyzeRequest) -> str:
+    """Gives the file or folder of a request: its path, or its upload.
+
+    Args:
+        req (AnalyzeRequest): The request, with a file path or an upload hash.
+
+    Raises:
+        HTTPException: 400 if the request has neither, 404 if the hash isn't a stored upload.
+
+    Returns:
+        str: The file or folder to analyze.
+    """
+    if req.hash is not None:
+        target = uploads.target(req.hash)
+        if target is None:
+            raise HTTPException(status_code=404, detail=f"Unknown upload: {req.hash}")
+        return target
+    if req.filepath is None:
+        raise HTTPException(status_code=400, detail="Expected a filepath or an upload hash.")
+    return req.filepath
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await jobs.start()
+    try:
+        yield
+    finally:
+        await jobs.stop()
+        await clients.aclose()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
 @app.post("/analyze")
-def analyze(req: AnalyzeRequest) -> list[dict]:
-    """Analyzes a file using the specified LLM model.
+async def analyze(req: AnalyzeRequest) -> dict:
+    """Queues the analysis of a file, or of an upload given by its hash, see `GET /jobs/{job_id}` for its result.
+
+    An upload is stored by content, so its analysis is run once per model and settings: the same hash
+    gives the job already queued, running or done, with its result if done.
+    The token is kept in memory only: a job interrupted by a restart, or claimed by another server, fails
+    and has to be submitted again with the token.
+
+    Args:
+        req (AnalyzeRequest): The request containing file path or upload hash, model, and Hugging Face token.
+
+    Raises:
+        HTTPException: 400 if the request has no file path or hash, 404 if the hash isn't a stored upload.
+
+    Returns:
+        dict: The id and status of the job, and its result if it is done.
+    """
+    target_of(req)
+    secrets = {"hf_token": req.hf_token} if req.hf_token else None
+    # only the presence of the token is stored, never its value
+    token = {"needs_token": True} if secrets else {}
+    if req.hash is None:
+        request = {"filepath": req.filepath, "model": req.model or DEFAULT_MODEL}
+        job_id = await jobs.submit({**request, **token}, secrets)
+        return {"job_id": job_id, "status": "queued"}
+
+    request = {
+        "hash": req.hash,
+        "model": req.model or DEFAULT_MODEL,
+        "settings": ANALYSIS_SETTINGS,
+        "extractor": EXTRACTOR_VERSION,
+    }
+    job_id = await jobs.submit({**request, **token}, secrets, key=JobStore.request_key(request))
+    job = await asyncio.to_thread(jobs.store.get, job_id)
+    if job["status"] == "done":
+        return {"job_id": job_id, "status": "done", "result": job["result"]}
+    return {"job_id": job_id, "status": job["status"]}
+
+
+@app.post("/analyze/stream")
+async def analyze_stream(req: AnalyzeRequest) -> StreamingResponse:
+    """Analyzes a file, or an uploaded file given by its hash, while the client waits, streaming each function as soon as it is defined.
+
+    The response is NDJSON: the `{"file": ...}` header, then one function per line, see `AsyncGentlemanLLM.stream_file`.
+    If the analysis fails, the last line is `{"error": ...}`. The analysis stops if the client disconnects.
+
+    Args:
+        req (AnalyzeRequest): The request containing file path or upload hash, model, and Hugging Face token.
+
+    Raises:
+        HTTPException: 400 if the request has no file path or hash, or gives a folder, 404 if the hash isn't a stored upload.
+
+    Returns:
+        StreamingResponse: The lines of the analysis.
+    """
+    filepath = target_of(req)
+    if os.path.isdir(filepath):
+        raise HTTPException(status_code=400, detail="Only a file can be streamed, analyze a project with /analyze.")
+    service = AsyncGentlemanLLM(
+        model=req.model or DEFAULT_MODEL,
+        hf_token=req.hf_token or os.getenv("HF_TOKEN"),
+        cache=cache,
+        result_store=result_store,
+        extraction_cache=extraction_cache,
+        clients=clients,
+        rate_limiter=rate_limiter,
+        **ANALYSIS_SETTINGS,
+    )
+
+    async def lines():
+        try:
+            async for record in service.stream_file(filepath):
+                yield json.dumps(record, ensure_ascii=False) + "\n"
+        except Exception as e:
+            yield json.dumps({"error": str(e) or type(e).__name__}, ensure_ascii=False) + "\n"
+        finally:
+            await service.close()
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str) -> dict:
+    """Gives the status of an analysis job, and its result once done.
 
     Args:
-        req (GentlemanRequest): The request containing file path, model, and Hugging Face token.
+        job_id (str): The id given by `/analyze`.
+
+    Raises:
+        HTTPException: 404 if the job doesn't exist.
 
     Returns:
-        list[dict]: Analysis results from the LLM.
+        dict: The job's id, status ("queued", "running", "done" or "failed"), request, result, error and times.
     """
-    if req.model is None:
-        model = "meta-llama/Llama-3.1-8B-Instruct"
-    else:
-        model = req.model
-    if req.hf_token is None:
-        hf_token = os.getenv("HF_TOKEN")
-    else:
-        hf_token = req.hf_token
-    service = GentlemanLLM(model=model, hf_token=hf_token)
-    return service.analyze_file(req.filepath)
+    job = await asyncio.to_thread(jobs.store.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Unknown job: {job_id}")
+    return job
 
 
 class UploadRequest(BaseModel):
@@ -52,16 +280,49 @@ class UploadRequest(BaseModel):
     content: str
     
 @app.post("/upload")
-def upload(req: UploadRequest) -> str:
-    """Uploads a file using the specified content.
+def upload(req: UploadRequest) -> dict:
+    """Uploads a file using the specified content, stored once per name and content.
 
     Args:
         req (UploadRequest): The request containing filename and content.
 
+    Raises:
+        HTTPException: 400 if the file name is invalid.
+
     Returns:
-        bool: Result of the upload operation.
+        dict: The hash of the upload, to give to `/analyze`, and its folder.
     """
     file_name = os.path.basename(req.filepath)
-    folder_name = next_available_foldername("code")
-    write_file(f"{folder_name}/{file_name}", req.content.strip())
-    return folder_name
+    content = io.BytesIO(req.content.strip().encode("utf-8"))
+    try:
+        digest, _ = uploads.save([(file_name, content)])
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"hash": digest, "folder": uploads.path(digest)}
+
+
+@app.post("/upload/project")
+async def upload_project(files: list[UploadFile] = File(...)) -> dict:
+    """Uploads the files of a project in a single multipart request, stored once per content.
+
+    Each file is named by its path in the project, such as "pkg/mod.py". Zip and tar archives are extracted.
+    The files are copied chunk by chunk, so neither the request nor the archives are held in memory.
+    The project is stored under the hash of its paths and contents, see `UploadStore`:
+    uploading it again gives the same hash, and `/analyze` reuses its analysis.
+
+    Args:
+        files (list[UploadFile]): The files and archives of the project.
+
+    Raises:
+        HTTPException: 400 if a path is invalid, an archive can't be read, or the upload is too large or empty.
+
+    Returns:
+        dict: The hash of the project, to give to `/analyze`, its folder, and the paths of its files.
+    """
+    try:
+        digest, written = await asyncio.to_thread(
+            uploads.save, [(f.filename or "", f.file) for f in files]
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"hash": digest, "folder": uploads.path(digest), "files": written}
@@ -0,0 +1,341 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+
+class JobStore:
+    """On-disk queue of the analysis jobs, their status and their results.
+
+    Jobs are claimed oldest first, a single update marking them running under the lease of their worker,
+    so several workers, or several processes, never run the same job. A worker renews the leases of its jobs
+    while it runs them: the job of a worker that stopped renewing it, such as a crashed process, is claimed again
+    once its lease has expired. Secrets such as tokens are never stored.
+    A job submitted with a key is submitted once: the same key gives the job already queued, running or done.
+
+    Args:
+        path (str, optional): The SQLite file of the jobs. Defaults to "cache/jobs.sqlite".
+        lease (float, optional): The seconds a running job stays claimed without being renewed. Defaults to 60.0.
+    """
+
+    def __init__(self, path: str = "cache/jobs.sqlite", lease: float = 60.0):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.lease = lease
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                request TEXT NOT NULL,
+                result TEXT,
+                error TEXT,
+                created_at REAL NOT NULL,
+                started_at REAL,
+                finished_at REAL,
+                key TEXT,
+                owner TEXT,
+                heartbeat REAL
+            )"""
+        )
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(jobs)")]
+        # a store created before the keyed jobs, or before the leases
+        for column, kind in (("key", "TEXT"), ("owner", "TEXT"), ("heartbeat", "REAL")):
+            if column not in columns:
+                self.conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {kind}")
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS jobs_queued ON jobs (status, created_at)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS jobs_key ON jobs (key, created_at)")
+        self.conn.commit()
+
+    @staticmethod
+    def request_key(request: dict) -> str:
+        """Hashes a request, whatever the order of its parameters."""
+        content = json.dumps(request, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    def submit(self, request: dict, job_id: str | None = None, key: str | None = None) -> str:
+        """Queues a job, unless a job of the same key is queued, running or done.
+
+        Args:
+            request (dict): The parameters of the job, JSON serializable and without secrets.
+            job_id (str | None, optional): The job's id. Defaults to a new random id.
+            key (str | None, optional): The key of the job, see `request_key`. Defaults to None, always queued.
+
+        Returns:
+            str: The job's id, the id of the previous job of the same key if there is one.
+        """
+        job_id = job_id or uuid.uuid4().hex
+        with self.lock, self.conn:
+            if key is not None:
+                row = self.conn.execute(
+                    """SELECT id FROM jobs WHERE key = ? AND status != 'failed'
+                    ORDER BY created_at DESC LIMIT 1""",
+                    (key,),
+                ).fetchone()
+                if row is not None:
+                    return row[0]
+            self.conn.execute(
+                "INSERT INTO jobs (id, status, request, created_at, key) VALUES (?, 'queued', ?, ?, ?)",
+                (job_id, json.dumps(request, ensure_ascii=False), time.time(), key),
+            )
+        return job_id
+
+    def claim(self, owner: str) -> tuple[str, dict] | None:
+        """Marks the oldest queued job, or running job whose lease has expired, as running under the lease of a worker.
+
+        Args:
+            owner (str): The id of the claiming worker.
+
+        Returns:
+            tuple[str, dict] | None: The job's id and request, None if no job is queued.
+        """
+        now = time.time()
+        with self.lock, self.conn:
+            row = self.conn.execute(
+                """UPDATE jobs SET status = 'running', started_at = ?, owner = ?, heartbeat = ?
+                WHERE id = (
+                    SELECT id FROM jobs
+                    WHERE status = 'queued'
+                    OR (status = 'running' AND (heartbeat IS NULL OR heartbeat < ?))
+                    ORDER BY created_at LIMIT 1
+                )
+                RETURNING id, request""",
+                (now, owner, now, now - self.lease),
+            ).fetchone()
+        if row is None:
+            return None
+        return row[0], json.loads(row[1])
+
+    def renew(self, owner: str) -> int:
+        """Renews the leases of the jobs a worker is running.
+
+        Args:
+            owner (str): The id of the worker.
+
+        Returns:
+            int: The number of jobs renewed.
+        """
+        with self.lock, self.conn:
+            cursor = self.conn.execute(
+                "UPDATE jobs SET heartbeat = ? WHERE owner = ? AND status = 'running'",
+                (time.time(), owner),
+            )
+        return cursor.rowcount
+
+    def release(self, owner: str) -> int:
+        """Queues again the jobs a worker is running, when it stops before finishing them.
+
+        Args:
+            owner (str): The id of the worker.
+
+        Returns:
+            int: The number of jobs queued again.
+        """
+        with self.lock, self.conn:
+            cursor = self.conn.execute(
+                """UPDATE jobs SET status = 'queued', started_at = NULL, owner = NULL, heartbeat = NULL
+                WHERE owner = ? AND status = 'running'""",
+                (owner,),
+            )
+        return cursor.rowcount
+
+    def finish(self, job_id: str, owner: str, result: object = None, error: str | None = None) -> bool:
+        """Records the result, or the error, of a job, unless its worker lost the job's lease.
+
+        Args:
+            job_id (str): The job's id.
+            owner (str): The id of the worker that ran the job.
+            result (object, optional): The result, JSON serializable. Defaults to None.
+            error (str | None, optional): The error, the job failed if given. Defaults to None.
+
+        Returns:
+            bool: True if recorded, False if the job was claimed again by another worker.
+        """
+        with self.lock, self.conn:
+            cursor = self.conn.execute(
+                """UPDATE jobs SET status = ?, result = ?, error = ?, finished_at = ?, owner = NULL, heartbeat = NULL
+                WHERE id = ? AND owner = ? AND status = 'running'""",
+                (
+                    "failed" if error is not None else "done",
+                    json.dumps(result, ensure_ascii=False) if error is None else None,
+                    error,
+                    time.time(),
+                    job_id,
+                    owner,
+                ),
+            )
+        return cursor.rowcount == 1
+
+    def queued(self, job_ids: list[str]) -> set[str]:
+        """Gives the jobs still waiting for a worker among some jobs.
+
+        Args:
+            job_ids (list[str]): The jobs' ids.
+
+        Returns:
+            set[str]: The ids of the queued jobs.
+        """
+        if not job_ids:
+            return set()
+        with self.lock:
+            rows = self.conn.execute(
+                f"SELECT id FROM jobs WHERE status = 'queued' AND id IN ({', '.join('?' * len(job_ids))})",
+                job_ids,
+            ).fetchall()
+        return {row[0] for row in rows}
+
+    def get(self, job_id: str) -> dict | None:
+        """Gets a job.
+
+        Args:
+            job_id (str): The job's id.
+
+        Returns:
+            dict | None: The job's id, status, request, result, error and times, None if it doesn't exist.
+        """
+        with self.lock:
+            row = self.conn.execute(
+                """SELECT id, status, request, result, error, created_at, started_at, finished_at
+                FROM jobs WHERE id = ?""",
+                (job_id,),
+            ).fetchone()
+        if row is None:
+            return None
+        return {
+            "id": row[0],
+            "status": row[1],
+            "request": json.loads(row[2]),
+            "result": json.loads(row[3]) if row[3] is not None else None,
+            "error": row[4],
+            "created_at": row[5],
+            "started_at": row[6],
+            "finished_at": row[7],
+        }
+
+    def close(self):
+        """Closes the connection to the store."""
+        with self.lock:
+            self.conn.close()
+
+
+class JobQueue:
+    """Runs the jobs of a `JobStore` with a pool of asyncio workers.
+
+    The secrets of a job are kept in memory only, until a worker claims it: a job claimed again after a restart,
+    or by another process, runs without them. The secrets of the jobs claimed by another process are dropped
+    once they are older than a lease. Idle workers are woken by a submission, and check the store every
+    `poll_interval` for the jobs submitted by other processes, or whose lease has expired. The leases of the running
+    jobs are renewed a few times per lease, so several servers can share a store: the jobs of a crashed server are
+    claimed again once their lease has expired, those of a stopped server at once.
+
+    Args:
+        store (JobStore): The jobs.
+        handler (Callable[[dict, dict], Awaitable[object]]): Runs a job from its request and secrets, returning its result.
+        workers (int, optional): The number of jobs run at once. Defaults to 2.
+        poll_interval (float, optional): The seconds between two checks of the store by an idle worker. Defaults to 1.0.
+    """
+
+    def __init__(self, store: JobStore, handler, workers: int = 2, poll_interval: float = 1.0):
+        self.store = store
+        self.handler = handler
+        self.workers = max(1, workers)
+        self.poll_interval = poll_interval
+        # the secrets of the jobs submitted to this queue, with their submission time
+        self.secrets: dict[str, tuple[dict, float]] = {}
+        # the id of this queue in the leases of its jobs
+        self.owner = uuid.uuid4().hex
+        self.tasks: list[asyncio.Task] = []
+        self.wakeup: asyncio.Event | None = None
+
+    async def submit(self, request: dict, secrets: dict | None = None, key: str | None = None) -> str:
+        """Queues a job, see `JobStore.submit`.
+
+        Args:
+            request (dict): The parameters of the job, stored.
+            secrets (dict | None, optional): The secrets of the job, such as a token, never stored. Defaults to None.
+            key (str | None, optional): The key of the job, a previous job of the same key is given instead. Defaults to None.
+
+        Returns:
+            str: The job's id.
+        """
+        job_id = uuid.uuid4().hex
+        if secrets:
+            # before the job is stored, a worker may claim it at once
+            self.secrets[job_id] = (secrets, time.monotonic())
+        submitted = await asyncio.to_thread(self.store.submit, request, job_id, key)
+        if submitted != job_id:
+            self.secrets.pop(job_id, None)
+        elif self.wakeup is not None:
+            self.wakeup.set()
+        return submitted
+
+    async def start(self):
+        """Starts the workers and the renewal of their leases."""
+        self.wakeup = asyncio.Event()
+        self.tasks = [asyncio.create_task(self.work()) for _ in range(self.workers)]
+        self.tasks.append(asyncio.create_task(self.renew()))
+
+    async def stop(self):
+        """Stops the workers, the jobs they were running are queued again."""
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        released = await asyncio.to_thread(self.store.release, self.owner)
+        if released:
+            print(f"[INFO] {released} interrupted jobs queued again.")
+
+    async def renew(self):
+        while True:
+            await asyncio.sleep(self.store.lease / 3)
+            try:
+                await asyncio.to_thread(self.store.renew, self.owner)
+                await self.drop_secrets()
+            except sqlite3.Error as e:
+                print(f"[ERROR] Failed to renew the job leases: {e}")
+
+    async def drop_secrets(self):
+        """Drops the secrets older than a lease whose job is no longer queued, claimed or finished by another process."""
+        expired = time.monotonic() - self.store.lease
+        old = [job_id for job_id, (_, submitted) in self.secrets.items() if submitted < expired]
+        queued = await asyncio.to_thread(self.store.queued, old)
+        for job_id in old:
+            if job_id not in queued:
+                self.secrets.pop(job_id, None)
+
+    async def work(self):
+        while True:
+            self.wakeup.clear()
+            claimed = await asyncio.to_thread(self.store.claim, self.owner)
+            if claimed is None:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            job_id, request = claimed
+            secrets, _ = self.secrets.pop(job_id, ({}, None))
+            try:
+                result = await self.handler(request, secrets)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"[ERROR] Job {job_id} failed: {e}")
+                finished = await asyncio.to_thread(
+                    self.store.finish, job_id, self.owner, None, str(e) or type(e).__name__
+                )
+            else:
+                finished = await asyncio.to_thread(self.store.finish, job_id, self.owner, result)
+            if not finished:
+                print(f"[WARNING] Job {job_id} was claimed again by another worker, its result is dropped.")
+            self.secrets.pop(job_id, None)
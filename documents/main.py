@@ -1,15 +1,32 @@
 from dotenv import load_dotenv
-from util import write_functions_to_json
+from util import (
+    latest_functions_json,
+    read_functions_from_json,
+    write_functions_to_json,
+)
 from gentleman_llm import GentlemanLLM
+from cache import ExtractionCache, ResponseCache, ResultStore
+from clients import ClientRegistry
 import os
 
 if __name__ == "__main__":
     load_dotenv()
+    clients = ClientRegistry()
     service = GentlemanLLM(
         model="meta-llama/Llama-3.1-70B-Instruct",
-        hf_token=os.getenv("HF_TOKEN")
+        hf_token=os.getenv("HF_TOKEN"),
+        cache=ResponseCache(),
+        result_store=ResultStore(),
+        extraction_cache=ExtractionCache(path="cache/extractions"),
+        clients=clients,
     )
-    names = ["master","__init__", "annuaire_parser","repertoire_parser","schedule_parser","udem_info_parser","xlsx2csv"] 
-    for name in names:
-        result = service.analyze_file(f"./code/{name}.py")
-        write_functions_to_json(result, f"{name}.json")
+    try:
+        names = ["master","__init__", "annuaire_parser","repertoire_parser","schedule_parser","udem_info_parser","xlsx2csv"] 
+        for name in names:
+            last_output = latest_functions_json(name)
+            previous = read_functions_from_json(last_output) if last_output else None
+            result = service.analyze_file(f"./code/{name}.py", previous=previous)
+            write_functions_to_json(result, f"{name}.json")
+    finally:
+        clients.close()
+    print(f"LLM answers: {service.repair_stats.summary()}.")
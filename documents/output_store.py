@@ -0,0 +1,167 @@
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+
+# a versioned output, "name_3.json"
+VERSIONED = re.compile(r"^(.+)_(\d+)\.(\w+)$")
+
+
+class OutputStore:
+    """Versioned outputs of a directory, numbered by a SQLite manifest instead of listing the directory.
+
+    Each output name has a counter: allocating a version is a single upsert, safe across threads and processes,
+    and the last complete version is read without listing the directory. Files are written to a temporary file
+    then renamed, so a reader never sees a partial output.
+    The manifest is created from the versions already in the directory, listed once.
+
+    Args:
+        directory (str): The directory of the outputs.
+        manifest (str, optional): The name of the manifest in the directory. Defaults to ".versions.sqlite".
+    """
+
+    def __init__(self, directory: str, manifest: str = ".versions.sqlite"):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.path = os.path.join(directory, manifest)
+        self.lock = threading.Lock()
+        existed = os.path.exists(self.path)
+        self.conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS versions (
+                key TEXT PRIMARY KEY,
+                allocated INTEGER NOT NULL,
+                written INTEGER NOT NULL
+            )"""
+        )
+        self.conn.commit()
+        if not existed:
+            self.seed()
+
+    @staticmethod
+    def key(name: str, ext: str) -> str:
+        """Gives the manifest key of an output, "name.ext"."""
+        return f"{name}.{ext}"
+
+    def seed(self):
+        """Records the versions already in the directory, written before the manifest."""
+        versions = {}
+        for entry in os.listdir(self.directory):
+            match = VERSIONED.match(entry)
+            if match is None or entry.startswith("."):
+                continue
+            if not os.path.isfile(os.path.join(self.directory, entry)):
+                continue
+            key = self.key(match.group(1), match.group(3))
+            versions[key] = max(versions.get(key, 0), int(match.group(2)))
+        with self.lock, self.conn:
+            self.conn.executemany(
+                """INSERT INTO versions (key, allocated, written) VALUES (?, ?, ?)
+                ON CONFLICT (key) DO UPDATE SET
+                    allocated = MAX(allocated, excluded.allocated),
+                    written = MAX(written, excluded.written)""",
+                [(key, version, version) for key, version in versions.items()],
+            )
+
+    def allocate(self, name: str, ext: str) -> str:
+        """Reserves the next version of an output.
+
+        Args:
+            name (str): The output's name, such as "master_func_concepts".
+            ext (str): The extension of the file, such as "json".
+
+        Returns:
+            str: The path of the version, such as "results/master_func_concepts_4.json".
+        """
+        with self.lock, self.conn:
+            (version,) = self.conn.execute(
+                """INSERT INTO versions (key, allocated, written) VALUES (?, 1, 0)
+                ON CONFLICT (key) DO UPDATE SET allocated = allocated + 1
+                RETURNING allocated""",
+                (self.key(name, ext),),
+            ).fetchone()
+        return os.path.join(self.directory, f"{name}_{version}.{ext}")
+
+    def written(self, name: str, ext: str, path: str):
+        """Records a version as complete, the last one becoming the latest.
+
+        Args:
+            name (str): The output's name.
+            ext (str): The extension of the file.
+            path (str): The path of the version, see `allocate`.
+        """
+        version = int(VERSIONED.match(os.path.basename(path)).group(2))
+        with self.lock, self.conn:
+            self.conn.execute(
+                "UPDATE versions SET written = MAX(written, ?) WHERE key = ?",
+                (version, self.key(name, ext)),
+            )
+
+    def write(self, name: str, content: str, ext: str = "json") -> str:
+        """Writes the next version of an output file, atomically.
+
+        Args:
+            name (str): The output's name.
+            content (str): The content of the file.
+            ext (str, optional): The extension of the file. Defaults to "json".
+
+        Returns:
+            str: The path of the written version.
+        """
+        path = self.allocate(name, ext)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=".tmp-", suffix=f".{ext}")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self.written(name, ext, path)
+        return path
+
+    def latest(self, name: str, ext: str) -> str | None:
+        """Gives the last complete version of an output.
+
+        Args:
+            name (str): The output's name.
+            ext (str): The extension of the file.
+
+        Returns:
+            str | None: The path of the version, None if there is none or it was deleted.
+        """
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT written FROM versions WHERE key = ?", (self.key(name, ext),)
+            ).fetchone()
+        if row is None or row[0] == 0:
+            return None
+        path = os.path.join(self.directory, f"{name}_{row[0]}.{ext}")
+        return path if os.path.exists(path) else None
+
+    def close(self):
+        """Closes the connection to the manifest."""
+        with self.lock:
+            self.conn.close()
+
+
+stores: dict[str, OutputStore] = {}
+stores_lock = threading.Lock()
+
+
+def output_store(directory: str) -> OutputStore:
+    """Gives the store of a directory, shared by the whole process.
+
+    Args:
+        directory (str): The directory of the outputs.
+
+    Returns:
+        OutputStore: The store.
+    """
+    key = os.path.abspath(directory)
+    with stores_lock:
+        if key not in stores:
+            stores[key] = OutputStore(directory)
+        return stores[key]
@@ -0,0 +1,356 @@
+import argparse
+import json
+import os
+import threading
+
+from context import FileContext
+from util import list_files, parse_module, read_file
+
+# imports followed through the re-exports of packages, such as "from .mod import f" in an __init__.py
+MAX_REEXPORTS = 8
+
+
+def module_name(filepath: str, root: str | None = None) -> str:
+    """Gives the dotted name of a module from its path in the analyzed tree.
+
+    Args:
+        filepath (str): The path of the file.
+        root (str | None, optional): The analyzed directory, the path is made relative to it. If None, only the file's name is kept. Defaults to None.
+
+    Returns:
+        str: The module's name, "pkg/mod.py" gives "pkg.mod" and "pkg/__init__.py" gives "pkg".
+    """
+    rel_path = os.path.relpath(filepath, root) if root else os.path.basename(filepath)
+    parts = os.path.splitext(rel_path)[0].replace(os.sep, "/").split("/")
+    if parts[-1] == "__init__" and len(parts) > 1:
+        parts.pop()
+    return ".".join(parts)
+
+
+class ProjectIndex:
+    """Indexes the functions of a tree of modules and the calls between them, across files.
+
+    A function is named by its module and qualified name, such as "annuaire_parser.parse" or "pkg.mod.Class.method".
+    The calls resolved within a file by `ModuleVisitor` are kept, and its unresolved calls are followed through
+    the imports of the file: `import mod` then `mod.f()`, `from mod import f as g` then `g()`, relative imports,
+    `mod.Class()` to its `__init__`, and names re-exported by a package.
+
+    Files are added one at a time, in any order: a call to a module not indexed yet waits for it, and adding
+    a file again replaces its previous version. The calls through a re-export are resolved when linked,
+    replacing the re-exporting package keeps them. The callers and callees of a function are read from dictionnaries.
+    """
+
+    def __init__(self):
+        # the indexed modules: their functions, import targets, and if they are packages
+        self.modules: dict[str, dict] = {}
+        self.functions: set[str] = set()
+        self.calls: dict[str, set[str]] = {}
+        self.called_by: dict[str, set[str]] = {}
+        # the dotted targets of the calls of each function leaving its file, as imported
+        self.targets: dict[str, set[str]] = {}
+        # the callers of each target not indexed yet, and the waiting targets under each dotted prefix
+        self.waiting: dict[str, set[str]] = {}
+        self.waiting_under: dict[str, set[str]] = {}
+        # the waited targets of each caller
+        self.waiting_for: dict[str, set[str]] = {}
+        self.lock = threading.Lock()
+
+    def add_file(self, filepath: str, root: str | None = None) -> str:
+        """Parses a Python file and indexes it, see `add_module`.
+
+        Args:
+            filepath (str): The path of the file.
+            root (str | None, optional): The analyzed directory, giving the module's name, see `module_name`. Defaults to None.
+
+        Returns:
+            str: The module's name.
+        """
+        module = module_name(filepath, root)
+        visitor = parse_module(read_file(filepath), filepath)
+        self.add_module(
+            module,
+            visitor.functions,
+            visitor.import_targets,
+            visitor.unresolved,
+            is_package=os.path.basename(filepath) == "__init__.py",
+        )
+        return module
+
+    def add_context(self, filepath: str, file_context: FileContext, root: str | None = None) -> str:
+        """Indexes a Python file already extracted, without parsing it again, see `add_module`.
+
+        Args:
+            filepath (str): The path of the file.
+            file_context (FileContext): The context of the file, from its extraction.
+            root (str | None, optional): The analyzed directory, giving the module's name, see `module_name`. Defaults to None.
+
+        Returns:
+            str: The module's name.
+        """
+        module = module_name(filepath, root)
+        self.add_module(
+            module,
+            list(file_context.functions.values()),
+            file_context.import_targets,
+            file_context.unresolved,
+            is_package=os.path.basename(filepath) == "__init__.py",
+        )
+        return module
+
+    def add_module(
+        self,
+        module: str,
+        functions: list[dict],
+        import_targets: dict[str, str],
+        unresolved: dict[str, list[tuple[str | None, str]]],
+        is_package: bool = False,
+    ):
+        """Indexes the functions of a module and their calls, replacing a previous version of the module.
+
+        Args:
+            module (str): The module's dotted name.
+            functions (list[dict]): The function dictionnaries of the module, see `ModuleVisitor`.
+            import_targets (dict[str, str]): The dotted target of each name bound by an import of the module.
+            unresolved (dict[str, list[tuple[str | None, str]]]): The calls of each function not resolved in the module, by qualified name.
+            is_package (bool, optional): If True, the module is the `__init__.py` of a package, for its relative imports. Defaults to False.
+        """
+        with self.lock:
+            if module in self.modules:
+                self.remove(module)
+
+            names = [f"{module}.{f['qualname']}" for f in functions]
+            self.modules[module] = {
+                "functions": names,
+                "import_targets": dict(import_targets),
+                "is_package": is_package,
+            }
+            self.functions.update(names)
+            for name in names:
+                self.calls[name] = set()
+                self.called_by[name] = set()
+
+            for name, f in zip(names, functions):
+                for callee in f["calls"]:
+                    self.link(name, f"{module}.{callee}")
+                for base, called in unresolved.get(f["qualname"], []):
+                    target = self.import_target(module, base, called)
+                    if target is not None:
+                        self.targets.setdefault(name, set()).add(target)
+                        self.link(name, target)
+
+            # the calls waiting for a target in the module: its functions, classes, or the names it re-exports
+            for target in self.waiting_under.pop(module, set()):
+                for caller in self.unwait(target):
+                    self.link(caller, target)
+
+    def remove(self, module: str):
+        """Removes a module from the index, the calls to its functions waiting again for them.
+
+        Args:
+            module (str): The module's dotted name.
+        """
+        removed = set(self.modules.pop(module)["functions"])
+        self.functions -= removed
+
+        callers = set()
+        for name in removed:
+            for callee in self.calls.pop(name, set()):
+                if callee in self.called_by:
+                    self.called_by[callee].discard(name)
+            callers |= self.called_by.pop(name, set())
+            self.targets.pop(name, None)
+            for target in self.waiting_for.pop(name, set()):
+                self.unwait(target, name)
+
+        for caller in callers - removed:
+            self.calls[caller] -= removed
+            for target in self.targets.get(caller, set()):
+                self.link(caller, target)
+
+    def import_target(self, module: str, base: str | None, name: str) -> str | None:
+        """Gives the dotted target of a call through the imports of its module.
+
+        Args:
+            module (str): The calling module.
+            base (str | None): The dotted name of the called object, "" for an expression, None for `name()`.
+            name (str): The name called.
+
+        Returns:
+            str | None: The absolute dotted name called, such as "mod.f", None if the call doesn't go through an import.
+        """
+        import_targets = self.modules[module]["import_targets"]
+        if base is None:
+            if name not in import_targets:
+                return None
+            target = import_targets[name]
+        else:
+            root, _, rest = base.partition(".")
+            if root not in import_targets:
+                return None
+            target = ".".join(part for part in (import_targets[root], rest, name) if part)
+        return self.absolute(module, target)
+
+    def absolute(self, module: str, target: str) -> str:
+        """Resolves a relative import target against the importing module.
+
+        Args:
+            module (str): The importing module.
+            target (str): The target, such as ".mod.f" or "..f".
+
+        Returns:
+            str: The absolute target.
+        """
+        level = len(target) - len(target.lstrip("."))
+        if level == 0:
+            return target
+        package = module.split(".")
+        if not self.modules.get(module, {}).get("is_package"):
+            package = package[:-1]
+        package = package[: len(package) - (level - 1)] if level > 1 else package
+        return ".".join([*package, target[level:]]) if target[level:] else ".".join(package)
+
+    def resolve(self, target: str) -> tuple[str | None, str]:
+        """Gives the indexed function a dotted target refers to, a class giving its `__init__`.
+
+        Args:
+            target (str): The absolute dotted target.
+
+        Returns:
+            tuple[str | None, str]: The function's name, None if it isn't indexed (yet),
+            and the target after following the re-exports, the one to wait for.
+        """
+        for _ in range(MAX_REEXPORTS):
+            if target in self.functions:
+                return target, target
+            if f"{target}.__init__" in self.functions:
+                return f"{target}.__init__", target
+
+            # a name imported by an indexed module, such as a package re-exporting it
+            parts = target.split(".")
+            for i in range(len(parts) - 1, 0, -1):
+                module = ".".join(parts[:i])
+                if module in self.modules:
+                    imported = self.modules[module]["import_targets"].get(parts[i])
+                    break
+            else:
+                return None, target
+            if imported is None:
+                return None, target
+            target = ".".join([self.absolute(module, imported), *parts[i + 1 :]])
+        return None, target
+
+    def link(self, caller: str, target: str):
+        """Adds the call of a target, or makes it wait for the target to be indexed."""
+        callee, target = self.resolve(target)
+        if callee is not None:
+            self.calls[caller].add(callee)
+            self.called_by[callee].add(caller)
+            return
+        self.waiting_for.setdefault(caller, set()).add(target)
+        if target not in self.waiting:
+            self.waiting[target] = set()
+            parts = target.split(".")
+            for i in range(1, len(parts)):
+                self.waiting_under.setdefault(".".join(parts[:i]), set()).add(target)
+        self.waiting[target].add(caller)
+
+    def unwait(self, target: str, caller: str | None = None) -> set[str]:
+        """Stops a caller, or all the callers, from waiting for a target.
+
+        Args:
+            target (str): The target.
+            caller (str | None, optional): The caller, None for all of them. Defaults to None.
+
+        Returns:
+            set[str]: The callers that stopped waiting.
+        """
+        callers = self.waiting.get(target, set())
+        removed = callers.copy() if caller is None else callers & {caller}
+        callers -= removed
+        for name in removed:
+            self.waiting_for.get(name, set()).discard(target)
+        if not callers and target in self.waiting:
+            del self.waiting[target]
+            parts = target.split(".")
+            for i in range(1, len(parts)):
+                under = self.waiting_under.get(".".join(parts[:i]))
+                if under is not None:
+                    under.discard(target)
+                    if not under:
+                        del self.waiting_under[".".join(parts[:i])]
+        return removed
+
+    def callers(self, name: str) -> set[str]:
+        """Gives the functions calling a function.
+
+        Args:
+            name (str): The function's name, such as "annuaire_parser.parse".
+
+        Returns:
+            set[str]: The names of its callers, empty if the function isn't indexed.
+        """
+        with self.lock:
+            return set(self.called_by.get(name, ()))
+
+    def callees(self, name: str) -> set[str]:
+        """Gives the indexed functions called by a function.
+
+        Args:
+            name (str): The function's name, such as "master.main".
+
+        Returns:
+            set[str]: The names of the functions it calls, empty if the function isn't indexed.
+        """
+        with self.lock:
+            return set(self.calls.get(name, ()))
+
+    def to_json(self) -> dict:
+        """Gives the call graph of the index.
+
+        Returns:
+            dict: The sorted "calls" and "called_by" of each indexed function.
+        """
+        with self.lock:
+            return {
+                "calls": {name: sorted(self.calls[name]) for name in sorted(self.functions)},
+                "called_by": {name: sorted(self.called_by[name]) for name in sorted(self.functions)},
+            }
+
+
+def index_directory(directory: str) -> ProjectIndex:
+    """Indexes the Python files of a directory, searched recursively.
+
+    Args:
+        directory (str): The directory, the root of the modules' names.
+
+    Returns:
+        ProjectIndex: The index.
+    """
+    index = ProjectIndex()
+    for f in list_files(directory, recursive=True):
+        if f.endswith(".py"):
+            try:
+                index.add_file(os.path.join(directory, f), directory)
+            except SyntaxError as e:
+                print(f"[ERROR] {f} can't be parsed: {e}")
+    return index
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Builds the call graph of the Python files of a directory.")
+    parser.add_argument("directory", help="The directory, the root of the modules' names.")
+    parser.add_argument("--callers", help="Lists the callers of a function, such as annuaire_parser.parse.")
+    parser.add_argument("--callees", help="Lists the functions called by a function, such as master.main.")
+    args = parser.parse_args()
+
+    index = index_directory(args.directory)
+    if args.callers:
+        print(json.dumps(sorted(index.callers(args.callers)), indent=4))
+    elif args.callees:
+        print(json.dumps(sorted(index.callees(args.callees)), indent=4))
+    else:
+        print(json.dumps(index.to_json(), indent=4, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
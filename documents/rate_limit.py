@@ -0,0 +1,250 @@
+import asyncio
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+from openai import APIConnectionError, APIError, APIStatusError, RateLimitError
+
+
+def is_rate_limit_error(e: Exception) -> bool:
+    """Checks if an exception returned by the LLM provider is a rate limit or quota error.
+
+    Args:
+        e (Exception): The exception returned.
+
+    Returns:
+        bool: True if the request was refused because of a rate limit or exceeded credits.
+    """
+    if isinstance(e, RateLimitError) or getattr(e, "status_code", None) == 429:
+        return True
+    if not isinstance(e, APIError):
+        return False
+    err = str(e).lower()
+    return "rate limit" in err or "exceeded" in err
+
+
+def is_transient_error(e: Exception) -> bool:
+    """Checks if an exception is a failure of the provider or of the connection, the same query may succeed later.
+
+    Args:
+        e (Exception): The exception returned.
+
+    Returns:
+        bool: True for a connection error, a timeout, or a server error (408, 409 or 5xx).
+    """
+    if isinstance(e, APIConnectionError):
+        return True
+    if not isinstance(e, APIStatusError):
+        return False
+    return e.status_code >= 500 or e.status_code in (408, 409)
+
+
+def retry_after(e: Exception) -> float | None:
+    """Reads the delay asked by the provider before retrying, from the `Retry-After` headers of the response.
+
+    Args:
+        e (Exception): The exception returned.
+
+    Returns:
+        float | None: The delay in seconds, or None if the provider didn't give one.
+    """
+    response = getattr(e, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+
+    value = headers.get("retry-after-ms")
+    if value is not None:
+        try:
+            return max(0.0, float(value) / 1000)
+        except ValueError:
+            pass
+
+    value = headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt: int, base: float = 1.0, cap: float = 60.0) -> float:
+    """Gives a random delay before retrying a request, growing exponentially with the attempts ("full jitter").
+
+    Args:
+        attempt (int): The number of times the request was refused.
+        base (float, optional): The delay of the first attempt, in seconds. Defaults to 1.0.
+        cap (float, optional): The maximum delay, in seconds. Defaults to 60.0.
+
+    Returns:
+        float: The delay in seconds.
+    """
+    return random.uniform(0, min(cap, base * 2**attempt))
+
+
+def estimate_tokens(messages: list[dict], completion_tokens: int = 256) -> int:
+    """Estimates the number of tokens used by a chat completion, about 4 characters per token.
+
+    Args:
+        messages (list[dict]): The messages sent.
+        completion_tokens (int, optional): The expected length of the answer. Defaults to 256.
+
+    Returns:
+        int: The estimated number of tokens.
+    """
+    return sum(len(m["content"]) for m in messages) // 4 + completion_tokens
+
+
+class RateLimiter:
+    """Limits the requests sent to the LLM provider, shared by every request of the process.
+
+    Requests are bounded by two token buckets, requests per second and tokens per minute, and by a concurrency limit.
+    The concurrency limit adapts to the provider (AIMD): it grows by one every `limit` successful requests,
+    and is multiplied by `decrease` when a request is rate limited or fails on the provider's side, see `is_transient_error`.
+    A `Retry-After` pauses every request.
+
+    Args:
+        requests_per_second (float | None, optional): The request budget, None for no limit. Defaults to None.
+        tokens_per_minute (float | None, optional): The token budget, None for no limit. Defaults to None.
+        max_concurrency (int, optional): The maximum number of requests running at once. Defaults to 16.
+        min_concurrency (int, optional): The minimum concurrency limit. Defaults to 1.
+        decrease (float, optional): The factor applied to the concurrency limit on a rate limit. Defaults to 0.5.
+    """
+
+    def __init__(
+        self,
+        requests_per_second: float | None = None,
+        tokens_per_minute: float | None = None,
+        max_concurrency: int = 16,
+        min_concurrency: int = 1,
+        decrease: float = 0.5,
+    ):
+        self.requests_per_second = requests_per_second
+        self.tokens_per_minute = tokens_per_minute
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min(min_concurrency, max_concurrency)
+        self.decrease = decrease
+
+        self.limit = float(max_concurrency)
+        self.in_flight = 0
+        self.request_tokens = requests_per_second or 0.0
+        self.budget_tokens = tokens_per_minute or 0.0
+        self.refilled_at = time.monotonic()
+        self.paused_until = 0.0
+        self.rate_limited = 0
+        self.condition = threading.Condition()
+
+    def refill(self, now: float):
+        """Refills the token buckets for the time elapsed. Called with the lock held.
+
+        Args:
+            now (float): The current monotonic time.
+        """
+        elapsed = now - self.refilled_at
+        self.refilled_at = now
+        if self.requests_per_second:
+            self.request_tokens = min(
+                self.requests_per_second,
+                self.request_tokens + elapsed * self.requests_per_second,
+            )
+        if self.tokens_per_minute:
+            self.budget_tokens = min(
+                self.tokens_per_minute,
+                self.budget_tokens + elapsed * self.tokens_per_minute / 60,
+            )
+
+    def try_acquire(self, tokens: int = 0) -> float:
+        """Takes a slot for a request if the budgets and the concurrency limit allow it.
+
+        Args:
+            tokens (int, optional): The estimated number of tokens of the request. Defaults to 0.
+
+        Returns:
+            float: 0 if the slot was taken, otherwise the time to wait before trying again, in seconds.
+        """
+        with self.condition:
+            now = time.monotonic()
+            self.refill(now)
+
+            if now < self.paused_until:
+                return self.paused_until - now
+            if self.in_flight >= int(self.limit):
+                return 0.05
+            if self.requests_per_second and self.request_tokens < 1:
+                return (1 - self.request_tokens) / self.requests_per_second
+            # a request larger than the whole budget only waits for a full bucket
+            tokens = min(tokens, self.tokens_per_minute or 0)
+            if self.tokens_per_minute and self.budget_tokens < tokens:
+                return (tokens - self.budget_tokens) * 60 / self.tokens_per_minute
+
+            self.in_flight += 1
+            if self.requests_per_second:
+                self.request_tokens -= 1
+            if self.tokens_per_minute:
+                self.budget_tokens -= tokens
+            return 0.0
+
+    def acquire(self, tokens: int = 0):
+        """Waits for a slot for a request.
+
+        Args:
+            tokens (int, optional): The estimated number of tokens of the request. Defaults to 0.
+        """
+        while True:
+            wait = self.try_acquire(tokens)
+            if wait == 0:
+                return
+            with self.condition:
+                self.condition.wait(timeout=wait)
+
+    async def acquire_async(self, tokens: int = 0):
+        """Waits for a slot for a request, without blocking the event loop.
+
+        Args:
+            tokens (int, optional): The estimated number of tokens of the request. Defaults to 0.
+        """
+        while True:
+            wait = self.try_acquire(tokens)
+            if wait == 0:
+                return
+            await asyncio.sleep(wait)
+
+    def release(
+        self,
+        estimated_tokens: int = 0,
+        used_tokens: int | None = None,
+        error: Exception | None = None,
+    ):
+        """Frees the slot of a finished request and adapts the concurrency limit to its outcome.
+
+        Args:
+            estimated_tokens (int, optional): The number of tokens taken by `acquire`. Defaults to 0.
+            used_tokens (int | None, optional): The number of tokens actually used, when the provider gives it. Defaults to None.
+            error (Exception | None, optional): The exception of the request, if it failed. Defaults to None.
+        """
+        with self.condition:
+            self.in_flight -= 1
+
+            if self.tokens_per_minute and used_tokens is not None:
+                # give back, or take, the difference with the estimate
+                self.budget_tokens = min(
+                    self.tokens_per_minute,
+                    self.budget_tokens + estimated_tokens - used_tokens,
+                )
+
+            if error is not None and (is_rate_limit_error(error) or is_transient_error(error)):
+                self.rate_limited += 1
+                self.limit = max(self.min_concurrency, self.limit * self.decrease)
+                delay = retry_after(error)
+                if delay:
+                    self.paused_until = max(self.paused_until, time.monotonic() + delay)
+            elif error is None:
+                self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+
+            self.condition.notify_all()
@@ -0,0 +1,256 @@
+import difflib
+import re
+import threading
+
+from type_grammar import split_top_level
+
+class RepairStats:
+    """Counts how the answers of the LLM passed their check, shared by every query of a service.
+
+    An answer is either valid as given, repaired locally by `repairing`, or failed and retried with a new query.
+    """
+
+    def __init__(self):
+        self.valid = 0
+        self.repaired = 0
+        self.retried = 0
+        self.lock = threading.Lock()
+
+    def record(self, outcome: str):
+        """Counts an answer.
+
+        Args:
+            outcome (str): "valid", "repaired" or "retried".
+        """
+        with self.lock:
+            setattr(self, outcome, getattr(self, outcome) + 1)
+
+    def summary(self) -> str:
+        """Describes the counts, the repaired answers being queries saved."""
+        return f"{self.valid} valid answers, {self.repaired} repaired, {self.retried} retried"
+
+
+def strip_fences(answer: str) -> str:
+    """Removes the code fences, backticks and blank space around an answer.
+
+    Args:
+        answer (str): The answer.
+
+    Returns:
+        str: The answer without its fences.
+    """
+    cleaned = answer.strip()
+    cleaned = re.sub(r"^```\w*\s*|\s*```$", "", cleaned).strip()
+    return cleaned.strip("`").strip()
+
+
+def first_literal(answer: str) -> str | None:
+    """Extracts the first bracketed literal of an answer, a list or an object, ignoring the prose around it.
+
+    Args:
+        answer (str): The answer.
+
+    Returns:
+        str | None: The literal, None if the answer has no balanced brackets.
+    """
+    starts = [i for i in (answer.find("["), answer.find("{")) if i != -1]
+    if not starts:
+        return None
+    start = min(starts)
+    opening = answer[start]
+    closing = "]" if opening == "[" else "}"
+    depth = 0
+    quote = None
+    for i in range(start, len(answer)):
+        ch = answer[i]
+        if quote:
+            if ch == quote and answer[i - 1] != "\\":
+                quote = None
+        elif ch in "'\"":
+            quote = ch
+        elif ch == opening:
+            depth += 1
+        elif ch == closing:
+            depth -= 1
+            if depth == 0:
+                return answer[start : i + 1]
+    return None
+
+
+def answer_candidates(answer: str) -> list[str]:
+    """Lists the generic repairs of an answer: without fences, its first literal, and its first and last lines.
+
+    Args:
+        answer (str): The answer.
+
+    Returns:
+        list[str]: The repaired answers, without duplicates nor the answer itself.
+    """
+    cleaned = strip_fences(answer)
+    candidates = [cleaned]
+
+    literal = first_literal(cleaned)
+    if literal is not None:
+        candidates.append(literal)
+
+    lines = [line.strip() for line in cleaned.splitlines() if line.strip()]
+    if len(lines) > 1:
+        # a prose line before or after the answer
+        candidates += [lines[0], lines[-1]]
+    candidates += [c.strip("'\".,;: ") for c in list(candidates)]
+
+    unique = []
+    for c in candidates:
+        if c and c != answer and c not in unique:
+            unique.append(c)
+    return unique
+
+
+def closest(value: str, choices: list[str] | set[str], cutoff: float = 0.8) -> str | None:
+    """Gives the choice closest to a value, ignoring case, spaces and underscores.
+
+    Args:
+        value (str): The value.
+        choices (list[str] | set[str]): The valid choices.
+        cutoff (float, optional): The minimum similarity between 0 and 1. Defaults to 0.8.
+
+    Returns:
+        str | None: The closest choice, None if none is similar enough.
+    """
+
+    def key(text: str) -> str:
+        return re.sub(r"[\s_\-'\"`]", "", text).lower()
+
+    keys = {key(c): c for c in choices}
+    match = difflib.get_close_matches(key(value), list(keys), n=1, cutoff=cutoff)
+    return keys[match[0]] if match else None
+
+
+def type_candidates(answer: str, valid_types: set[str]) -> list[str]:
+    """Lists the repairs of a type, or list of types, answer. Typing aliases are left to the check, see `TypeParser`.
+
+    Args:
+        answer (str): The answer.
+        valid_types (set[str]): The accepted types, each type of the answer is matched to the closest.
+
+    Returns:
+        list[str]: The repaired answers.
+    """
+    candidates = answer_candidates(answer)
+
+    def match(t: str) -> str | None:
+        # a misspelled name, generics are left to the check
+        t = t.strip().strip("'\"")
+        if t in valid_types or not re.fullmatch(r"\w+", t):
+            return t
+        return closest(t, valid_types)
+
+    for c in [answer] + list(candidates):
+        literal = c.strip()
+        if literal.startswith("[") and literal.endswith("]"):
+            matched = [match(t) for t in split_top_level(literal[1:-1])]
+            if all(matched):
+                candidates.append(f"[{', '.join(matched)}]")
+        else:
+            matched = match(literal)
+            if matched:
+                candidates.append(matched)
+    return list(dict.fromkeys(c for c in candidates if c != answer))
+
+
+def tags_candidates(answer: str) -> list[str]:
+    """Lists the repairs of a list of tags answer, a comma separated text included.
+
+    Args:
+        answer (str): The answer.
+
+    Returns:
+        list[str]: The repaired answers.
+    """
+    candidates = answer_candidates(answer)
+    cleaned = strip_fences(answer)
+    if "[" not in cleaned and "," in cleaned:
+        tags = [t.strip().strip("'\"") for t in cleaned.split(",")]
+        candidates.append(repr([t for t in tags if t]))
+    return candidates
+
+
+def category_candidates(answer: str, categories: list[str]) -> list[str]:
+    """Lists the repairs of a category answer, the closest valid category included.
+
+    Args:
+        answer (str): The answer.
+        categories (list[str]): The valid categories.
+
+    Returns:
+        list[str]: The repaired answers.
+    """
+    candidates = answer_candidates(answer)
+    for c in [answer] + list(candidates):
+        match = closest(c, categories)
+        if match:
+            candidates.append(match)
+    # a sentence naming a single category
+    named = [c for c in categories if re.search(rf"\b{c}\b", answer, re.IGNORECASE)]
+    if len(named) == 1:
+        candidates.append(named[0])
+    return list(dict.fromkeys(c for c in candidates if c != answer))
+
+
+def description_candidates(answer: str, max_len: int) -> list[str]:
+    """Lists the repairs of a description answer, cut to `max_len` when it is a little too long.
+
+    The description is cut after its last whole sentence, or else its last whole word, fitting in `max_len`.
+    Descriptions over `max_len` by more than a quarter are not cut.
+
+    Args:
+        answer (str): The answer.
+        max_len (int): The maximum length of the description.
+
+    Returns:
+        list[str]: The repaired answers.
+    """
+    candidates = answer_candidates(answer)
+    for c in [answer] + list(candidates):
+        c = c.strip().strip("'\"")
+        if max_len < len(c) <= max_len * 1.25:
+            head = c[:max_len]
+            sentence_end = max(head.rfind(". "), head.rfind("! "), head.rfind("? "))
+            if sentence_end > 0:
+                candidates.append(head[: sentence_end + 1])
+            word_end = head.rfind(" ")
+            if word_end > 0:
+                candidates.append(head[:word_end].rstrip(",;:- ") + ".")
+    return list(dict.fromkeys(c for c in candidates if c != answer))
+
+
+def repairing(check, candidates, stats: RepairStats | None = None):
+    """Wraps the check of an answer to try local repairs before declaring the answer invalid.
+
+    Args:
+        check (Callable[[str], object]): The check of the answer, raising an exception if it is invalid.
+        candidates (Callable[[str], list[str]]): Gives the repaired answers to check, in order.
+        stats (RepairStats | None, optional): Counts the valid and repaired answers. Defaults to None.
+
+    Returns:
+        Callable[[str], object]: The check, returning the value of the first valid answer among the answer and its repairs.
+    """
+
+    def repaired_check(answer: str) -> object:
+        try:
+            value = check(answer)
+        except Exception as e:
+            for candidate in candidates(answer):
+                try:
+                    value = check(candidate)
+                except Exception:
+                    continue
+                if stats is not None:
+                    stats.record("repaired")
+                return value
+            raise e
+        if stats is not None:
+            stats.record("valid")
+        return value
+
+    return repaired_check
@@ -0,0 +1,147 @@
+import asyncio
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Callable
+
+
+class Stage:
+    """A step of a function's definition, run once all of its inputs are defined.
+
+    Args:
+        name (str): The name of the stage, used by other stages to depend on it.
+        inputs (list[str]): The names of the stages whose results this stage reads.
+        run (Callable[[dict], Any]): Defines the stage's result from a snapshot of the function's information. Returns a coroutine when run by `run_stages_async`.
+        apply (Callable[[dict, Any], None]): Writes the stage's result in the function's information.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        inputs: list[str],
+        run: Callable[[dict], Any],
+        apply: Callable[[dict, Any], None],
+    ):
+        self.name = name
+        self.inputs = inputs
+        self.run = run
+        self.apply = apply
+
+
+def check_stages(stages: list[Stage]):
+    """Checks that the stages form a DAG over known stage names.
+
+    Args:
+        stages (list[Stage]): The stages to check.
+
+    Raises:
+        ValueError: If a stage name is duplicated, an input is unknown, or the inputs form a cycle.
+    """
+    names = [stage.name for stage in stages]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Duplicated stage names: {names}")
+
+    for stage in stages:
+        unknown = [i for i in stage.inputs if i not in names]
+        if unknown:
+            raise ValueError(f"Stage {stage.name} depends on unknown stages: {unknown}")
+
+    done = set()
+    remaining = list(stages)
+    while remaining:
+        ready = [s for s in remaining if all(i in done for i in s.inputs)]
+        if not ready:
+            raise ValueError(
+                f"Cycle between stages: {[s.name for s in remaining]}"
+            )
+        done |= {s.name for s in ready}
+        remaining = [s for s in remaining if s.name not in done]
+
+
+def run_stages(
+    function_info: dict, stages: list[Stage], max_workers: int | None = None
+) -> dict | Exception:
+    """Runs the stages on the function, each stage starting as soon as its inputs are defined.
+
+    Independent stages run at the same time. A stage reads a snapshot of the function's information
+    taken when it starts, and its result is applied once it finishes, so concurrent stages never see
+    each other's partial results.
+
+    Args:
+        function_info (dict): The dictionnary containing the function's information, updated in place.
+        stages (list[Stage]): The stages to run.
+        max_workers (int | None, optional): The maximum number of stages running at once. Defaults to the number of stages.
+
+    Raises:
+        ValueError: If the stages do not form a DAG.
+        Exception: The first exception raised by a stage, the stages not yet started are dropped.
+
+    Returns:
+        (dict | Exception): The function's information with every stage applied.
+    """
+    check_stages(stages)
+    if not stages:
+        return function_info
+
+    pending = list(stages)
+    done = set()
+    running = {}
+
+    with ThreadPoolExecutor(max_workers=max_workers or len(stages)) as executor:
+        while pending or running:
+            ready = [s for s in pending if all(i in done for i in s.inputs)]
+            for stage in ready:
+                pending.remove(stage)
+                future = executor.submit(stage.run, dict(function_info))
+                running[future] = stage
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage = running.pop(future)
+                try:
+                    result = future.result()
+                except Exception:
+                    executor.shutdown(cancel_futures=True)
+                    raise
+                stage.apply(function_info, result)
+                done.add(stage.name)
+
+    return function_info
+
+
+async def run_stages_async(function_info: dict, stages: list[Stage]) -> dict | Exception:
+    """Runs the stages on the function as asyncio tasks, see `run_stages`.
+
+    Args:
+        function_info (dict): The dictionnary containing the function's information, updated in place.
+        stages (list[Stage]): The stages to run, their `run` returning a coroutine.
+
+    Raises:
+        ValueError: If the stages do not form a DAG.
+        Exception: The first exception raised by a stage, the other running stages are cancelled.
+
+    Returns:
+        (dict | Exception): The function's information with every stage applied.
+    """
+    check_stages(stages)
+
+    pending = list(stages)
+    done = set()
+    running = {}
+
+    try:
+        while pending or running:
+            ready = [s for s in pending if all(i in done for i in s.inputs)]
+            for stage in ready:
+                pending.remove(stage)
+                task = asyncio.create_task(stage.run(dict(function_info)))
+                running[task] = stage
+
+            finished, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for task in finished:
+                stage = running.pop(task)
+                stage.apply(function_info, task.result())
+                done.add(stage.name)
+    finally:
+        for task in running:
+            task.cancel()
+
+    return function_info
@@ -0,0 +1,384 @@
+import ast
+import re
+
+# builtins whose call gives a known type
+CONSTRUCTORS = {
+    "int": "int",
+    "float": "float",
+    "str": "str",
+    "bool": "bool",
+    "bytes": "bytes",
+    "list": "list",
+    "dict": "dict",
+    "set": "set",
+    "tuple": "tuple",
+    "len": "int",
+    "sorted": "list",
+    "isinstance": "bool",
+    "repr": "str",
+}
+# a docstring type, such as "list[str]" or "str | None"
+TYPE_EXPRESSION = re.compile(r"^[\w\.\[\], |]+$")
+GOOGLE_ARGS = {"args", "arguments", "parameters", "params"}
+GOOGLE_RETURNS = {"returns", "return"}
+
+
+def infer_python_type_from_ast(node: ast) -> str:
+    """Infers the Python type from an AST node.
+
+    Args:
+        node (ast): The AST node to infer the type from.
+
+    Returns:
+        str: The inferred Python type as a string.
+    """
+    if isinstance(node, ast.Tuple):
+        return "tuple"
+
+    if isinstance(node, (ast.List, ast.ListComp)):
+        return "list"
+
+    if isinstance(node, (ast.Dict, ast.DictComp)):
+        return "dict"
+
+    if isinstance(node, (ast.Set, ast.SetComp)):
+        return "set"
+
+    if isinstance(node, ast.JoinedStr):
+        return "str"
+
+    if isinstance(node, ast.Constant):
+        # True, 5, "hi", None
+        if isinstance(node.value, bool):
+            return "bool"
+        if isinstance(node.value, int):
+            return "int"
+        if isinstance(node.value, float):
+            return "float"
+        if isinstance(node.value, str):
+            return "str"
+        if node.value is None:
+            return "None"
+        return "any"
+
+    if isinstance(node, ast.Compare) or (
+        isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not)
+    ):
+        return "bool"
+
+    if isinstance(node, ast.BoolOp):
+        # "a and b" is one of its operands
+        types = {infer_python_type_from_ast(value) for value in node.values}
+        return types.pop() if len(types) == 1 else "any"
+
+    if isinstance(node, ast.BinOp) and infer_python_type_from_ast(node.left) == "str":
+        # "a" + b, "%s" % b
+        return "str"
+
+    if isinstance(node, ast.Name):
+        # something like "return x"
+        return "any"
+
+    if isinstance(node, ast.Call):
+        # return something() → unknown, unless something is a builtin
+        if isinstance(node.func, ast.Name) and node.func.id in CONSTRUCTORS:
+            return CONSTRUCTORS[node.func.id]
+        return "any"
+
+    return "any"
+
+
+def annotation_type(annotation: ast.expr | None) -> str | None:
+    """Gives the type expression of an annotation.
+
+    Args:
+        annotation (ast.expr | None): The annotation node, a string annotation included.
+
+    Returns:
+        str | None: The type expression, None without annotation.
+    """
+    if annotation is None:
+        return None
+    if isinstance(annotation, ast.Constant) and isinstance(annotation.value, str):
+        return annotation.value.strip() or None
+    return ast.unparse(annotation)
+
+
+def docstring_type(text: str) -> str | None:
+    """Gives the type expression of a docstring entry, such as "(list[str])" or "str | None".
+
+    Args:
+        text (str): The type part of the entry.
+
+    Returns:
+        str | None: The type expression, None if the text doesn't look like a type.
+    """
+    text = text.strip()
+    if text.startswith("(") and text.endswith(")"):
+        text = text[1:-1].strip()
+    text = re.sub(r",\s*optional$", "", text).strip()
+    if not text or not TYPE_EXPRESSION.match(text):
+        return None
+    return text
+
+
+def sections(docstring: str) -> dict[str, list[str]]:
+    """Splits a Google or NumPy style docstring into its sections.
+
+    Args:
+        docstring (str): The docstring, without its quotes.
+
+    Returns:
+        dict[str, list[str]]: The lines of each section, by lowercase title, with their indentation.
+    """
+    lines = docstring.expandtabs().splitlines()
+    result = {}
+    current = None
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        stripped = line.strip()
+        next_line = lines[i + 1].strip() if i + 1 < len(lines) else ""
+
+        google = re.match(r"^(\w+):$", stripped)
+        numpy = re.match(r"^(\w+)$", stripped) and re.match(r"^-{3,}$", next_line)
+        if google:
+            current = google.group(1).lower()
+            result[current] = []
+        elif numpy:
+            current = stripped.lower()
+            result[current] = []
+            i += 1
+        elif current is not None:
+            result[current].append(line)
+        i += 1
+    return result
+
+
+def entries(lines: list[str]) -> list[str]:
+    """Lists the entries of a docstring section, the lines with the least indentation.
+
+    Args:
+        lines (list[str]): The lines of the section.
+
+    Returns:
+        list[str]: The entries, stripped, without their description continuation lines.
+    """
+    indents = [len(line) - len(line.lstrip()) for line in lines if line.strip()]
+    if not indents:
+        return []
+    least = min(indents)
+    return [
+        line.strip()
+        for line in lines
+        if line.strip() and len(line) - len(line.lstrip()) == least
+    ]
+
+
+def docstring_types(docstring: str | None) -> tuple[dict[str, str], str | None]:
+    """Reads the parameter and return types of a Google or NumPy style docstring.
+
+    Google style: "name (type): description" under "Args:", "type: description" under "Returns:".
+    NumPy style: "name : type" under "Parameters", "type" or "name : type" under "Returns".
+
+    Args:
+        docstring (str | None): The docstring of the function.
+
+    Returns:
+        tuple[dict[str, str], str | None]: The type of each documented parameter, and the documented return type.
+    """
+    if not docstring:
+        return {}, None
+
+    parameters = {}
+    return_type = None
+    for title, lines in sections(docstring).items():
+        if title in GOOGLE_ARGS:
+            for entry in entries(lines):
+                google = re.match(r"^\**(\w+)\s*\((.+?)\)\s*:", entry)
+                numpy = re.match(r"^\**(\w+)\s+:\s*(.+)$", entry)
+                match = google or numpy
+                if match:
+                    t = docstring_type(match.group(2))
+                    if t is not None:
+                        parameters.setdefault(match.group(1), t)
+
+        elif title in GOOGLE_RETURNS and return_type is None:
+            found = entries(lines)
+            if not found:
+                continue
+            entry = found[0]
+            numpy = re.match(r"^\w+\s+:\s*(.+)$", entry)
+            if numpy:
+                return_type = docstring_type(numpy.group(1))
+            elif entry.startswith("("):
+                depth = 0
+                for i, ch in enumerate(entry):
+                    depth += {"(": 1, ")": -1}.get(ch, 0)
+                    if depth == 0:
+                        return_type = docstring_type(entry[: i + 1])
+                        break
+            else:
+                return_type = docstring_type(re.split(r":(\s|$)", entry)[0])
+
+    return parameters, return_type
+
+
+def local_types(node: ast.FunctionDef | ast.AsyncFunctionDef) -> dict[str, str]:
+    """Infers the type of the local variables of a function, from their assignments.
+
+    A variable keeps a type only when every assignment of the function gives it the same known type,
+    nested functions and classes excepted. Variables bound otherwise (loops, with, unpacking) have no type.
+
+    Args:
+        node (ast.FunctionDef | ast.AsyncFunctionDef): The function's node.
+
+    Returns:
+        dict[str, str]: The type of each typed variable.
+    """
+    found: dict[str, set[str]] = {}
+
+    def bind(target: ast.expr, t: str):
+        if isinstance(target, ast.Name):
+            found.setdefault(target.id, set()).add(t)
+        elif isinstance(target, (ast.Tuple, ast.List, ast.Starred)):
+            for child in ast.walk(target):
+                if isinstance(child, ast.Name):
+                    found.setdefault(child.id, set()).add("any")
+
+    stack = list(node.body)
+    while stack:
+        child = stack.pop()
+        if isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef, ast.Lambda)):
+            continue
+        if isinstance(child, ast.Assign):
+            t = infer_python_type_from_ast(child.value)
+            for target in child.targets:
+                bind(target, t)
+        elif isinstance(child, ast.AnnAssign):
+            bind(child.target, annotation_type(child.annotation) or "any")
+        elif isinstance(child, (ast.For, ast.AsyncFor, ast.comprehension)):
+            bind(child.target, "any")
+        elif isinstance(child, ast.withitem) and child.optional_vars is not None:
+            bind(child.optional_vars, "any")
+        elif isinstance(child, ast.NamedExpr):
+            bind(child.target, infer_python_type_from_ast(child.value))
+        stack.extend(ast.iter_child_nodes(child))
+
+    return {
+        name: types.pop()
+        for name, types in found.items()
+        if len(types) == 1 and "any" not in types
+    }
+
+
+def parameter_types(
+    node: ast.FunctionDef | ast.AsyncFunctionDef | ast.Lambda, class_name: str | None = None
+) -> dict[str, str]:
+    """Resolves the types of the parameters of a function without the LLM.
+
+    In order: the annotation, the docstring, the type of a default value other than None,
+    and the enclosing class for the `self` of a method, `type[...]` of it for the `cls` of a method.
+
+    Args:
+        node (ast.FunctionDef | ast.AsyncFunctionDef | ast.Lambda): The function's node.
+        class_name (str | None, optional): The qualified name of the enclosing class of a method. Defaults to None.
+
+    Returns:
+        dict[str, str]: The type expression of each resolved parameter.
+    """
+    args = node.args.args
+    documented = {}
+    if not isinstance(node, ast.Lambda):
+        documented, _ = docstring_types(ast.get_docstring(node))
+
+    defaults = dict(zip([a.arg for a in args[len(args) - len(node.args.defaults) :]], node.args.defaults))
+
+    receiver = None
+    decorators = getattr(node, "decorator_list", [])
+    if class_name is not None and not any(
+        isinstance(d, ast.Name) and d.id == "staticmethod" for d in decorators
+    ):
+        receiver = {"self": class_name, "cls": f"type[{class_name}]"}
+
+    types = {}
+    for position, arg in enumerate(args):
+        t = annotation_type(arg.annotation) or documented.get(arg.arg)
+        if t is None and arg.arg in defaults:
+            inferred = infer_python_type_from_ast(defaults[arg.arg])
+            if inferred not in ("any", "None"):
+                t = inferred
+        if t is None and receiver is not None and position == 0:
+            t = receiver.get(arg.arg)
+        if t is not None:
+            types[arg.arg] = t
+    return types
+
+
+def returned_type(
+    node: ast.FunctionDef | ast.AsyncFunctionDef | ast.Lambda,
+    value: ast.expr | None,
+    parameters: dict[str, str],
+    local: dict[str, str] | None = None,
+) -> str | None:
+    """Resolves the type of a returned expression, a parameter or a local variable being followed to its type.
+
+    Args:
+        node (ast.FunctionDef | ast.AsyncFunctionDef | ast.Lambda): The function's node.
+        value (ast.expr | None): The returned expression, None for a bare `return`.
+        parameters (dict[str, str]): The resolved types of the parameters.
+        local (dict[str, str] | None, optional): The types of the local variables, see `local_types`. Defaults to inferring them.
+
+    Returns:
+        str | None: The type expression, None if it stays unknown.
+    """
+    if value is None:
+        return "None"
+    if isinstance(value, ast.Name):
+        if value.id in parameters:
+            return parameters[value.id]
+        if not isinstance(node, ast.Lambda):
+            return (local if local is not None else local_types(node)).get(value.id)
+        return None
+    inferred = infer_python_type_from_ast(value)
+    return None if inferred == "any" else inferred
+
+
+def return_type(
+    node: ast.FunctionDef | ast.AsyncFunctionDef | ast.Lambda,
+    values: list[ast.expr | None],
+    parameters: dict[str, str],
+) -> str | None:
+    """Resolves the return type of a function without the LLM.
+
+    In order: the annotation, the docstring, then the union of the types of the returns, see `returned_type`.
+    A bare `return` gives None, and a single return of unknown type leaves the whole type unknown.
+
+    Args:
+        node (ast.FunctionDef | ast.AsyncFunctionDef | ast.Lambda): The function's node.
+        values (list[ast.expr | None]): The returned expressions of the function, None for a bare `return`, see `ModuleVisitor`.
+        parameters (dict[str, str]): The resolved types of the parameters.
+
+    Returns:
+        str | None: The return type expression, None if it stays unknown.
+    """
+    if not isinstance(node, ast.Lambda):
+        t = annotation_type(node.returns)
+        if t is None:
+            _, t = docstring_types(ast.get_docstring(node))
+        if t is not None:
+            return t
+
+    if not values:
+        return None
+    local = local_types(node) if not isinstance(node, ast.Lambda) else None
+    types = []
+    for value in values:
+        t = returned_type(node, value, parameters, local)
+        if t is None:
+            return None
+        if t not in types:
+            types.append(t)
+    # "int | None" rather than "None | int"
+    types.sort(key=lambda t: t == "None")
+    return " | ".join(types)
@@ -1,4 +1,5 @@
 import os
+import time
 from dotenv import load_dotenv
 import requests
 
@@ -43,19 +44,32 @@ resp = requests.post(
     },
 )
 
-folder_name = resp.json()
-print(f"Saved in folder: {folder_name}")
+upload = resp.json()
+folder_name = upload["folder"]
+print(f"Saved as {upload['hash']} in folder: {folder_name}")
 
-# analyze a document (proof of concept)
+# analyze a document (proof of concept), an upload analyzed before gives its result at once
 resp = requests.post(
     "http://127.0.0.1:8000/analyze",
     json={
-        "filepath": f"{folder_name}/{filename}",
+        "hash": upload["hash"],
         "model": "meta-llama/Llama-3.1-8B-Instruct",
         "hf_token": os.getenv("HF_TOKEN"),
     },
 )
+job = resp.json()
+job_id = job["job_id"]
+print(f"Analysis {job['status']}: {job_id}")
 
-write_functions_to_json(resp.json(), "exemple", dir=folder_name)
+# poll the job until the analysis is over
+while job["status"] not in ("done", "failed"):
+    time.sleep(2)
+    job = requests.get(f"http://127.0.0.1:8000/jobs/{job_id}").json()
+
+if job["status"] == "failed":
+    print(f"Analysis failed: {job['error']}")
+else:
+    # the upload folder is addressed by its content, the outputs go to results
+    write_functions_to_json(job["result"], "exemple", dir="results")
 
 
@@ -0,0 +1,223 @@
+import re
+
+# a dotted name, "...", or a punctuation of type expressions
+TOKEN = re.compile(r"\s*(?:(\.\.\.)|([A-Za-z_]\w*(?:\.[A-Za-z_]\w*)*)|([\[\],|]))")
+# typing aliases and their builtin type
+ALIASES = {
+    "list": "list",
+    "dict": "dict",
+    "tuple": "tuple",
+    "set": "set",
+    "any": "any",
+    "none": "None",
+    "nonetype": "None",
+}
+TYPING_MODULES = ("typing.", "typing_extensions.")
+
+
+def split_top_level(text: str, sep: str = ",") -> list[str]:
+    """Splits a text on a separator outside of brackets: "dict[str, int], str" gives ["dict[str, int]", "str"].
+
+    Args:
+        text (str): The text.
+        sep (str, optional): The separator, a single character. Defaults to ",".
+
+    Returns:
+        list[str]: The stripped parts.
+    """
+    parts = []
+    depth = 0
+    start = 0
+    for i, ch in enumerate(text):
+        if ch in "[(":
+            depth += 1
+        elif ch in "])":
+            depth -= 1
+        elif ch == sep and depth == 0:
+            parts.append(text[start:i].strip())
+            start = i + 1
+    parts.append(text[start:].strip())
+    return parts
+
+
+class TypeParser:
+    """Parses a type expression into its canonical form, validating every name it contains.
+
+    Grammar, read in a single left to right pass:
+        type     := union
+        union    := term ("|" term)*
+        term     := name ["[" args "]"] | "..."
+        args     := arg ("," arg)* [","]
+        arg      := type | "[" [type ("," type)*] "]"
+
+    Names are the base types, case insensitive, and the names imported by the file. `typing` aliases give builtins,
+    `Optional[X]` gives "X | None", `Union[A, B]` gives "A | B" and `Callable[[A], R]` keeps its argument list.
+
+    Args:
+        text (str): The type expression.
+        base_types (set[str]): The accepted type names.
+        imports (set[str]): The names imported by the file, also accepted, and the modules of dotted names.
+    """
+
+    def __init__(self, text: str, base_types: set[str], imports: set[str]):
+        self.text = text
+        self.base_types = base_types
+        self.imports = imports
+        self.tokens = []
+        position = 0
+        text = text.rstrip()
+        while position < len(text):
+            match = TOKEN.match(text, position)
+            if match is None:
+                raise ValueError(f"Invalid character in type '{self.text}': '{text[position:].strip()[:1]}'")
+            self.tokens.append(next(g for g in match.groups() if g is not None))
+            position = match.end()
+        self.position = 0
+
+    def peek(self) -> str | None:
+        return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+    def expect(self, token: str):
+        if self.peek() != token:
+            raise ValueError(f"Expected '{token}' in type '{self.text}', got '{self.peek() or 'the end'}'.")
+        self.position += 1
+
+    def parse(self) -> str:
+        """Parses the whole expression.
+
+        Raises:
+            ValueError: If the expression isn't a valid type.
+
+        Returns:
+            str: The canonical type, such as "dict[str, list[int]]" or "str | None".
+        """
+        if not self.tokens:
+            raise ValueError("Empty type.")
+        t = self.union()
+        if self.peek() is not None:
+            raise ValueError(f"Unexpected '{self.peek()}' in type '{self.text}'.")
+        return t
+
+    def union(self) -> str:
+        members = [self.term()]
+        while self.peek() == "|":
+            self.position += 1
+            members.append(self.term())
+        return " | ".join(dict.fromkeys(members))
+
+    def args(self) -> list[str]:
+        args = []
+        while True:
+            if self.peek() == "[":
+                self.position += 1
+                items = []
+                while self.peek() != "]":
+                    items.append(self.union())
+                    if self.peek() != ",":
+                        break
+                    self.position += 1
+                self.expect("]")
+                args.append(f"[{', '.join(items)}]")
+            else:
+                args.append(self.union())
+            if self.peek() != ",":
+                break
+            self.position += 1
+            if self.peek() == "]":
+                break
+        self.expect("]")
+        return args
+
+    def term(self) -> str:
+        token = self.peek()
+        if token is None or token in "[],|":
+            raise ValueError(f"Expected a type name in '{self.text}', got '{token or 'the end'}'.")
+        self.position += 1
+        if token == "...":
+            return token
+
+        name = self.name(token)
+        if self.peek() != "[":
+            if name in ("Optional", "Union"):
+                raise ValueError(f"{name} needs type arguments.")
+            return name
+        self.position += 1
+        args = self.args()
+
+        if name == "Optional":
+            if len(args) != 1:
+                raise ValueError(f"Optional takes a single type, got {len(args)}.")
+            return " | ".join(dict.fromkeys([*args[0].split(" | "), "None"]))
+        if name == "Union":
+            return " | ".join(dict.fromkeys(" | ".join(args).split(" | ")))
+        if name == "Callable" and (len(args) != 2 or not (args[0].startswith("[") or args[0] == "...")):
+            raise ValueError("Callable takes a list of argument types and a return type.")
+        if name != "Callable" and any(a.startswith("[") for a in args):
+            raise ValueError(f"Unexpected argument list in '{self.text}'.")
+        return f"{name}[{', '.join(args)}]"
+
+    def name(self, token: str) -> str:
+        """Validates a type name and gives its canonical spelling.
+
+        Args:
+            token (str): The name, possibly dotted.
+
+        Raises:
+            ValueError: If the name is neither a base type nor imported.
+
+        Returns:
+            str: The canonical name.
+        """
+        for module in TYPING_MODULES:
+            if token.startswith(module):
+                token = token[len(module) :]
+
+        lowered = token.lower()
+        if lowered in ALIASES:
+            return ALIASES[lowered]
+        if token in ("Optional", "Union"):
+            return token
+        if "." in token:
+            # a type of an imported module, such as "datetime.date"
+            root = token.split(".")[0]
+            if self.known(root) is not None:
+                return token
+        else:
+            known = self.known(token)
+            if known is not None:
+                return known
+        raise ValueError(f"Unknown or unsupported type name: '{token}'")
+
+    def known(self, name: str) -> str | None:
+        """Finds a name among the base types and the imports, ignoring case.
+
+        Args:
+            name (str): The name.
+
+        Returns:
+            str | None: The name as spelled in the base types or the imports, None if it is unknown.
+        """
+        if name in self.base_types or name in self.imports:
+            return name
+        lowered = name.lower()
+        for known in (*self.base_types, *self.imports):
+            if known.lower() == lowered:
+                return known
+        return None
+
+
+def parse_type(text: str, base_types: set[str], imports: set[str]) -> str:
+    """Validates a type expression and gives its canonical form, see `TypeParser`.
+
+    Args:
+        text (str): The type expression.
+        base_types (set[str]): The accepted type names.
+        imports (set[str]): The names imported by the file.
+
+    Raises:
+        ValueError: If the expression isn't a valid type.
+
+    Returns:
+        str: The canonical type.
+    """
+    return TypeParser(text, base_types, imports).parse()
@@ -0,0 +1,210 @@
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+import tarfile
+import zipfile
+
+CHUNK_SIZE = 1024 * 1024
+# the most bytes written by an upload, archives included once extracted
+MAX_UPLOAD_BYTES = 200 * 1024 * 1024
+ARCHIVES = (".zip", ".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tar.xz")
+DIGEST = re.compile(r"^[0-9a-f]{64}$")
+
+
+def is_archive(filename: str) -> bool:
+    """Checks if an uploaded file is a zip or tar archive, from its name."""
+    return filename.lower().endswith(ARCHIVES)
+
+
+def safe_path(folder: str, relpath: str) -> str:
+    """Gives the path of an uploaded file in the project folder.
+
+    Args:
+        folder (str): The project folder.
+        relpath (str): The path of the file in the project, such as "pkg/mod.py".
+
+    Raises:
+        ValueError: If the path is absolute or leaves the folder.
+
+    Returns:
+        str: The path of the file.
+    """
+    relpath = relpath.replace("\\", "/")
+    normalized = os.path.normpath(relpath)
+    if not relpath or os.path.isabs(relpath) or normalized == "." or normalized.startswith(".."):
+        raise ValueError(f"Invalid path in the upload: '{relpath}'")
+    return os.path.join(folder, normalized)
+
+
+class UploadWriter:
+    """Writes the files of an upload into a project folder, chunk by chunk, never holding a whole file in memory.
+
+    Args:
+        folder (str): The project folder, created beforehand.
+        max_bytes (int, optional): The most bytes written over all the files. Defaults to `MAX_UPLOAD_BYTES`.
+    """
+
+    def __init__(self, folder: str, max_bytes: int = MAX_UPLOAD_BYTES):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.written = 0
+        self.files: list[str] = []
+        # the sha256 of each written file, by path in the project
+        self.hashes: dict[str, str] = {}
+
+    def write(self, relpath: str, source):
+        """Copies a file of the upload.
+
+        Args:
+            relpath (str): The path of the file in the project.
+            source (BinaryIO): The file's content.
+
+        Raises:
+            ValueError: If the path is invalid or the upload is over `max_bytes`.
+        """
+        path = safe_path(self.folder, relpath)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        digest = hashlib.sha256()
+        with open(path, "wb") as f:
+            while chunk := source.read(CHUNK_SIZE):
+                self.written += len(chunk)
+                if self.written > self.max_bytes:
+                    raise ValueError(f"Upload over {self.max_bytes} bytes.")
+                digest.update(chunk)
+                f.write(chunk)
+        name = os.path.relpath(path, self.folder).replace(os.sep, "/")
+        if name not in self.hashes:
+            self.files.append(name)
+        self.hashes[name] = digest.hexdigest()
+
+    def extract(self, filename: str, source):
+        """Extracts the regular files of a zip or tar archive, links and special files are skipped.
+
+        Args:
+            filename (str): The archive's name, giving its format.
+            source (BinaryIO): The archive, seekable for a zip.
+
+        Raises:
+            ValueError: If the archive is invalid, a path is invalid, or the upload is over `max_bytes`.
+        """
+        try:
+            if filename.lower().endswith(".zip"):
+                with zipfile.ZipFile(source) as archive:
+                    for info in archive.infolist():
+                        is_link = (info.external_attr >> 16) & 0o170000 == 0o120000
+                        if info.is_dir() or is_link:
+                            continue
+                        with archive.open(info) as member:
+                            self.write(info.filename, member)
+            else:
+                # "r|*" reads the archive as a stream, compressed or not
+                with tarfile.open(fileobj=source, mode="r|*") as archive:
+                    for info in archive:
+                        if not info.isfile():
+                            continue
+                        self.write(info.name, archive.extractfile(info))
+        except (zipfile.BadZipFile, tarfile.TarError) as e:
+            raise ValueError(f"Invalid archive {filename}: {e}")
+
+    def add(self, filename: str, source):
+        """Writes an uploaded file, or extracts it if it is an archive, see `is_archive`.
+
+        Args:
+            filename (str): The name of the uploaded file, possibly a path in the project.
+            source (BinaryIO): The file's content.
+        """
+        if is_archive(filename):
+            self.extract(filename, source)
+        else:
+            self.write(filename, source)
+
+    def digest(self) -> str:
+        """Hashes the written project: the path and content of each file, whatever the order of the upload.
+
+        Returns:
+            str: The hex digest.
+        """
+        digest = hashlib.sha256()
+        for name in sorted(self.hashes):
+            digest.update(f"{name}\0{self.hashes[name]}\n".encode("utf-8"))
+        return digest.hexdigest()
+
+
+class UploadStore:
+    """Uploaded projects stored by content: a project uploaded again is stored once, under the same hash.
+
+    A project is written to a temporary folder, hashed while written, see `UploadWriter.digest`,
+    then renamed to `root/<hash>`, or dropped if that hash is already stored.
+
+    Args:
+        root (str, optional): The folder of the uploads. Defaults to "uploads".
+        max_bytes (int, optional): The most bytes written by an upload. Defaults to `MAX_UPLOAD_BYTES`.
+    """
+
+    def __init__(self, root: str = "uploads", max_bytes: int = MAX_UPLOAD_BYTES):
+        os.makedirs(root, exist_ok=True)
+        self.root = root
+        self.max_bytes = max_bytes
+
+    def path(self, digest: str) -> str | None:
+        """Gives the folder of a stored upload.
+
+        Args:
+            digest (str): The hash of the upload.
+
+        Returns:
+            str | None: The folder, None if the hash isn't a stored upload.
+        """
+        if not DIGEST.match(digest):
+            return None
+        path = os.path.join(self.root, digest)
+        return path if os.path.isdir(path) else None
+
+    def target(self, digest: str) -> str | None:
+        """Gives what to analyze for an upload: its only file, or its folder.
+
+        Args:
+            digest (str): The hash of the upload.
+
+        Returns:
+            str | None: The file or folder, None if the hash isn't a stored upload.
+        """
+        path = self.path(digest)
+        if path is None:
+            return None
+        entries = os.listdir(path)
+        if len(entries) == 1 and os.path.isfile(os.path.join(path, entries[0])):
+            return os.path.join(path, entries[0])
+        return path
+
+    def save(self, uploads: list[tuple[str, object]]) -> tuple[str, list[str]]:
+        """Stores the files and archives of an upload, see `UploadWriter`.
+
+        Args:
+            uploads (list[tuple[str, BinaryIO]]): The name and content of each uploaded file.
+
+        Raises:
+            ValueError: If a file can't be written, see `UploadWriter.write`.
+
+        Returns:
+            tuple[str, list[str]]: The hash of the upload, and the paths of its files in the project.
+        """
+        tmp = tempfile.mkdtemp(dir=self.root, prefix=".tmp-")
+        try:
+            writer = UploadWriter(tmp, self.max_bytes)
+            for filename, source in uploads:
+                writer.add(filename, source)
+            if not writer.files:
+                raise ValueError("Empty upload.")
+            digest = writer.digest()
+            if self.path(digest) is None:
+                try:
+                    os.rename(tmp, os.path.join(self.root, digest))
+                except OSError:
+                    # stored by a concurrent upload of the same project
+                    pass
+            return digest, writer.files
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
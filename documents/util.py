@@ -1,8 +1,20 @@
 import ast
-import copy
+import hashlib
 import os
 import re
 import json
+import textwrap
+import threading
+
+from output_store import output_store
+from static_types import (
+    infer_python_type_from_ast,
+    local_types,
+    parameter_types,
+    return_type,
+    returned_type,
+)
+from type_grammar import parse_type, split_top_level
 
 CONTAINERS = {"list", "dict", "tuple", "set"}
 PRIMITIVES = {
@@ -14,6 +26,7 @@ PRIMITIVES = {
     "none",
     "any",
     "object",
+    "type",
 } | CONTAINERS
 CUSTOM = {"DB"}
 NON_EXHAUSTIVE = {
@@ -34,59 +47,62 @@ NON_EXHAUSTIVE = {
 }
 
 
-def generate_valid_types(depth: int = 0) -> set[str]:
-    """Generate an exhaustive set of type expressions up to a given nesting depth.
+VALID_BASE_TYPES = PRIMITIVES | NON_EXHAUSTIVE | CUSTOM
+# the types accepted in the LLM's answers, see `TypeParser`
+ACCEPTED_TYPES = (
+    f"the names {sorted(VALID_BASE_TYPES)} and the names imported by the file, "
+    "generics of them at any depth such as list[str] or dict[str, list[int]], "
+    "unions such as str | None, Optional[...] and Callable[[...], ...]"
+)
 
-    Args:
-        depth (int, optional): The depth of valid types to generate (d=0: list,dict; d=1: list[str], dict[str];...). Defaults to 0.
-
-    Returns:
-        set(str): The set of types to compare to for the LLM's answer.
-    """
-    base = PRIMITIVES | CUSTOM
-    valid = set(base)
-
-    def expand(base_types, current_depth):
-        if current_depth > depth:
-            return set()
-
-        new_types = set()
-        for outer in CONTAINERS:
-            for inner in base_types:
-                if outer == "dict" or outer == "tuple":
-                    for inner2 in base_types:
-                        new_types.add(f"{outer}[{inner},{inner2}]")
-                else:
-                    new_types.add(f"{outer}[{inner}]")
 
-        if current_depth < depth:
-            new_types |= expand(new_types, current_depth + 1)
+# Python 3.11 corrupts its AST conversion when several threads parse at once (CPython gh-106905)
+parse_lock = threading.Lock()
 
-        return new_types
 
-    valid |= expand(base, 1)
-    return valid
+def parse_python(source: str, filename: str = "<unknown>", mode: str = "exec") -> ast.AST:
+    """Parses Python source like `ast.parse`, one thread at a time.
 
+    Args:
+        source (str): The source.
+        filename (str, optional): The file name, used in syntax errors. Defaults to "<unknown>".
+        mode (str, optional): "exec" for a module, "eval" for an expression. Defaults to "exec".
 
-VALID_BASE_TYPES = PRIMITIVES | NON_EXHAUSTIVE | generate_valid_types(0)
+    Returns:
+        ast.AST: The tree.
+    """
+    with parse_lock:
+        return ast.parse(source, filename, mode)
 
 
-def list_files(directory: str) -> list[str]:
+def list_files(directory: str, recursive: bool = False) -> list[str]:
     """Lists all files in a given directory.
 
     Args:
         directory (str): The name of the directory
+        recursive (bool, optional): If True, also lists the files of the sub-directories, hidden directories excepted. Defaults to False.
 
     Returns:
-        list[str]: Lists of all file names in a directory.
+        list[str]: Lists of all file names in a directory, relative to the directory.
     """
 
     try:
-        return [
-            f
-            for f in os.listdir(directory)
-            if os.path.isfile(os.path.join(directory, f))
-        ]
+        if not recursive:
+            return [
+                f
+                for f in os.listdir(directory)
+                if os.path.isfile(os.path.join(directory, f))
+            ]
+
+        if not os.path.isdir(directory):
+            raise FileNotFoundError(directory)
+        files = []
+        for root, dirs, names in os.walk(directory):
+            dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+            rel_root = os.path.relpath(root, directory)
+            for name in sorted(names):
+                files.append(name if rel_root == "." else os.path.join(rel_root, name))
+        return files
     except FileNotFoundError:
         print(f"Directory not found: {directory}")
         return []
@@ -116,225 +132,470 @@ def read_file(filepath: str) -> str:
         return ""
 
 
-def next_available_filename(base_name: str, ext: str = "txt") -> str:
-    """Given a base_name like 'filename_func_def', returns a file name like 'filename_func_def_1.txt' or increments until a free name is found.
+def list_imports(node: ast, imports: list[str]):
+    """Lists the names bound by the imports of the file.
 
     Args:
-        base_name (str): The name of the file
-        ext (str, optional): The extension of the file. Defaults to "txt".
-
-    Returns:
-        str: The name of the file numbered.
+        node (ast): The current node explored by AST of the file.
+        imports (list[str]): The list to add the imports to.
     """
+    if isinstance(node, ast.Import):
+        for alias in node.names:
+            # "import os.path" binds "os"
+            imports.append(alias.asname or alias.name.split(".")[0])
 
-    directory = os.path.dirname(base_name) or "."
-    filename_root = os.path.basename(base_name)
-
-    pattern = re.compile(rf"^{re.escape(filename_root)}_(\d+)\.{ext}$")
-
-    existing_versions = []
-
-    for file in os.listdir(directory):
-        match = pattern.match(file)
-        if match:
-            version = int(match.group(1))
-            existing_versions.append(version)
+    elif isinstance(node, ast.ImportFrom):
+        for alias in node.names:
+            imports.append(alias.asname or alias.name)
 
-    next_version = max(existing_versions, default=0) + 1
 
-    return os.path.join(directory, f"{filename_root}_{next_version}.{ext}")
+def import_targets(node: ast.Import | ast.ImportFrom) -> dict[str, str]:
+    """Gives what each name bound by an import refers to, as a dotted name.
 
-def next_available_foldername(base_name: str) -> str:
-    """
-    Given a base folder name like 'my_folder', returns 'my_folder_1'
-    or increments until a free folder name is found.
+    Relative imports keep their leading dots, resolved against the importing module by `ProjectIndex`.
 
     Args:
-        base_name (str): The folder name.
+        node (ast.Import | ast.ImportFrom): The import node.
 
     Returns:
-        str: A new folder name with an incremented suffix.
-    """
-
-    directory = os.path.dirname(base_name) or "."
-    folder_root = os.path.basename(base_name)
-
-    pattern = re.compile(rf"^{re.escape(folder_root)}_(\d+)$")
-
-    existing_versions = []
-
-    for entry in os.listdir(directory):
-        full_path = os.path.join(directory, entry)
-        if os.path.isdir(full_path):
-            match = pattern.match(entry)
-            if match:
-                existing_versions.append(int(match.group(1)))
-
-    next_version = max(existing_versions, default=0) + 1
-    return os.path.join(directory, f"{folder_root}_{next_version}")
-
-def list_imports(node: ast, imports: list[str]):
-    """Lists the imports of the file.
-
-    Args:
-        node (ast): The current node explored by AST of the file.
-        imports (list[str]): The list to add the imports to.
+        dict[str, str]: The dotted target of each bound name: "import a.b as c" gives {"c": "a.b"},
+        "import a.b" gives {"a": "a"} and "from .a import f" gives {"f": ".a.f"}.
     """
+    targets = {}
     if isinstance(node, ast.Import):
         for alias in node.names:
-            sanitized_name = sanitize(alias.name)
-            imports.append(sanitized_name)
-
-    elif isinstance(node, ast.ImportFrom):
+            if alias.asname:
+                targets[alias.asname] = alias.name
+            else:
+                root = alias.name.split(".")[0]
+                targets[root] = root
+    else:
+        module = "." * node.level + (node.module or "")
         for alias in node.names:
-            sanitized_name = sanitize(alias.name)
-            imports.append(sanitized_name)
+            if alias.name != "*":
+                separator = "." if module and not module.endswith(".") else ""
+                targets[alias.asname or alias.name] = f"{module}{separator}{alias.name}"
+    return targets
 
 
-def list_functions(node:ast, content: str, functions: list[dict]):
-    """Appends the function in the file as a dict to the given functions' list.
+def source_lines(content: str) -> list[str]:
+    """Splits a file into lines as the positions of its AST count them, form feeds included in lines.
 
     Args:
-        node (ast): The current node being explored.
         content (str): The content of the file.
-        functions (list[dict]): The lists to which all the functions dict will be added.
-    """
-    func_source = ast.get_source_segment(content, node)
-    param_names = [param.arg for param in node.args.args]
 
-    functions.append(
-        {
-            "name": node.name,
-            "parameters": [(param, "") for param in param_names],
-            "source": func_source,
-            "start_line": node.lineno,
-            "end_line": node.end_lineno,
-            "called_by": [],
-            "calls": [],
-            "description": "",
-            "tags": [],
-            "category": "",
-            "return": ("", ""),
-        }
-    )
+    Returns:
+        list[str]: The lines, with their line endings.
+    """
+    return re.findall(r"[^\r\n]*(?:\r\n|\r|\n)|[^\r\n]+$", content)
 
 
-def list_calls(tree: ast.Module, functions: list[dict]) -> list[dict]:
-    """Gets the calls made by each function in the file.
+def source_segment(lines: list[str], node: ast.AST) -> str | None:
+    """Gives the source of a node, as `ast.get_source_segment` without splitting the file again for every node.
 
     Args:
-        tree (ast.Module): The AST tree of the file.
-        functions (list[dict]): The list of function dictionaries.
+        lines (list[str]): The lines of the file, see `source_lines`.
+        node (ast.AST): The node.
 
     Returns:
-        list[dict]: The updated list of function dictionaries with call information.
+        str | None: The source of the node, None if the node has no position.
     """
-
-    local_function_names = {f["name"] for f in functions}
-    for node in ast.walk(tree):
-        if isinstance(node, ast.FunctionDef):
-            func_name = node.name
-            index = index_of(functions, "name", func_name)
-            calls = set()
-
-            for inner in ast.walk(node):
-                if isinstance(inner, ast.Call):
-                    if isinstance(inner.func, ast.Name):
-                        name = inner.func.id
-                        if name in local_function_names:
-                            calls.add(name)
-
-                    elif isinstance(inner.func, ast.Attribute):
-                        name = inner.func.attr
-                        if name in local_function_names:
-                            calls.add(name)
-
-            functions[index]["calls"] = list(calls)
-
-    return functions
+    if getattr(node, "end_lineno", None) is None or getattr(node, "end_col_offset", None) is None:
+        return None
+    first, last = node.lineno - 1, node.end_lineno - 1
+    if first == last:
+        return lines[first].encode()[node.col_offset : node.end_col_offset].decode()
+    return "".join(
+        [
+            lines[first].encode()[node.col_offset :].decode(),
+            *lines[first + 1 : last],
+            lines[last].encode()[: node.end_col_offset].decode(),
+        ]
+    )
 
 
-def list_called_by(functions: list[dict]) -> list[dict]:
-    """Lists the functions that call each function in the file.
+def new_function(
+    node: ast.FunctionDef | ast.AsyncFunctionDef | ast.Lambda,
+    content: str,
+    name: str,
+    qualname: str,
+    parent: str | None,
+    source_node: ast.AST | None = None,
+    lines: list[str] | None = None,
+) -> dict:
+    """Builds the dictionnary of a function of the file.
 
     Args:
-        functions (list[dict]): The list of function dictionaries.
+        node (ast.FunctionDef | ast.AsyncFunctionDef | ast.Lambda): The function's node.
+        content (str): The content of the file.
+        name (str): The name of the function, the assigned name for a lambda.
+        qualname (str): The qualified name of the function, such as "Class.method" or "outer.<locals>.inner".
+        parent (str | None): The qualified name of the enclosing class or function, None at the top of the module.
+        source_node (ast.AST | None, optional): The node giving the source, the assignment of a lambda. Defaults to `node`.
+        lines (list[str] | None, optional): The lines of the file, see `source_lines`. Defaults to splitting `content`.
 
     Returns:
-        list[dict]: The updated list of function dictionaries with caller information.
+        dict: The function's information, to be completed by the LLM.
     """
-    for f in functions:
-        caller = f["name"]
+    source_node = source_node or node
+    func_source = source_segment(lines if lines is not None else source_lines(content), source_node)
+    param_names = [param.arg for param in node.args.args]
 
-        for callee in f["calls"]:
-            idx = index_of(functions, "name", callee)
-            if idx != -1:
-                functions[idx]["called_by"].append(caller)
+    return {
+        "name": name,
+        "qualname": qualname,
+        "parent": parent,
+        "async": isinstance(node, ast.AsyncFunctionDef),
+        "decorators": [ast.unparse(d) for d in getattr(node, "decorator_list", [])],
+        "parameters": [(param, "") for param in param_names],
+        "source": func_source,
+        "start_line": source_node.lineno,
+        "end_line": source_node.end_lineno,
+        "called_by": [],
+        "calls": [],
+        "description": "",
+        "tags": [],
+        "category": "",
+        # "rules" when the category comes from `classify`, "llm" otherwise, with the confidence of the rules
+        "category_source": "",
+        "category_confidence": None,
+        "return": ("", ""),
+        # every return of the function, in source order, as (value, type): ("", "None") for a bare `return`
+        "returns": [],
+    }
+
+
+class ModuleVisitor(ast.NodeVisitor):
+    """Collects, in a single pass over the AST of a file, its imports, functions, returns and calls.
+
+    Functions, methods, async functions and lambdas assigned to a name are listed in source order
+    and indexed by qualified name, as Python's `__qualname__`: "Class.method", "outer.<locals>.inner".
+    A name defined again in the same scope, such as a property's getter and setter, is numbered from its second
+    definition on: "Class.x", then "Class.x#2", so that every function has its own qualified name.
+    The returns and calls of a nested function belong to the nested function only.
+    The return of a function is its last return with a value among the least nested ones, usually its final return.
+
+    Calls are resolved against the symbol table: a name through the enclosing functions then the module,
+    a class to its `__init__`, `self.m()` and `cls.m()` to the method of the enclosing class, `Class.m()` to the method,
+    and any other `obj.m()` to the only function of the file named `m`, if there is one.
+    The calls left unresolved, and the targets of the imports, are kept for `ProjectIndex`.
+    The module docstring, the module imports and the headers of the classes and functions are kept for `FileContext`.
 
-    for f in functions:
-        f["calls"] = sorted(set(f["calls"]))
-        f["called_by"] = sorted(set(f["called_by"]))
+    Args:
+        content (str): The content of the file.
+    """
 
-    return functions
+    def __init__(self, content: str):
+        self.content = content
+        self.lines = source_lines(content)
+        self.imports: list[str] = []
+        # the dotted target of each name bound by an import, see `import_targets`
+        self.import_targets: dict[str, str] = {}
+        self.functions: list[dict] = []
+        self.index: dict[str, int] = {}
+        self.by_name: dict[str, list[int]] = {}
+        # the qualified names of the classes, with the qualified name of their parent
+        self.classes: dict[str, str | None] = {}
+        self.nodes: list[ast.AST] = []
+        self.returns: list[list[tuple[int, ast.Return]]] = []
+        self.raw_calls: list[list[tuple[str | None, str]]] = []
+        # the calls of each function not resolved in the file, by qualified name
+        self.unresolved: dict[str, list[tuple[str | None, str]]] = {}
+        # enclosing scopes, as ("class" | "function", qualname, position of the function)
+        self.scopes: list[tuple[str, str, int | None]] = []
+        self.depth = 0
+        # the parts of the file sent as context, see `FileContext`
+        self.docstring: str | None = None
+        self.import_sources: list[str] = []
+        self.class_headers: list[tuple[int, int, str]] = []
+        self.headers: dict[str, str] = {}
+
+    def visit(self, node: ast.AST):
+        self.depth += 1
+        super().visit(node)
+        self.depth -= 1
+
+    def qualify(self, name: str) -> str:
+        """Gives the qualified name of a definition in the current scope.
+
+        Args:
+            name (str): The name of the definition.
+
+        Returns:
+            str: Its qualified name.
+        """
+        if not self.scopes:
+            return name
+        kind, qualname, _ = self.scopes[-1]
+        return f"{qualname}.<locals>.{name}" if kind == "function" else f"{qualname}.{name}"
+
+    def header(self, node: ast.ClassDef | ast.FunctionDef | ast.AsyncFunctionDef) -> str:
+        """Gives the header of a class or function: its definition lines and its docstring.
+
+        Args:
+            node (ast.ClassDef | ast.FunctionDef | ast.AsyncFunctionDef): The class or function node.
+
+        Returns:
+            str: The header, followed by "..." standing for the body.
+        """
+        first_body = node.body[0]
+        end = first_body.lineno - 1
+        if ast.get_docstring(node) is not None:
+            end = first_body.end_lineno
+        header = "\n".join(line.rstrip("\r\n") for line in self.lines[node.lineno - 1 : end])
+        indent = " " * (first_body.col_offset)
+        return f"{header}\n{indent}..."
+
+    def current_function(self) -> int | None:
+        """Gives the position of the innermost function being visited, None outside of functions."""
+        for kind, _, position in reversed(self.scopes):
+            if kind == "function":
+                return position
+        return None
+
+    def add_function(self, node: ast.AST, name: str, source_node: ast.AST | None = None):
+        qualname = self.qualify(name)
+        parent = self.scopes[-1][1] if self.scopes else None
+        if qualname in self.index:
+            count = 2
+            while f"{qualname}#{count}" in self.index:
+                count += 1
+            qualname = f"{qualname}#{count}"
+
+        position = len(self.functions)
+        self.functions.append(new_function(node, self.content, name, qualname, parent, source_node, self.lines))
+        self.index[qualname] = position
+        self.by_name.setdefault(name, []).append(position)
+        if not isinstance(node, ast.Lambda):
+            self.headers[qualname] = self.header(node)
+        self.nodes.append(node)
+        self.returns.append([])
+        self.raw_calls.append([])
+
+        self.scopes.append(("function", qualname, position))
+        if isinstance(node, ast.Lambda):
+            self.visit(node.body)
+        else:
+            self.generic_visit(node)
+        self.scopes.pop()
+
+    def visit_Module(self, node: ast.Module):
+        self.docstring = ast.get_docstring(node)
+        self.import_sources = [
+            source_segment(self.lines, statement)
+            for statement in node.body
+            if isinstance(statement, (ast.Import, ast.ImportFrom))
+        ]
+        self.generic_visit(node)
+
+    def visit_Import(self, node: ast.Import):
+        list_imports(node, self.imports)
+        self.import_targets.update(import_targets(node))
+
+    def visit_ImportFrom(self, node: ast.ImportFrom):
+        list_imports(node, self.imports)
+        self.import_targets.update(import_targets(node))
+
+    def visit_ClassDef(self, node: ast.ClassDef):
+        qualname = self.qualify(node.name)
+        self.classes.setdefault(qualname, self.scopes[-1][1] if self.scopes else None)
+        self.class_headers.append((node.lineno, node.end_lineno, self.header(node)))
+        self.scopes.append(("class", qualname, None))
+        self.generic_visit(node)
+        self.scopes.pop()
+
+    def visit_FunctionDef(self, node: ast.FunctionDef):
+        self.add_function(node, node.name)
+
+    def visit_AsyncFunctionDef(self, node: ast.AsyncFunctionDef):
+        self.add_function(node, node.name)
+
+    def visit_Assign(self, node: ast.Assign):
+        if (
+            isinstance(node.value, ast.Lambda)
+            and len(node.targets) == 1
+            and isinstance(node.targets[0], ast.Name)
+        ):
+            self.add_function(node.value, node.targets[0].id, node)
+        else:
+            self.generic_visit(node)
+
+    def visit_Return(self, node: ast.Return):
+        position = self.current_function()
+        if position is not None:
+            self.returns[position].append((self.depth, node))
+        self.generic_visit(node)
+
+    def visit_Call(self, node: ast.Call):
+        position = self.current_function()
+        if position is not None:
+            if isinstance(node.func, ast.Name):
+                self.raw_calls[position].append((None, node.func.id))
+            elif isinstance(node.func, ast.Attribute):
+                # the dotted name of the called object, such as "os.path", "" for an expression
+                parts = []
+                value = node.func.value
+                while isinstance(value, ast.Attribute):
+                    parts.append(value.attr)
+                    value = value.value
+                base = ".".join([value.id, *reversed(parts)]) if isinstance(value, ast.Name) else ""
+                self.raw_calls[position].append((base, node.func.attr))
+        self.generic_visit(node)
+
+    def resolve(self, caller: dict, base: str | None, name: str) -> str | None:
+        """Resolves a call of a function of the file to the qualified name of the function called.
+
+        Args:
+            caller (dict): The calling function.
+            base (str | None): The dotted name of the called object for `base.name()`, "" for an expression, None for `name()`.
+            name (str): The name called.
+
+        Returns:
+            str | None: The qualified name of the function called, None if it isn't defined in the file.
+        """
+        # the enclosing scopes of the caller, innermost first: itself, then its parents
+        scopes = []
+        qualname = caller["qualname"]
+        while qualname is not None:
+            scopes.append(qualname)
+            if qualname in self.index:
+                qualname = self.functions[self.index[qualname]]["parent"]
+            else:
+                qualname = self.classes.get(qualname)
+
+        if base is None:
+            candidates = [f"{scope}.<locals>.{name}" for scope in scopes if scope in self.index]
+            candidates.append(name)
+            for candidate in candidates:
+                if candidate in self.index:
+                    return candidate
+                if candidate in self.classes and f"{candidate}.__init__" in self.index:
+                    return f"{candidate}.__init__"
+            return None
+
+        if base in ("self", "cls"):
+            for scope in scopes:
+                if scope in self.classes:
+                    return f"{scope}.{name}" if f"{scope}.{name}" in self.index else None
+        if base in self.classes:
+            return f"{base}.{name}" if f"{base}.{name}" in self.index else None
+
+        positions = self.by_name.get(name, [])
+        if len(positions) == 1:
+            return self.functions[positions[0]]["qualname"]
+        return None
+
+    def resolve_types(self, f: dict, node: ast.AST, values: list[ast.expr | None], imports: set[str]):
+        """Fills the parameter and return types resolved without the LLM, and the type of each return, see `static_types`.
+
+        The unresolved parameters keep an empty type, an unresolved return keeps its inferred type,
+        and an unresolved expression of `returns` keeps "any".
+
+        Args:
+            f (dict): The function's dictionnary, updated in place.
+            node (ast.AST): The function's node.
+            values (list[ast.expr | None]): The returned expressions of the function, None for a bare `return`.
+            imports (set[str]): The imports of the file and its classes, used to validate the types.
+        """
+        static = parameter_types(node, f["parent"] if f["parent"] in self.classes else None)
+        resolved = {}
+        for name, t in static.items():
+            try:
+                resolved[name] = validate_type(t, imports)
+            except ValueError:
+                pass
+        f["parameters"] = [(name, resolved.get(name, "")) for name, _ in f["parameters"]]
+
+        local = local_types(node) if not isinstance(node, ast.Lambda) else None
+        f["returns"] = [
+            (
+                ast.unparse(value) if value is not None else "",
+                returned_type(node, value, static, local) or "any",
+            )
+            for value in values
+        ]
 
+        t = return_type(node, values, static)
+        if t is not None:
+            try:
+                f["return"] = (f["return"][0], validate_type(t, imports))
+            except ValueError:
+                pass
+
+    def finish(self) -> list[dict]:
+        """Fills the return and the calls of each function, once the whole file is visited.
+
+        Returns:
+            list[dict]: The function dictionnaries.
+        """
+        # the classes of the file are valid types, such as the type of `self`
+        imports = set(self.imports) | set(self.classes)
+        for position, f in enumerate(self.functions):
+            node = self.nodes[position]
+            # a single return is shown as the function's value, its type is the union of every return's
+            value = None
+            values = [r.value for _, r in self.returns[position]]
+            valued = [(depth, r) for depth, r in self.returns[position] if r.value is not None]
+            if isinstance(node, ast.Lambda):
+                value = node.body
+                values = [node.body]
+            elif valued:
+                least_depth = min(depth for depth, _ in valued)
+                value = [r for depth, r in valued if depth == least_depth][-1].value
+            if value is not None:
+                f["return"] = (ast.unparse(value), infer_python_type_from_ast(value))
+            self.resolve_types(f, node, values, imports)
 
-def list_returns(node: ast, current_function: str, functions: list[dict]):
-    """Lists the return statements and their inferred types for the current function.
+            calls = set()
+            unresolved = []
+            for base, name in self.raw_calls[position]:
+                callee = self.resolve(f, base, name)
+                if callee is not None:
+                    calls.add(callee)
+                elif (base, name) not in unresolved:
+                    unresolved.append((base, name))
+            f["calls"] = sorted(calls)
+            self.unresolved[f["qualname"]] = unresolved
 
-    Args:
-        node (ast): The current AST node being explored.
-        current_function (str): The name of the current function.
-        functions (list[dict]): The list of function dictionaries.
-    """
+        called_by = [set() for _ in self.functions]
+        for f in self.functions:
+            for callee in f["calls"]:
+                called_by[self.index[callee]].add(f["qualname"])
+        for f, callers in zip(self.functions, called_by):
+            f["called_by"] = sorted(callers)
 
-    index = index_of(functions, "name", current_function)
-    
-    value = node.value
+        return self.functions
 
-    try:
-        return_expr = ast.unparse(value)
-    except Exception:
-        return_expr = "Unknown"
 
-    inferred_type = infer_python_type_from_ast(value)
+def parse_module(content: str, filepath: str = "<unknown>") -> ModuleVisitor:
+    """Parses the content of a Python file and visits it once, see `ModuleVisitor`.
+
+    Args:
+        content (str): The content of the file.
+        filepath (str, optional): The path of the file, used in syntax errors. Defaults to "<unknown>".
 
-    functions[index]["return"] = (return_expr, inferred_type)
+    Returns:
+        ModuleVisitor: The visitor, with its functions completed.
+    """
+    tree = parse_python(content, filepath)
+    visitor = ModuleVisitor(content)
+    visitor.visit(tree)
+    visitor.finish()
+    return visitor
 
 
-def extract_information(filepath: str) -> tuple[list[dict], set[str]]:
+def extract_information(filepath: str) -> tuple[list[dict], set[str], str]:
     """Extracts information about functions and imports from a Python file.
 
     Args:
         filepath (str): The path to the Python file.
 
     Returns:
-        tuple[list[dict], set[str]]: A tuple containing a list of function dictionaries and a set of import statements.
+        tuple[list[dict], set[str], str]: A tuple containing a list of function dictionaries, a set of import statements and the content of the file.
     """
     content = read_file(filepath)
-    tree = ast.parse(content, filepath)
-
-    functions = []
-    imports = []
-    func_stack=[]
-
-    for node in ast.walk(tree):
-        if isinstance(node, (ast.Import, ast.ImportFrom)):
-            list_imports(node, imports)
-        
-        if isinstance(node, ast.FunctionDef):
-            list_functions(node, content, functions)
-            func_stack.insert(0,(node.name, copy.copy(node)))
-
-    for func_name, func_node in reversed(func_stack):
-        for subnode in ast.walk(func_node):
-            if isinstance(subnode, ast.Return) :
-                list_returns(subnode, func_name, functions) ## assign the first return found to the function (can lead to inadequate return value)
-                break
-    
-    functions = list_calls(tree, functions)
-    functions = list_called_by(functions)
-
-    return functions, set(imports), content
+    visitor = parse_module(content, filepath)
+    return visitor.functions, set(visitor.imports), content
 
 
 def validate_types(llm_answer: str, imports: set[str]) -> list[str] | Exception:
@@ -361,7 +622,7 @@ def validate_types(llm_answer: str, imports: set[str]) -> list[str] | Exception:
     # Drop outer brackets
     inner = cleaned[1:-1].strip()
 
-    items = [item.strip() for item in inner.split(",")]
+    items = split_top_level(inner)
 
     sanitized = []
     for item in items:
@@ -404,31 +665,25 @@ def sanitize_and_validate(t: str, imports: set[str]) -> str:
         imports (set[str]): The set of import statements.
 
     Raises:
-        ValueError: If the type name is unknown or unsupported.
+        ValueError: If the type is unknown, unsupported or malformed.
 
     Returns:
-        str: The sanitized and validated type name.
+        str: The canonical type, generics kept, see `TypeParser`.
     """
-    sanitized_t = sanitize(t)
-
-    if not is_valid_type(sanitized_t, imports):
-        raise ValueError(f"Unknown or unsupported type name: '{sanitized_t}'")
+    return parse_type(sanitize(t), VALID_BASE_TYPES, imports)
 
-    return sanitized_t
 
-
-def sanitize(t: str) -> str | ValueError:
-    """Sanitizes a type name by removing extraneous characters and validating its format.
+def sanitize(t: str) -> str | TypeError:
+    """Sanitizes a type by removing the parameter name, quotes and blank space around it.
 
     Args:
-        t (str): The type name to sanitize.
+        t (str): The type to sanitize, such as "x: list[str]" or "x - str".
 
     Raises:
-        TypeError: If the type name is not a string.
-        ValueError: If the type name contains invalid characters.
+        TypeError: If the type is not a string.
 
     Returns:
-        str|ValueError: The sanitized type name or a ValueError if invalid.
+        str|TypeError: The sanitized type, generics kept.
     """
     if not isinstance(t, str):
         raise TypeError(f"Type name must be a string.\n Type: {t}")
@@ -440,15 +695,7 @@ def sanitize(t: str) -> str | ValueError:
         parts = t.split("-")
         if len(parts[-1].strip()) > 0:
             t = parts[-1].strip()
-    t = re.sub(r"\s+", "", t)
-    match = re.match(r"^(\w+)", t.strip().lower())  # get root type
-
-    if match:
-        t = match.group(1)
-
-    if any(ch in t for ch in ["(", ")", "[[", "{", "}"]):
-        raise ValueError(f"Invalid characters in type name: '{t}'")
-    return t
+    return t.strip().strip("`'\"").strip()
 
 
 def validate_tags(llm_answer: str) -> list[str] | Exception:
@@ -466,7 +713,7 @@ def validate_tags(llm_answer: str) -> list[str] | Exception:
         list[str] | Exception: A list of validated tags or an exception.
     """
     try:
-        value = ast.literal_eval(llm_answer.strip())
+        value = ast.literal_eval(parse_python(llm_answer.strip(), mode="eval"))
     except Exception as e:
         raise ValueError(f"Invalid Python literal for tags list: {e}") from e
     if not isinstance(value, list):
@@ -477,6 +724,35 @@ def validate_tags(llm_answer: str) -> list[str] | Exception:
     return value
 
 
+def parse_json_answer(llm_answer: str) -> object | Exception:
+    """Parses a JSON answer of the LLM, ignoring code fences and text around the JSON value.
+
+    Args:
+        llm_answer (str): The LLM answer containing the JSON value.
+
+    Raises:
+        ValueError: If the answer contains no valid JSON object or list.
+
+    Returns:
+        object | Exception: The parsed JSON value or an exception.
+    """
+    cleaned = llm_answer.strip()
+    cleaned = re.sub(r"^```(?:json)?\s*|\s*```$", "", cleaned).strip()
+    try:
+        return json.loads(cleaned)
+    except json.JSONDecodeError:
+        pass
+
+    starts = [i for i in (cleaned.find("{"), cleaned.find("[")) if i != -1]
+    if starts:
+        try:
+            value, _ = json.JSONDecoder().raw_decode(cleaned[min(starts):])
+            return value
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Invalid JSON answer: {e}") from e
+    raise ValueError(f"Expected a JSON answer, got: {cleaned}")
+
+
 def valid_category(answer_LLM: str, function_types: list[str]) -> bool:
     """Validates a single category provided by the LLM answer.
 
@@ -498,143 +774,206 @@ def valid_category(answer_LLM: str, function_types: list[str]) -> bool:
         return True
 
 
-def infer_python_type_from_ast(node: ast) -> str:
-    """Infers the Python type from an AST node.
+def in_range(value: int, min_val: int, max_val: int) -> bool:
+    """Checks if a value is within a specified range.
 
     Args:
-        node (ast): The AST node to infer the type from.
+        value (int): The value to check.
+        min_val (int): The minimum acceptable value.
+        max_val (int): The maximum acceptable value.
 
     Returns:
-        str: The inferred Python type as a string.
+        bool: True if the value is within the specified range, False otherwise.
     """
-    if isinstance(node, ast.Tuple):
-        return "tuple"
+    return min_val <= value <= max_val
 
-    if isinstance(node, ast.List):
-        return "list"
 
-    if isinstance(node, ast.Dict):
-        return "dict"
+def in_list(value: str, list_str: list[str]) -> bool:
+    """Checks if a string value is present in a list of strings, case-insensitively.
 
-    if isinstance(node, ast.Set):
-        return "set"
+    Args:
+        value (str): The string value to check.
+        list_str (list[str]): The list of strings to search within.
 
-    if isinstance(node, ast.Constant):
-        # True, 5, "hi", None
-        if isinstance(node.value, bool):
-            return "bool"
-        if isinstance(node.value, int):
-            return "int"
-        if isinstance(node.value, float):
-            return "float"
-        if isinstance(node.value, str):
-            return "str"
-        if node.value is None:
-            return "None"
-        return "any"
+    Returns:
+        bool: True if the string value is present in the list, False otherwise.
+    """
+    low_val = value.lower()
+    for items in list_str:
+        if items.lower() == low_val:
+            return True
+    return False
 
-    if isinstance(node, ast.Name):
-        # something like "return x"
-        return "any"
 
-    if isinstance(node, ast.Call):
-        # return something() → unknown
-        return "any"
+def write_functions_to_json(func_with_file: list[dict], output: str, dir:str|None = None) -> str:
+    """Writes a list of function dictionaries to the next version of a JSON file, see `OutputStore`.
 
-    return "any"
+    Args:
+        functions (list[dict]): The list of function dictionaries to write.
+        output (str): The output file path or base name for the JSON file.
+        dir (str|None): The directory to save the JSON file in. If None, uses the results directory.
 
+    Returns:
+        str: The path to the written JSON file, or an empty string if writing failed.
+    """
+    try:
+        base_name_no_ext = os.path.splitext(os.path.basename(output))[0]
+        store = output_store(dir if dir is not None else "results")
+        output_file = store.write(
+            f"{base_name_no_ext}_func_concepts",
+            json.dumps(func_with_file, indent=4, ensure_ascii=False),
+            ext="json",
+        )
+        print(f"[OK] JSON written: {output_file}")
+        return output_file
 
-def is_valid_type(expr: str, imports: set[str]) -> bool:
-    """Checks if a given type expression is valid based on known base types and imported types.
+    except Exception as e:
+        print(f"[ERROR] Failed to write JSON: {e}")
+        return ""
+
+
+def latest_functions_json(output: str, dir: str | None = None) -> str | None:
+    """Finds the last JSON written by `write_functions_to_json` for a file.
 
     Args:
-        expr (str): The type expression to validate.
-        imports (set[str]): A set of imported type names to consider valid.
+        output (str): The output file path or base name given to `write_functions_to_json`.
+        dir (str|None): The directory the JSON files were saved in. If None, uses the results directory.
 
     Returns:
-        bool: True if the type expression is valid, False otherwise.
+        str | None: The path of the JSON file with the highest version, or None if there is none.
     """
-    return expr in (VALID_BASE_TYPES | imports)
+    base_name_no_ext = os.path.splitext(os.path.basename(output))[0]
+    directory = dir if dir is not None else "results"
+    if not os.path.isdir(directory):
+        return None
+    return output_store(directory).latest(f"{base_name_no_ext}_func_concepts", "json")
 
 
-def in_range(value: int, min_val: int, max_val: int) -> bool:
-    """Checks if a value is within a specified range.
+def read_functions_from_json(filepath: str) -> list[dict]:
+    """Reads a list of function dictionaries written by `write_functions_to_json`.
 
     Args:
-        value (int): The value to check.
-        min_val (int): The minimum acceptable value.
-        max_val (int): The maximum acceptable value.
+        filepath (str): The path of the JSON file.
 
     Returns:
-        bool: True if the value is within the specified range, False otherwise.
+        list[dict]: The file header followed by the function dictionaries, or an empty list if reading failed.
     """
-    return min_val <= value <= max_val
+    try:
+        with open(filepath, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception as e:
+        print(f"Error reading JSON {filepath}: {e}")
+        return []
 
 
-def index_of(dicts: list[dict], key: str, value: any) -> int:
-    """Finds the index of the first dictionary in a list where the specified key has the given value.
+def source_hash(source: str) -> str:
+    """Hashes the source of a function.
 
     Args:
-        dicts (list[dict]): The list of dictionaries to search.
-        key (str): The key to look for in each dictionary.
-        value (any): The value to match against the specified key.
+        source (str): The source of the function.
 
     Returns:
-        int: The index of the first dictionary where the key matches the value, or -1 if not found.
+        str: The hex digest of the source.
     """
-    for i, d in enumerate(dicts):
-        if d.get(key) == value:
-            return i
-    return -1  # or None
+    return hashlib.sha256((source or "").encode("utf-8")).hexdigest()
 
 
-def in_list(value: str, list_str: list[str]) -> bool:
-    """Checks if a string value is present in a list of strings, case-insensitively.
+def parse_source(source: str) -> ast.AST | None:
+    """Parses the source of a function, whose first line lost the indentation of the others when nested.
 
     Args:
-        value (str): The string value to check.
-        list_str (list[str]): The list of strings to search within.
+        source (str): The function's source, see `extract_information`.
 
     Returns:
-        bool: True if the string value is present in the list, False otherwise.
+        ast.AST | None: The function's node, or None if the source can't be parsed.
     """
-    low_val = value.lower()
-    for items in list_str:
-        if items.lower() == low_val:
-            return True
-    return False
+    lines = source.splitlines()
+    indents = [len(line) - len(line.lstrip()) for line in lines[1:] if line.strip()]
+    for pad in range(min(indents, default=0), -1, -1):
+        try:
+            tree = parse_python(textwrap.dedent(" " * pad + source))
+        except SyntaxError:
+            continue
+        return tree.body[0] if tree.body else None
+    return None
 
 
-def write_functions_to_json(func_with_file: list[dict], output: str, dir:str|None = None) -> str:
-    """Writes a list of function dictionaries to a JSON file.
+def ast_fingerprint(source: str) -> str | None:
+    """Hashes the normalized AST of a function's source, ignoring formatting, comments and docstring whitespace.
 
     Args:
-        functions (list[dict]): The list of function dictionaries to write.
-        output (str): The output file path or base name for the JSON file.
-        dir (str|None): The directory to save the JSON file in. If None, uses current directory.
+        source (str): The function's source.
 
     Returns:
-        str: The path to the written JSON file, or an empty string if writing failed.
+        str | None: The hex digest, identical for functions written differently but parsed the same, None if the source can't be parsed.
     """
-    try:
-        base_name = os.path.basename(output)
-        base_name_no_ext = os.path.splitext(base_name)[0]
-        if dir is not None:
-            os.makedirs(dir, exist_ok=True)
-            base_output_name = f"{dir}/{base_name_no_ext}_func_concepts"
-        else:
-            base_output_name = f"results/{base_name_no_ext}_func_concepts"
-        output_file = next_available_filename(base_output_name, ext="json")
-        with open(output_file, "w", encoding="utf-8") as out:
-            json.dump(func_with_file, out, indent=4, ensure_ascii=False)
+    node = parse_source(source or "")
+    if node is None:
+        return None
+    for child in ast.walk(node):
+        body = getattr(child, "body", None)
+        if (
+            isinstance(body, list)
+            and body
+            and isinstance(body[0], ast.Expr)
+            and isinstance(body[0].value, ast.Constant)
+            and isinstance(body[0].value.value, str)
+        ):
+            body[0].value.value = " ".join(body[0].value.value.split())
+    dump = ast.dump(node, annotate_fields=False, include_attributes=False)
+    return hashlib.sha256(dump.encode("utf-8")).hexdigest()
+
+
+def copy_definition(f: dict, source: dict):
+    """Copies the LLM definition of a function: its parameter types, return type, description, tags and category, with the category's source.
+
+    Args:
+        f (dict): The function dictionnary, updated in place.
+        source (dict): The defined function, or its stored definition.
+    """
+    f["parameters"] = [tuple(p) for p in source["parameters"]]
+    f["return"] = (f["return"][0], source["return"][1])
+    f["description"] = source["description"]
+    f["tags"] = list(source["tags"])
+    f["category"] = source["category"]
+    f["category_source"] = source.get("category_source", "")
+    f["category_confidence"] = source.get("category_confidence")
+
+
+def merge_previous(functions: list[dict], previous: list[dict]) -> list[dict]:
+    """Copies the LLM definitions of the functions unchanged since a previous analysis.
+
+    A function is unchanged when a previous function of the same qualified name has the same source hash and calls the same functions.
+    Previous outputs without qualified names are matched by name.
+
+    Args:
+        functions (list[dict]): The function dictionaries freshly extracted from the file, updated in place.
+        previous (list[dict]): The previous output of the analysis of the file, with or without its file header.
+
+    Returns:
+        list[dict]: The functions that are new or changed, and still have to be defined.
+    """
+    previous_by_name = {}
+    for f in previous:
+        if "name" in f and "source" in f:
+            previous_by_name.setdefault(f.get("qualname", f["name"]), f)
+
+    changed = []
+    for f in functions:
+        prev = previous_by_name.get(f["qualname"])
+        if (
+            prev is None
+            or source_hash(prev["source"]) != source_hash(f["source"])
+            or sorted(set(prev.get("calls", []))) != f["calls"]
+        ):
+            changed.append(f)
+            continue
+
+        copy_definition(f, prev)
+
+    return changed
 
-        print(f"[OK] JSON written: {output_file}")
-        return output_file
 
-    except Exception as e:
-        print(f"[ERROR] Failed to write JSON: {e}")
-        return ""
-    
 def write_file(filepath: str, content: str) -> str:
     """Writes content to a file at the specified filepath.
 